@@ -0,0 +1,139 @@
+"""
+Columnar observer benchmark.
+
+Builds a capture file from many copies of the test traces, interleaved in
+time and with the addresses of each copy changed so that the copies are
+separate flows, and compares the packet rate of the ColumnarObserver with
+that of the Observer reading the same file with the pure Python packet
+source, checking that both produce the same flow records.
+
+Usage::
+
+    python3 benchmarks/columnar.py [-c COPIES] [-r ROUNDS] [PCAP ...]
+
+NumPy is required for the ColumnarObserver.
+"""
+
+import argparse
+import glob
+import json
+import os
+import queue
+import sys
+import tempfile
+import time
+
+from pathspider.base import SHUTDOWN_SENTINEL
+from pathspider.chains.basic import BasicChain
+from pathspider.chains.dscp import DSCPChain
+from pathspider.chains.ecn import ECNChain
+from pathspider.chains.tcp import TCPChain
+from pathspider.chains.udp import UDPChain
+from pathspider.columnar import ColumnarObserver
+from pathspider.observer import Observer
+from pathspider.traces.pcap import PcapTrace
+from pathspider.traces.pcap import PcapWriter
+
+CHAINS = [BasicChain, TCPChain, ECNChain, DSCPChain, UDPChain]
+DATA = os.path.join(os.path.dirname(__file__), "..", "pathspider", "tests",
+                    "data")
+
+# Seconds between the starts of consecutive copies of a trace, and the number
+# of copies after which addresses are reused, so that flow keys recur after
+# their earlier flows have gone idle
+SPACING = 0.05
+REUSE = 1000
+
+
+def _readdress(data, copy):
+    data = bytearray(data)
+    (first, second) = (copy & 0xff, (copy >> 8) & 0xff)
+    if data[0] >> 4 == 4:
+        for off in (12, 16):
+            data[off + 1] ^= first
+            data[off + 2] ^= second
+    else:
+        for off in (8, 24):
+            data[off + 2] ^= first
+            data[off + 3] ^= second
+    return bytes(data)
+
+
+def build(traces, copies, path):
+    """
+    Write a capture file of interleaved copies of the packets of the traces.
+
+    :returns: the number of packets written
+    """
+
+    packets = []
+    for trace in traces:
+        source = PcapTrace(trace)
+        first = None
+        for pkt in source:
+            ip = pkt.ip or pkt.ip6
+            if ip is None:
+                continue
+            if first is None:
+                first = pkt.seconds
+            packets.append((pkt.seconds - first, bytes(ip.data)))
+        source.close()
+
+    writer = PcapWriter(path)
+    timeline = sorted(
+        (1.5e9 + copy * SPACING + seconds, copy, index)
+        for copy in range(copies)
+        for (index, (seconds, _)) in enumerate(packets))
+    for (seconds, copy, index) in timeline:
+        writer.write(seconds, _readdress(packets[index][1], copy % REUSE))
+    writer.close()
+    return len(timeline)
+
+
+def run_once(observer):
+    flowqueue = queue.Queue()
+    start = time.perf_counter()
+    observer.run_flow_enqueuer(flowqueue)
+    flows = [flow for batch in iter(flowqueue.get, SHUTDOWN_SENTINEL)
+             for flow in batch]
+    return (time.perf_counter() - start, flows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("-c", "--copies", type=int, default=100,
+                        help="Copies of the traces in the capture file")
+    parser.add_argument("-r", "--rounds", type=int, default=3,
+                        help="Rounds per observer, the best is reported")
+    parser.add_argument("traces", nargs="*",
+                        help="Capture files (Default: the test data)")
+    args = parser.parse_args()
+
+    traces = args.traces or sorted(glob.glob(os.path.join(DATA, "*.pcap")))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "tiled.pcap")
+        packets = build(traces, args.copies, path)
+        lturi = "pcapfile:" + path
+
+        results = {}
+        for (name, create) in (
+                ("observer", lambda: Observer(lturi, CHAINS,
+                                              packet_source="python")),
+                ("columnar", lambda: ColumnarObserver(lturi, CHAINS))):
+            (elapsed, flows) = min((run_once(create())
+                                    for _ in range(args.rounds)),
+                                   key=lambda result: result[0])
+            results[name] = (elapsed, sorted(json.dumps(flow)
+                                             for flow in flows))
+            print("{:<10} {:>8} packets {:>8} flows {:>12.0f} pkt/s".format(
+                name, packets, len(flows), packets / elapsed))
+
+    if results["observer"][1] != results["columnar"][1]:
+        print("flow records differ")
+        return 1
+    print("speedup: {:.2f}x".format(results["observer"][0] /
+                                    results["columnar"][0]))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,125 @@
+"""
+Observer chain dispatch benchmark.
+
+Measures the packet rate of the Observer running the chain stack used by the
+``ecn`` plugin (BasicChain, TCPChain and ECNChain) over a capture file, using
+the precompiled per-hook dispatch tables and, for comparison, the previous
+dispatch that looked up the chain functions for every hook on every packet.
+
+Usage::
+
+    python3 benchmarks/observer_dispatch.py [-r ROUNDS] [PCAP ...]
+
+The capture files are read with python-libtrace if it is installed, and
+otherwise with the pure Python packet sources in :mod:`pathspider.traces`.
+"""
+
+import argparse
+import os
+import queue
+import sys
+import time
+
+from pathspider.base import SHUTDOWN_SENTINEL
+from pathspider.chains.basic import BasicChain
+from pathspider.chains.tcp import TCPChain
+from pathspider.chains.ecn import ECNChain
+from pathspider.observer import Observer
+
+CHAINS = [BasicChain, TCPChain, ECNChain]
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..",
+                        "pathspider", "tests", "data")
+DEFAULT_TRACES = ["tcp_ecn.pcap", "ecn_fake_fwd_ce.pcap", "tcp_http.pcap"]
+
+
+class LegacyDispatchObserver(Observer):
+    """
+    An Observer using the per-packet chain function lookup that was in place
+    before the dispatch tables were precompiled.
+    """
+
+    def _legacy_chains(self, name):
+        return [
+            c.__getattribute__(name) for c in self._chains if hasattr(c, name)
+        ]
+
+    def _dispatch(self, rec, rev):
+        keep_flow = True
+        if self._pkt.ip:
+            for fn in self._legacy_chains("ip4"):
+                keep_flow = keep_flow and fn(rec, self._pkt.ip, rev=rev)
+            if self._pkt.icmp:
+                for fn in self._legacy_chains("icmp4"):
+                    q = self._pkt.icmp.payload # pylint: disable=no-member
+                    keep_flow = keep_flow and fn(rec, self._pkt.ip, q, rev=rev)
+        elif self._pkt.ip6:
+            for fn in self._legacy_chains("ip6"):
+                keep_flow = keep_flow and fn(rec, self._pkt.ip6, rev=rev)
+            if self._pkt.icmp6:
+                for fn in self._legacy_chains("icmp6"):
+                    q = self._pkt.icmp6.payload # pylint: disable=no-member
+                    keep_flow = keep_flow and fn(
+                        rec, self._pkt.ip6, q, rev=rev)
+        if self._pkt.tcp:
+            for fn in self._legacy_chains("tcp"):
+                keep_flow = keep_flow and fn(rec, self._pkt.tcp, rev=rev)
+        elif self._pkt.udp:
+            for fn in self._legacy_chains("udp"):
+                keep_flow = keep_flow and fn(rec, self._pkt.udp, rev=rev)
+        return keep_flow
+
+
+def run_once(observer_class, trace):
+    observer = observer_class("pcap:" + trace, CHAINS)
+    flowqueue = queue.Queue()
+    start = time.perf_counter()
+    observer.run_flow_enqueuer(flowqueue)
+    elapsed = time.perf_counter() - start
+    flows = 0
+    batch = flowqueue.get()
+    while batch != SHUTDOWN_SENTINEL:
+        flows += len(batch)
+        batch = flowqueue.get()
+    return (observer._ct_pkt, flows, elapsed) # pylint: disable=protected-access
+
+
+def bench(observer_class, traces, rounds):
+    best = None
+    for _ in range(rounds):
+        packets = 0
+        elapsed = 0.0
+        for trace in traces:
+            (pkts, _, secs) = run_once(observer_class, trace)
+            packets += pkts
+            elapsed += secs
+        rate = packets / elapsed
+        if best is None or rate > best[1]:
+            best = (packets, rate)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("-r", "--rounds", type=int, default=5,
+                        help="Rounds per variant, the best is reported")
+    parser.add_argument("traces", nargs="*", metavar="PCAP",
+                        help="Capture files (default: ECN test traces)")
+    args = parser.parse_args()
+
+    traces = args.traces or [os.path.join(DATA_DIR, t)
+                             for t in DEFAULT_TRACES]
+
+    results = []
+    for (name, observer_class) in (("per-packet lookup",
+                                    LegacyDispatchObserver),
+                                   ("dispatch tables", Observer)):
+        (packets, rate) = bench(observer_class, traces, args.rounds)
+        results.append(rate)
+        print("{:<20} {:>8} packets {:>12.0f} pkt/s".format(name, packets,
+                                                          rate))
+    print("speedup: {:.2f}x".format(results[1] / results[0]))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
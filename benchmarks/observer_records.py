@@ -0,0 +1,102 @@
+"""
+Observer flow record memory benchmark.
+
+Measures the memory used per active flow by the flow records the Observer
+keeps for the chain stack used by the ``ecn`` plugin (BasicChain, TCPChain
+and ECNChain), comparing dictionaries initialised key by key as before the
+chains declared their fields with the slot-backed records generated from the
+declarations.
+
+Usage::
+
+    python3 benchmarks/observer_records.py [-f FLOWS]
+"""
+
+import argparse
+import ipaddress
+import sys
+import tracemalloc
+
+from pathspider.chains.base import Field
+from pathspider.chains.basic import BasicChain
+from pathspider.chains.tcp import TCPChain
+from pathspider.chains.ecn import ECNChain
+from pathspider.records import record_class
+
+CHAINS = [BasicChain, TCPChain, ECNChain]
+
+
+def dict_record(i, pt):
+    rec = {'pkt_first': pt, '_kdir': 0}
+    (rec['sip'], rec['dip'], rec['proto']) = (
+        str(ipaddress.IPv4Address(0x0a000000 + (i >> 16))),
+        str(ipaddress.IPv4Address(0xc0000000 + i)), 6)
+    (rec['sp'], rec['dp']) = (1024 + (i & 0xffff), 80)
+    rec['pkt_fwd'] = 0
+    rec['pkt_rev'] = 0
+    rec['oct_fwd'] = 0
+    rec['oct_rev'] = 0
+    rec['tcp_synflags_fwd'] = None
+    rec['tcp_synflags_rev'] = None
+    rec['tcp_fin_fwd'] = False
+    rec['tcp_fin_rev'] = False
+    rec['tcp_rst_fwd'] = False
+    rec['tcp_rst_rev'] = False
+    rec['tcp_connected'] = False
+    for d in ['fwd', 'rev']:
+        for t in ['syn', 'data']:
+            for f in ['ect0', 'ect1', 'ce']:
+                rec['ecn_{}_{}_{}'.format(f, t, d)] = False
+    rec['pkt_last'] = pt
+    return rec
+
+
+def slot_record_factory():
+    record = record_class(
+        [Field("pkt_first", float, None)] +
+        [field for chain in CHAINS for field in chain.fields] +
+        [Field("pkt_last", float, None), Field("_kdir", int, 0)])
+
+    def slot_record(i, pt):
+        rec = record()
+        rec.pkt_first = pt
+        (rec['sip'], rec['dip'], rec['proto']) = (
+            str(ipaddress.IPv4Address(0x0a000000 + (i >> 16))),
+            str(ipaddress.IPv4Address(0xc0000000 + i)), 6)
+        (rec['sp'], rec['dp']) = (1024 + (i & 0xffff), 80)
+        rec.pkt_last = pt
+        return rec
+
+    return slot_record
+
+
+def measure(factory, flows):
+    tracemalloc.start()
+    table = {}
+    for i in range(flows):
+        table[i.to_bytes(13, "big")] = factory(i, 1500000000.0 + i / 1000)
+    # only count the records, not the flow table holding them
+    (current, _) = tracemalloc.get_traced_memory()
+    table_size = sys.getsizeof(table) + sum(sys.getsizeof(k) for k in table)
+    tracemalloc.stop()
+    return (current - table_size) / flows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("-f", "--flows", type=int, default=500000,
+                        help="Number of concurrent flows")
+    args = parser.parse_args()
+
+    results = []
+    for (name, factory) in (("dict", dict_record),
+                            ("slots", slot_record_factory())):
+        per_flow = measure(factory, args.flows)
+        results.append(per_flow)
+        print("{:<6} {:>8.0f} bytes per flow {:>8.1f} MiB for {} flows".format(
+            name, per_flow, per_flow * args.flows / 2**20, args.flows))
+    print("reduction: {:.2f}x".format(results[0] / results[1]))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,200 @@
+"""
+Observer flow timer benchmark.
+
+Simulates the Observer's idle and expiry timer handling for a large number of
+concurrent flows, comparing the dict-of-sets bin tables previously used by
+the Observer with the timing wheel. Each flow sees a number of packets spread
+over a busy period, followed by a long silence and a final packet that
+expires every flow.
+
+The bin tables previously placed a flow completed by its idle timeout in the
+expiry bin for the packet clock before the tick began, so a flow completed
+during a jump of more than the expiry timeout was never expired. The timing
+wheel schedules its expiry from the time it completed, and the emulated bin
+tables do the same here, so that both variants expire the same flows. The
+cost per expired flow is reported along with the packet rate.
+
+Usage::
+
+    python3 benchmarks/observer_timers.py [-f FLOWS] [-p PACKETS]
+"""
+
+import argparse
+import math
+import random
+import sys
+import time
+
+from pathspider.timers import TimingWheel
+
+IDLE_TIMEOUT = 30
+EXPIRY_TIMEOUT = 5
+
+
+class BinTimers:
+    """
+    The idle and expiry bin tables the Observer used before the timing wheel,
+    with flows expired from the bin they were completed in.
+    """
+
+    def __init__(self):
+        self.ptq = 0
+        self.idle_bins = {}
+        self.expiry_bins = {}
+        self.active = {}
+        self.expiring = {}
+        self.emitted = 0
+
+    def packet(self, fid, pt):
+        self.tick(pt)
+        rec = self.active.get(fid)
+        if rec is None:
+            rec = {'pkt_first': pt, '_idle_bin': 0}
+            self.active[fid] = rec
+        rec['pkt_last'] = pt
+        new_idle_bin = math.ceil(pt + IDLE_TIMEOUT)
+        if new_idle_bin > rec['_idle_bin']:
+            if rec['_idle_bin'] in self.idle_bins:
+                self.idle_bins[rec['_idle_bin']] -= set((fid, ))
+            if new_idle_bin in self.idle_bins:
+                self.idle_bins[new_idle_bin] |= set((fid, ))
+            else:
+                self.idle_bins[new_idle_bin] = set((fid, ))
+            rec['_idle_bin'] = new_idle_bin
+
+    def complete(self, fid):
+        rec = self.active.pop(fid)
+        self.idle_bins[rec['_idle_bin']] -= set((fid, ))
+        self.expiring[fid] = rec
+        expiry_bin = math.ceil(self.ptq + EXPIRY_TIMEOUT)
+        if expiry_bin in self.expiry_bins:
+            self.expiry_bins[expiry_bin] |= set((fid, ))
+        else:
+            self.expiry_bins[expiry_bin] = set((fid, ))
+
+    def tick(self, pt):
+        next_ptq = math.ceil(pt)
+        if next_ptq <= self.ptq:
+            return
+        elif self.ptq == 0:
+            self.ptq = next_ptq
+            return
+        for bint in range(self.ptq + 1, next_ptq + 1):
+            # flows completed in this bin expire from it
+            self.ptq = bint
+            if bint in self.idle_bins:
+                for fid in self.idle_bins[bint].copy():
+                    self.complete(fid)
+                del self.idle_bins[bint]
+            if bint in self.expiry_bins:
+                for fid in self.expiry_bins[bint].copy():
+                    del self.expiring[fid]
+                    self.emitted += 1
+                del self.expiry_bins[bint]
+        self.ptq = next_ptq
+
+
+class WheelTimers:
+    """
+    The idle and expiry timing wheels as used by the Observer.
+    """
+
+    def __init__(self):
+        self.ptq = 0
+        self.idle_timers = TimingWheel()
+        self.expiry_timers = TimingWheel()
+        self.active = {}
+        self.expiring = {}
+        self.emitted = 0
+
+    def packet(self, fid, pt):
+        self.tick(pt)
+        rec = self.active.get(fid)
+        if rec is None:
+            rec = {'pkt_first': pt}
+            self.active[fid] = rec
+            self.idle_timers.schedule(math.ceil(pt + IDLE_TIMEOUT), fid)
+        rec['pkt_last'] = pt
+
+    def tick(self, pt):
+        next_ptq = math.ceil(pt)
+        if next_ptq <= self.ptq:
+            return
+        elif self.ptq == 0:
+            self.ptq = next_ptq
+            self.idle_timers.advance(next_ptq)
+            self.expiry_timers.advance(next_ptq)
+            return
+        for fid in self.idle_timers.expire(next_ptq):
+            rec = self.active.get(fid)
+            if rec is None:
+                continue
+            idle_tick = math.ceil(rec['pkt_last'] + IDLE_TIMEOUT)
+            if idle_tick > self.idle_timers.time:
+                self.idle_timers.schedule(idle_tick, fid)
+            else:
+                del self.active[fid]
+                self.expiring[fid] = rec
+                self.expiry_timers.schedule(
+                    self.idle_timers.time + EXPIRY_TIMEOUT, fid)
+        for fid in self.expiry_timers.expire(next_ptq):
+            if self.expiring.pop(fid, None) is not None:
+                self.emitted += 1
+        self.ptq = next_ptq
+
+
+def workload(flows, packets, seed=0):
+    rng = random.Random(seed)
+    start = 1500000000.0
+    busy = 20.0
+    events = []
+    for fid in range(flows):
+        first = start + rng.random() * busy
+        events.append((first, fid))
+        for _ in range(packets - 1):
+            events.append((first + rng.random() * busy, fid))
+    events.sort()
+    # a long silence then one more packet to expire everything
+    events.append((start + busy + 3600.0, flows))
+    return events
+
+
+def bench(timers_class, events):
+    timers = timers_class()
+    packet = timers.packet
+    start = time.perf_counter()
+    for (pt, fid) in events:
+        packet(fid, pt)
+    # and again after the last flow has expired
+    timers.tick(events[-1][0] + 3600.0)
+    elapsed = time.perf_counter() - start
+    return (elapsed, timers.emitted)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("-f", "--flows", type=int, default=1000000,
+                        help="Number of concurrent flows")
+    parser.add_argument("-p", "--packets", type=int, default=4,
+                        help="Packets per flow")
+    args = parser.parse_args()
+
+    events = workload(args.flows, args.packets)
+    print("{} flows, {} packets".format(args.flows, len(events)))
+
+    results = []
+    for (name, timers_class) in (("bin tables", BinTimers),
+                                 ("timing wheel", WheelTimers)):
+        (elapsed, emitted) = bench(timers_class, events)
+        results.append((elapsed, emitted))
+        print("{:<14} {:>8.2f} s {:>12.0f} pkt/s {:>9} flows expired "
+              "{:>8.2f} us/flow".format(name, elapsed, len(events) / elapsed,
+                                        emitted, elapsed / emitted * 1e6))
+    if results[0][1] != results[1][1]:
+        print("the variants expired different numbers of flows")
+        return 1
+    print("speedup: {:.2f}x".format(results[0][0] / results[1][0]))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
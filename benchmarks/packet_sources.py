@@ -0,0 +1,72 @@
+"""
+Observer packet source benchmark.
+
+Runs the Observer with the chain stack used by the ``ecn`` plugin (BasicChain,
+TCPChain and ECNChain) over the capture files in ``pathspider/tests/data``,
+reading the packets with python-libtrace (if it is installed) and with the
+pure Python memory-mapped packet source in ``pathspider.traces``.
+
+Usage::
+
+    python3 benchmarks/packet_sources.py [-r ROUNDS] [PCAP ...]
+"""
+
+import argparse
+import glob
+import os
+import queue
+import sys
+import time
+
+from pathspider.base import SHUTDOWN_SENTINEL
+from pathspider.chains.basic import BasicChain
+from pathspider.chains.tcp import TCPChain
+from pathspider.chains.ecn import ECNChain
+from pathspider.observer import Observer
+
+CHAINS = [BasicChain, TCPChain, ECNChain]
+DATA = os.path.join(os.path.dirname(__file__), "..", "pathspider", "tests",
+                    "data")
+
+
+def run_once(packet_source, traces):
+    packets = 0
+    flows = 0
+    start = time.perf_counter()
+    for trace in traces:
+        observer = Observer("pcapfile:" + trace, CHAINS,
+                            packet_source=packet_source)
+        flowqueue = queue.Queue()
+        observer.run_flow_enqueuer(flowqueue)
+        packets += observer._ct_pkt # pylint: disable=protected-access
+        for batch in iter(flowqueue.get, SHUTDOWN_SENTINEL):
+            flows += len(batch)
+    return (time.perf_counter() - start, packets, flows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("-r", "--rounds", type=int, default=5,
+                        help="Rounds to run, the best is reported")
+    parser.add_argument("traces", nargs="*",
+                        help="Capture files (Default: the test data)")
+    args = parser.parse_args()
+
+    traces = args.traces or sorted(glob.glob(os.path.join(DATA, "*.pcap")))
+    results = {}
+    for packet_source in ("libtrace", "python"):
+        try:
+            (elapsed, packets, flows) = min(run_once(packet_source, traces)
+                                            for _ in range(args.rounds))
+        except ImportError:
+            print("{:<9} not installed".format(packet_source))
+            continue
+        results[packet_source] = elapsed
+        print("{:<9} {:>8.3f} s {:>12.0f} pkt/s {:>8} packets {:>6} flows".format(
+            packet_source, elapsed, packets / elapsed, packets, flows))
+    if len(results) == 2:
+        print("speedup: {:.2f}x".format(results["libtrace"] / results["python"]))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,464 @@
+"""
+.. module:: pathspider.aggregate
+   :synopsis: Fixed-memory aggregate statistics of observed traffic
+
+This module contains the sketches used by an Observer in aggregate mode,
+where rather than keeping a record for every flow it summarises the traffic
+it sees in fixed memory, so that a link can be monitored for days at a time.
+A :class:`CountMinSketch` estimates the packets and octets to and from each
+network prefix, a :class:`HyperLogLog` estimates the number of distinct
+flows, and a :class:`Histogram` counts the values of each field set by the
+chains (e.g. ECN and DSCP marks or TCP option usage). The
+:class:`Aggregator` combines these and produces a summary for each interval
+of packet time.
+
+.. codeauthor:: Iain R. Learmonth <irl@fsfe.org>
+
+"""
+
+import array
+import collections
+import hashlib
+import ipaddress
+import math
+import zlib
+
+from pathspider.chains.basic import BasicChain
+
+
+def _prefix(addr, length):
+    """
+    Get the bytes of a network prefix of a packed address, with the bits
+    beyond the prefix length cleared.
+    """
+
+    (full, bits) = divmod(length, 8)
+    if not bits:
+        return bytes(addr[:full])
+    return bytes(addr[:full]) + bytes((addr[full] & (0xff00 >> bits) & 0xff,))
+
+
+class CountMinSketch:
+    """
+    Estimates the counts of a stream of keys in fixed memory. Estimates are
+    never lower than the true count, and are higher by at most a fraction of
+    about ``e / width`` of the total count, with a probability of failure of
+    about ``exp(-depth)``.
+
+    :param width: The number of counters in each row
+    :type width: int
+    :param depth: The number of rows, each with its own hash function
+    :type depth: int
+    """
+
+    def __init__(self, width=2048, depth=4):
+        self._width = width
+        self._seeds = [(row * 0x9e3779b9) & 0xffffffff
+                       for row in range(depth)]
+        self._rows = [array.array('Q', bytes(8 * width))
+                      for _ in range(depth)]
+
+    def add(self, key, count=1):
+        """
+        Add to the count of a key.
+
+        :param key: the key
+        :type key: bytes
+        :param count: the amount to add
+        :type count: int
+        """
+
+        width = self._width
+        for (seed, row) in zip(self._seeds, self._rows):
+            row[zlib.crc32(key, seed) % width] += count
+
+    def estimate(self, key):
+        """
+        Estimate the count of a key.
+
+        :param key: the key
+        :type key: bytes
+        :rtype: int
+        """
+
+        width = self._width
+        return min(row[zlib.crc32(key, seed) % width]
+                   for (seed, row) in zip(self._seeds, self._rows))
+
+    def clear(self):
+        """
+        Reset all of the counts.
+        """
+
+        for row in self._rows:
+            row[:] = array.array('Q', bytes(8 * self._width))
+
+
+class HyperLogLog:
+    """
+    Estimates the number of distinct keys in a stream in fixed memory, with
+    a standard error of about ``1.04 / sqrt(2 ** precision)``.
+
+    :param precision: The number of bits of the hash used to choose a
+                      register, there are ``2 ** precision`` registers
+    :type precision: int
+    """
+
+    def __init__(self, precision=12):
+        if not 4 <= precision <= 16:
+            raise ValueError("HyperLogLog precision must be in the range "
+                             "4 <= precision <= 16")
+        self._precision = precision
+        self._registers = bytearray(1 << precision)
+
+    def add(self, key):
+        """
+        Add a key.
+
+        :param key: the key
+        :type key: bytes
+        """
+
+        value = int.from_bytes(hashlib.sha1(key).digest()[:8], "big")
+        index = value >> (64 - self._precision)
+        rest = value & ((1 << (64 - self._precision)) - 1)
+        rank = 64 - self._precision - rest.bit_length() + 1
+        if rank > self._registers[index]:
+            self._registers[index] = rank
+
+    def count(self):
+        """
+        Estimate the number of distinct keys added.
+
+        :rtype: int
+        """
+
+        size = len(self._registers)
+        alpha = 0.7213 / (1 + 1.079 / size)
+        estimate = alpha * size * size / sum(2.0 ** -register
+                                             for register in self._registers)
+        zeros = self._registers.count(0)
+        if estimate <= 2.5 * size and zeros:
+            # small cardinalities are better estimated by linear counting
+            estimate = size * math.log(size / zeros)
+        return int(round(estimate))
+
+    def clear(self):
+        """
+        Forget all of the keys added.
+        """
+
+        self._registers = bytearray(len(self._registers))
+
+
+def _json_key(value):
+    """
+    Convert a value to the string used for it as a key in JSON.
+
+    :param value: the value
+    :rtype: str
+    """
+
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    return str(value)
+
+
+class Histogram:
+    """
+    Counts the occurrences of each value in a stream, for up to ``bins``
+    distinct values. Further values are counted together as others.
+
+    :param bins: The maximum number of distinct values counted
+    :type bins: int
+    """
+
+    def __init__(self, bins=256):
+        self._bins = bins
+        self._counts = {}
+        #: The number of occurrences of values that were not counted
+        self.other = 0
+
+    def add(self, value, count=1):
+        """
+        Count an occurrence of a value.
+
+        :param value: the value
+        :param count: the number of occurrences
+        :type count: int
+        """
+
+        counts = self._counts
+        if value in counts:
+            counts[value] += count
+        elif len(counts) < self._bins:
+            counts[value] = count
+        else:
+            self.other += count
+
+    def to_dict(self):
+        """
+        Get the counts, with the values as strings as in JSON.
+
+        :rtype: dict
+        """
+
+        counts = {_json_key(value): count
+                  for (value, count) in sorted(self._counts.items(),
+                                               key=lambda item: str(item[0]))}
+        if self.other:
+            counts["other"] = self.other
+        return counts
+
+    def clear(self):
+        """
+        Reset all of the counts.
+        """
+
+        self._counts.clear()
+        self.other = 0
+
+    def __len__(self):
+        return len(self._counts)
+
+
+class Aggregator:
+    """
+    Summarises the packets seen by an Observer in aggregate mode.
+
+    Each packet is passed to the chains as a flow of its own, and the record
+    they fill in is added to the aggregator along with the packet. The
+    values set by the chains are counted in a histogram for each boolean and
+    integer field, except for the addresses, ports and counters of
+    :class:`pathspider.chains.basic.BasicChain`, which are summarised by the
+    sketches instead. Packets are counted for both the source and the
+    destination prefix, once if these are the same.
+
+    The direction of a packet is relative to the first packet seen of its
+    flow, as for flow records, for the flows in a table of the flows most
+    recently seen. Packets of flows that have been forgotten are counted as
+    if they were the first packet of the flow.
+
+    A summary is produced for each ``interval`` seconds of packet time in
+    which packets were seen, starting at multiples of the interval, with:
+
+    ``pkt_first``, ``pkt_last``
+      the times of the first and last packets of the interval
+    ``packets``, ``octets``
+      the numbers of packets and octets (counted as in the ``oct_fwd`` and
+      ``oct_rev`` fields of BasicChain)
+    ``flows``
+      the estimated number of distinct flows
+    ``prefixes``
+      the estimated packet and octet counts of the prefixes with the most
+      packets
+    ``marks``
+      the counts of the values set by the chains, by field
+
+    The counts start again in each interval.
+
+    :param interval: The length of each interval in seconds
+    :type interval: float
+    :param prefix4: The length of the prefixes IPv4 addresses are counted
+                    for
+    :type prefix4: int
+    :param prefix6: The length of the prefixes IPv6 addresses are counted
+                    for
+    :type prefix6: int
+    :param top: The number of prefixes with the most packets reported
+    :type top: int
+    :param width: The width of the count-min sketches
+    :type width: int
+    :param depth: The depth of the count-min sketches
+    :type depth: int
+    :param precision: The precision of the HyperLogLog sketch
+    :type precision: int
+    :param bins: The maximum number of distinct values counted for each field
+    :type bins: int
+    :param flows: The maximum number of flows whose direction is remembered
+    :type flows: int
+    """
+
+    def __init__(self, interval=60, prefix4=24, prefix6=48, top=16,
+                 width=2048, depth=4, precision=12, bins=256, flows=65536):
+        if interval <= 0:
+            raise ValueError("Aggregate interval must be positive")
+        self.interval = interval
+        self._prefix4 = prefix4
+        self._prefix6 = prefix6
+        self._top = top
+        self._bins = bins
+        self._flows_size = flows
+
+        self._packets = CountMinSketch(width, depth)
+        self._octets = CountMinSketch(width, depth)
+        self._distinct = HyperLogLog(precision)
+        self._heavy = {}
+        self._heavy_floor = 0
+        self._marks = {}
+        self._fields = None
+        self._directions = collections.OrderedDict()
+
+        self._end = None
+        self._pkt_first = None
+        self._pkt_last = None
+        self._ct_pkt = 0
+        self._ct_oct = 0
+
+    def set_fields(self, fields):
+        """
+        Set the fields of the records filled in by the chains.
+
+        :param fields: the fields, as returned by
+                       :func:`pathspider.observer.flow_fields`
+        :type fields: list(pathspider.chains.base.Field)
+        """
+
+        skip = {field.name for field in BasicChain.fields}
+        skip.update(("pkt_first", "pkt_last"))
+        self._fields = [(field.name, field.default) for field in fields
+                        if field.name not in skip and
+                        field.type in (bool, int)]
+        self._marks = {name: Histogram(self._bins)
+                       for (name, _) in self._fields}
+
+    def reverse(self, fid, direction):
+        """
+        Get the direction of a packet relative to the first packet of its
+        flow.
+
+        :param fid: the flow key
+        :type fid: bytes
+        :param direction: the direction of the packet relative to the flow
+                          key
+        :type direction: int
+        :returns: True if the packet is in the reverse direction
+        :rtype: bool
+        """
+
+        directions = self._directions
+        first = directions.get(fid)
+        if first is None:
+            directions[fid] = first = direction
+            if len(directions) > self._flows_size:
+                directions.popitem(last=False)
+        else:
+            directions.move_to_end(fid)
+        return direction != first
+
+    def due(self, pt):
+        """
+        Check whether the current interval has ended.
+
+        :param pt: the packet time
+        :type pt: float
+        :rtype: bool
+        """
+
+        return self._end is not None and pt >= self._end
+
+    def add(self, fid, ip, rec):
+        """
+        Add a packet to the statistics of the current interval.
+
+        :param fid: the flow key of the packet
+        :type fid: bytes
+        :param ip: the IPv4 or IPv6 header of the packet
+        :param rec: the record filled in for the packet by the chains
+        """
+
+        pt = ip.seconds
+        if self._end is None:
+            self._end = (math.floor(pt / self.interval) + 1) * self.interval
+            self._pkt_first = pt
+        self._pkt_last = pt
+        size = ip.size
+        self._ct_pkt += 1
+        self._ct_oct += size
+        self._distinct.add(fid)
+
+        hdr = ip.data
+        if ip.version == 4:
+            (src, dst) = (b"\x04" + _prefix(hdr[12:16], self._prefix4),
+                          b"\x04" + _prefix(hdr[16:20], self._prefix4))
+        else:
+            (src, dst) = (b"\x06" + _prefix(hdr[8:24], self._prefix6),
+                          b"\x06" + _prefix(hdr[24:40], self._prefix6))
+        self._count_prefix(src, size)
+        if dst != src:
+            self._count_prefix(dst, size)
+
+        for (name, default) in self._fields:
+            value = rec[name]
+            if value != default:
+                self._marks[name].add(value)
+
+    def _count_prefix(self, prefix, size):
+        self._packets.add(prefix)
+        self._octets.add(prefix, size)
+        estimate = self._packets.estimate(prefix)
+
+        # the prefixes with the most packets so far are kept as candidates
+        # for the summary
+        heavy = self._heavy
+        if prefix in heavy or len(heavy) < self._top:
+            heavy[prefix] = estimate
+        elif estimate > self._heavy_floor:
+            lightest = min(heavy, key=heavy.get)
+            if estimate > heavy[lightest]:
+                del heavy[lightest]
+                heavy[prefix] = estimate
+            self._heavy_floor = min(heavy.values())
+
+    def _prefix_name(self, prefix):
+        if prefix[0] == 4:
+            (size, length) = (4, self._prefix4)
+        else:
+            (size, length) = (16, self._prefix6)
+        addr = prefix[1:].ljust(size, b"\x00")
+        return str(ipaddress.ip_network((addr, length)))
+
+    def __len__(self):
+        """
+        The number of packets in the current interval.
+        """
+
+        return self._ct_pkt
+
+    def summary(self):
+        """
+        Produce the summary of the current interval, and start the next.
+
+        :rtype: dict
+        """
+
+        prefixes = sorted(((self._packets.estimate(prefix),
+                            self._octets.estimate(prefix), prefix)
+                           for prefix in self._heavy), reverse=True)
+        summary = {
+            'pkt_first': self._pkt_first,
+            'pkt_last': self._pkt_last,
+            'packets': self._ct_pkt,
+            'octets': self._ct_oct,
+            'flows': self._distinct.count(),
+            'prefixes': [{'prefix': self._prefix_name(prefix),
+                          'packets': packets, 'octets': octets}
+                         for (packets, octets, prefix) in prefixes],
+            'marks': {name: histogram.to_dict()
+                      for (name, histogram) in self._marks.items()
+                      if histogram or histogram.other},
+        }
+
+        self._packets.clear()
+        self._octets.clear()
+        self._distinct.clear()
+        self._heavy.clear()
+        self._heavy_floor = 0
+        for histogram in self._marks.values():
+            histogram.clear()
+        self._end = None
+        self._pkt_first = None
+        self._pkt_last = None
+        self._ct_pkt = 0
+        self._ct_oct = 0
+        return summary
@@ -8,6 +8,7 @@ the sender.
 
 """
 
+import os
 import sys
 import time
 import logging
@@ -38,6 +39,12 @@ PORT_FAILED_AGAIN = -1
 QUEUE_SIZE = 1000
 QUEUE_SLEEP = 0.5
 
+# Weight of each new batch in the merger's mean flow batch size
+BATCH_MEAN_WEIGHT = 0.1
+
+# Seconds to keep a target in the observer's address filter after connecting
+ADDRESS_FILTER_HOLD = 60
+
 SHUTDOWN_SENTINEL = "SHUTDOWN_SENTINEL"
 NO_FLOW = None
 
@@ -61,8 +68,12 @@ class Spider:
         :param worker_count: The number of workers to use.
         :type worker_count: int
         :param libtrace_uri: The URI to pass to the Observer to describe the
-                             interface on which packets should be captured.
-        :type libtrace_uri: str
+                             interface on which packets should be captured,
+                             or a list of URIs, one for each uplink of a
+                             multi-homed host. Jobs are then spread over the
+                             uplinks, and the Observer captures on all of
+                             them at once.
+        :type libtrace_uri: str or list(str)
         :param server_mode: Whether the spider should operate in server mode
         :type server_mode: bool
 
@@ -84,7 +95,41 @@ class Spider:
         self.worker_count = worker_count
         self.args = args
         self.libtrace_uri = libtrace_uri
+        self.uplinks = [uri.partition(':')[2] for uri in (
+            [libtrace_uri] if isinstance(libtrace_uri, str) else libtrace_uri)]
+        self.uplink_next = 0
+        self._uplink = threading.local()
         self.server_mode = server_mode
+        self.observer_shards = getattr(args, 'observer_shards', None) or 1
+        self.observer_filter = getattr(args, 'observer_filter', False)
+        self.observer_flush_interval = getattr(
+            args, 'observer_flush_interval', None) or 1
+        self.observer_stats = getattr(args, 'observer_stats', None)
+        self.observer_idle_tick = getattr(
+            args, 'observer_idle_tick', None) or None
+        self.observer_early = getattr(args, 'observer_early', False)
+        self.observer_remote = getattr(args, 'observer_remote', None)
+        self.observer_remote_token = getattr(
+            args, 'observer_remote_token', None)
+        self.observer_overload_lag = getattr(
+            args, 'observer_overload_lag', None)
+        self.observer_overload_backlog = getattr(
+            args, 'observer_overload_backlog', None)
+        self.observer_overload_sample = getattr(
+            args, 'observer_overload_sample', None) or 0
+        self.observer_overload = (self.observer_overload_lag is not None or
+                                  self.observer_overload_backlog is not None)
+        self.observer_pcap = getattr(args, 'observer_pcap', None)
+        self.observer_pcap_match = getattr(args, 'observer_pcap_match', None)
+        self.observer_pcap_packets = getattr(
+            args, 'observer_pcap_packets', None) or 32
+        self.observer_pcap_memory = getattr(
+            args, 'observer_pcap_memory', None) or 64
+        self.observer_pcap_size = getattr(args, 'observer_pcap_size', None)
+        self.observer_pcap_files = getattr(
+            args, 'observer_pcap_files', None) or 1
+        self.address_filter = None
+        self.address_filter_releases = collections.deque()
 
         self.__initialize_queues()
         self.__set_interface_addresses()
@@ -105,19 +150,43 @@ class Spider:
         self.restab = {}
         self.flowtab = {}
         self.flowreap = collections.deque()
+        # mean number of flows in a batch from the flow queue
+        self.flow_batch_mean = 1.0
+        self.early_queues = []
+        self.early_merged = {}
+        self.early_reap = collections.deque()
         self.flowreap_size = min(self.worker_count * 100, 10000)
         self.outqueue = queue.Queue(QUEUE_SIZE)
 
     def __set_interface_addresses(self):
-        if self.libtrace_uri.startswith('int'):
-            self.source = (ipv4_address(self.libtrace_uri[4:]),
-                           ipv6_address(self.libtrace_uri[4:]))
-            self.source_public = (ipv4_address_public(self.libtrace_uri[4:]),
-                                  ipv6_address_public(self.libtrace_uri[4:]))
-            self.source_asn = (ipv4_asn(self.libtrace_uri[4:]),
-                               ipv6_asn(self.libtrace_uri[4:]))
-        else:
-            self.source = ("127.0.0.1", "::1")
+        uris = ([self.libtrace_uri] if isinstance(self.libtrace_uri, str)
+                else self.libtrace_uri)
+        self.uplink_sources = []
+        for uri in uris:
+            if uri.startswith(('int:', 'ring:')):
+                interface = uri.partition(':')[2]
+                self.uplink_sources.append((
+                    (ipv4_address(interface), ipv6_address(interface)),
+                    (ipv4_address_public(interface),
+                     ipv6_address_public(interface)),
+                    (ipv4_asn(interface), ipv6_asn(interface))))
+            else:
+                self.uplink_sources.append((("127.0.0.1", "::1"), None, None))
+        (_, self.source_public, self.source_asn) = self.uplink_sources[0]
+
+    @property
+    def source(self):
+        """
+        The IPv4 and IPv6 addresses that connections are made from. With
+        several uplinks, these are the addresses of the uplink of the job
+        that the calling worker is connecting for.
+        """
+
+        return self.uplink_sources[getattr(self._uplink, 'index', 0)][0]
+
+    @source.setter
+    def source(self, source):
+        self.uplink_sources[0] = (source,) + self.uplink_sources[0][1:]
 
     def _get_test_count(self):
         if hasattr(self, 'packets'):
@@ -135,6 +204,11 @@ class Spider:
 
     def _connect_wrapper(self, job, config, connect=None):
         start = str(datetime.utcnow())
+        if len(self.uplinks) > 1:
+            # connect from the uplink the job was assigned to
+            self._uplink.index = self.uplinks.index(
+                job.get('interface', self.uplinks[0]))
+        address = self._filter_address(job)
         if connect is None:
             conn = self.connect(job, config) # pylint: disable=no-member
         else:
@@ -142,22 +216,113 @@ class Spider:
                 connect = connect.__get__(self)
             conn = connect(job, config)
         conn['spdr_start'] = start
+        if address is not None:
+            self.address_filter_releases.append(
+                (time.monotonic() + ADDRESS_FILTER_HOLD, address))
         return conn
 
-    def create_observer(self):
+    def _filter_address(self, job):
+        """
+        Add the target of a job to the observer's address filter, if it is
+        being used, before connecting to it.
+
+        :returns: the address added to the filter, or None
+        """
+
+        if self.address_filter is None:
+            return None
+        address = job.get('sip' if self.server_mode else 'dip')
+        try:
+            self.address_filter.add(address)
+        except ValueError:
+            self.__logger.warning("Job target %r is not an IP address, flows "
+                                  "for this job will not be observed",
+                                  address)
+            return None
+        return address
+
+    def _release_filter_addresses(self):
+        """
+        Remove targets from the observer's address filter once they have been
+        held for long enough that the observer has created records for the
+        flows to them.
+        """
+
+        now = time.monotonic()
+        releases = self.address_filter_releases
+        while releases and releases[0][0] <= now:
+            self.address_filter.discard(releases.popleft()[1])
+
+    def create_observer(self, shard=0):
         """
         Create a flow observer.
 
         This function is called by the base Spider logic to get an instance
         of :class:`pathspider.observer.Observer` configured with the function
-        chains that are requried by the plugin.
+        chains that are requried by the plugin. When ``observer_remote`` is
+        set, a :class:`pathspider.remote.RemoteObserver` receiving flows from
+        an observer on another host is used instead.
+
+        :param shard: The shard of the flow space the observer will handle,
+                      when running more than one observer
+                      (see ``observer_shards``).
+        :type shard: int
         """
 
         self.__logger.info("Creating observer")
-        if len(self.chains) > 0:
+        if len(self.chains) > 0 and self.observer_remote is not None:
+            # flows are received from an observer on another host, for the
+            # addresses that connections are made from
+            from pathspider.remote import TOKEN_ENV
+            from pathspider.remote import RemoteObserver
+            from pathspider.remote import parse_address
+            addresses = set()
+            for (source, source_public, _) in self.uplink_sources:
+                addresses.update(source)
+                addresses.update(source_public or ())
+            return RemoteObserver(parse_address(self.observer_remote),
+                                  sorted(addresses - {None}),
+                                  token=(self.observer_remote_token or
+                                         os.environ.get(TOKEN_ENV)))
+        elif len(self.chains) > 0:
+            from pathspider.observer import FlowMatch
             from pathspider.observer import Observer
+            pcap_writer = None
+            if self.observer_pcap is not None:
+                # each shard writes its own files
+                from pathspider.traces.pcap import PcapWriter
+                path = self.observer_pcap
+                if self.observer_shards > 1:
+                    (root, ext) = os.path.splitext(path)
+                    path = "{}_{}{}".format(root, shard, ext)
+                pcap_writer = PcapWriter(
+                    path, file_size=(self.observer_pcap_size * 2**20
+                                     if self.observer_pcap_size else None),
+                    file_count=self.observer_pcap_files)
             return Observer(self.libtrace_uri,
-                            chains=self.chains) # pylint: disable=no-member
+                            chains=self.chains, # pylint: disable=no-member
+                            shard=shard,
+                            shard_count=self.observer_shards,
+                            address_filter=(self.address_filter
+                                            if self.observer_filter else None),
+                            flush_interval=self.observer_flush_interval,
+                            stats_interval=self.observer_stats,
+                            overload_lag=self.observer_overload_lag,
+                            overload_backlog=self.observer_overload_backlog,
+                            overload_sample=self.observer_overload_sample,
+                            overload_filter=self.address_filter,
+                            idle_tick=self.observer_idle_tick,
+                            early_queue=(self.early_queues[shard]
+                                         if self.early_queues else None),
+                            early_key=(("sip", "sp") if self.server_mode
+                                       else ("dip", "sp")),
+                            merge=len(self.uplinks) > 1,
+                            pcap_writer=pcap_writer,
+                            pcap_flows=self.address_filter,
+                            pcap_match=(FlowMatch(self.observer_pcap_match)
+                                        if self.observer_pcap_match else None),
+                            pcap_packets=self.observer_pcap_packets,
+                            pcap_memory=self.observer_pcap_memory * 2**20)
         else:
             from pathspider.observer import DummyObserver
             return DummyObserver()
@@ -171,37 +336,102 @@ class Spider:
 
     def _merge_flows(self):
         try:
-            flow = self.flowqueue.get_nowait()
+            batch = self.flowqueue.get_nowait()
         except queue.Empty:
             time.sleep(QUEUE_SLEEP)
             return True
         else:
-            if flow == SHUTDOWN_SENTINEL:
+            if batch == SHUTDOWN_SENTINEL:
+                self.observers_running -= 1
+                if self.observers_running > 0:
+                    self.__logger.debug("observer finished, %d still running",
+                                        self.observers_running)
+                    return True
                 self.__logger.debug("stopping flow merging on sentinel")
                 return False
 
-            flowkey = self._key(flow)
-            self.__logger.debug("got a flow (" + repr(flowkey) + ")")
-
-            if flowkey in self.restab:
-                self.__logger.debug("merging flow")
-                self.merge(flow, self.restab[flowkey])
-                del self.restab[flowkey]
-            elif flowkey in self.flowtab:
-                self.__logger.debug("won't merge duplicate flow")
-            else:
-                # Create a new flow
-                self.flowtab[flowkey] = flow
-
-                # And reap the oldest, if the reap queue is full
-                self.flowreap.append(flowkey)
-                if len(self.flowreap) > self.flowreap_size:
-                    try:
-                        del self.flowtab[self.flowreap.popleft()]
-                    except KeyError:
-                        pass
+            self.flow_batch_mean += (len(batch) -
+                                     self.flow_batch_mean) * BATCH_MEAN_WEIGHT
+            for flow in batch:
+                self._merge_flow(flow)
             return True
 
+    def _merge_flow(self, flow):
+        flowkey = self._key(flow)
+        self.__logger.debug("got a flow (" + repr(flowkey) + ")")
+
+        early = flow.pop('observer_early', False)
+        if flow.get('observer_update', False):
+            self._merge_flow_update(flowkey, flow)
+        elif flowkey in self.restab:
+            self.__logger.debug("merging flow")
+            if early:
+                self._remember_early(flowkey, flow)
+            self.merge(flow, self.restab[flowkey])
+            del self.restab[flowkey]
+        elif flowkey in self.flowtab:
+            self.__logger.debug("won't merge duplicate flow")
+        else:
+            # Create a new flow
+            self.flowtab[flowkey] = flow
+            if early:
+                self._remember_early(flowkey, flow)
+
+            # And reap the oldest, if the reap queue is full
+            self.flowreap.append(flowkey)
+            if len(self.flowreap) > self.flowreap_size:
+                try:
+                    del self.flowtab[self.flowreap.popleft()]
+                except KeyError:
+                    pass
+
+    def _remember_early(self, flowkey, flow):
+        """
+        Remember a flow that the observer passed on early, in case it sees
+        more packets for the flow and passes on an update.
+        """
+
+        self.early_merged[flowkey] = flow
+        self.early_reap.append(flowkey)
+        if len(self.early_reap) > self.flowreap_size:
+            self.early_merged.pop(self.early_reap.popleft(), None)
+
+    def _merge_flow_update(self, flowkey, update):
+        """
+        Fold an update from the observer, for a flow that was passed on
+        early and then saw more packets, into the flow if it is still
+        waiting for its result, or into the merged flow if the job is not
+        yet complete.
+        """
+
+        flow = self.early_merged.pop(flowkey, None)
+        if flow is None or (
+                self.flowtab.get(flowkey) is not flow and (
+                    flow.get('jobId') not in self.comparetab or
+                    not any(f is flow
+                            for f in self.comparetab[flow['jobId']]))):
+            self.__logger.debug("dropping late update for flow (" +
+                                repr(flowkey) + ")")
+            return
+        self.__logger.debug("updating merged flow")
+        for key in update:
+            if not key.startswith("_") and key != 'observer_update':
+                flow[key] = update[key]
+
+    def _request_flow(self, reskey):
+        """
+        Ask the observers to pass on the flow for a result as soon as it is
+        complete.
+        """
+
+        if reskey[1] in (PORT_FAILED, PORT_FAILED_AGAIN):
+            return
+        for early_queue in self.early_queues:
+            try:
+                early_queue.put_nowait(reskey)
+            except queue.Full:
+                pass
+
     def _merge_results(self):
         try:
             res = self.resqueue.get_nowait()
@@ -232,6 +462,8 @@ class Spider:
                 self.__logger.debug("won't merge duplicate result")
             else:
                 self.restab[reskey] = res
+                if self.early_queues:
+                    self._request_flow(reskey)
 
             self.resqueue.task_done()
             return True
@@ -262,7 +494,15 @@ class Spider:
 
             while self.running and (merging_results or merging_flows):
 
-                if merging_flows and self.flowqueue.qsize() >= self.resqueue.qsize():
+                if self.address_filter is not None:
+                    self._release_filter_addresses()
+
+                # flows are queued in batches and results one at a time, so
+                # compare the number of flows waiting (estimated from the
+                # mean batch size) with the number of results waiting
+                if merging_flows and (self.flowqueue.qsize() *
+                                      self.flow_batch_mean >=
+                                      self.resqueue.qsize()):
                     merging_flows = self._merge_flows()
 
                 elif merging_results:
@@ -296,7 +536,8 @@ class Spider:
         if flow == NO_FLOW:
             flow = {'observed': False}
         else:
-            flow['observed'] = True
+            # flows shed by an overloaded observer were not observed
+            flow['observed'] = not flow.get('observer_shed', False)
 
         for key in res.keys():
             if key in flow.keys():
@@ -329,11 +570,25 @@ class Spider:
             job['flow_results'] = flows
             job['time'] = {'from': start, 'to': stop}
             job['missed_flows'] = 0
+            shed_flows = 0
+            overloaded = False
             for flow in flows:
                 if not flow['observed']:
                     job['missed_flows'] = job['missed_flows'] + 1
+                if flow.get('observer_shed', False):
+                    shed_flows += 1
+                if flow.get('observer_overload', False):
+                    overloaded = True
             job['conditions'] = self.combine_flows(flows)
             if job['conditions'] is not None:
+                if shed_flows > 0 or overloaded:
+                    if shed_flows == job['missed_flows']:
+                        # the flows were only missed because the observer
+                        # was overloaded
+                        job['conditions'] = [
+                            c for c in job['conditions']
+                            if c != "pathspider.not_observed"]
+                    job['conditions'].append("pathspider.observer_overload")
                 if "pathspider.not_observed" in job['conditions']:
                     self.__logger.debug("At least one flow was not observed and so conditions could not be fully generated (if at all)")
                 if job['missed_flows'] > 0:
@@ -395,17 +650,41 @@ class Spider:
             
             self.stopping = False
 
-            # create an observer and start its process
-            self.observer = self.create_observer()
-            self.observer_process = mp.Process(
-                args=(self.observer.run_flow_enqueuer,
-                      self.flowqueue,
-                      self.observer_shutdown_queue),
-                target=self.exception_wrapper,
-                name='observer',
-                daemon=True)
-            self.observer_process.start()
-            self.__logger.debug("observer forked")
+            # create the observers and start their processes, each shard
+            # handles a disjoint part of the flow space
+            shard_count = (self.observer_shards if len(self.chains) > 0 and
+                           self.observer_remote is None else 1)
+            if (len(self.chains) > 0 and self.observer_remote is None and
+                    (self.observer_filter or self.observer_overload or
+                     self.observer_pcap is not None)):
+                # the job targets are also used to choose the flows that are
+                # not shed when an observer is overloaded, and the flows
+                # whose packets are written
+                from pathspider.observer import AddressFilter
+                self.address_filter = AddressFilter()
+            if (len(self.chains) > 0 and self.observer_early and
+                    self.observer_remote is None):
+                self.early_queues = [mp.Queue(QUEUE_SIZE)
+                                     for _ in range(shard_count)]
+            self.observers = []
+            self.observer_processes = []
+            for shard in range(shard_count):
+                observer = self.create_observer(shard)
+                observer_process = mp.Process(
+                    args=(observer.run_flow_enqueuer,
+                          self.flowqueue,
+                          self.observer_shutdown_queue),
+                    target=self.exception_wrapper,
+                    name='observer' if shard_count == 1 else
+                    'observer_{}'.format(shard),
+                    daemon=True)
+                observer_process.start()
+                self.observers.append(observer)
+                self.observer_processes.append(observer_process)
+            self.observers_running = shard_count
+            self.observer = self.observers[0]
+            self.observer_process = self.observer_processes[0]
+            self.__logger.debug("%d observer(s) forked", shard_count)
 
             # now start up ecnspider, backwards
             self.merger_thread = threading.Thread(
@@ -461,9 +740,11 @@ class Spider:
                     worker.join()
             self.__logger.debug("all workers joined")
 
-            # Tell observer to shut down
-            self.observer_shutdown_queue.put(True)
-            self.observer_process.join()
+            # Tell observers to shut down
+            for _ in self.observer_processes:
+                self.observer_shutdown_queue.put(True)
+            for observer_process in self.observer_processes:
+                observer_process.join()
             self.__logger.debug("observer shutdown")
 
             # Tell merger to shut down
@@ -501,8 +782,9 @@ class Spider:
         self.stopping = True
         self.running = False
 
-        # terminate observer
-        self.observer_shutdown_queue.put(True)
+        # terminate observers
+        for _ in self.observer_processes:
+            self.observer_shutdown_queue.put(True)
 
         # drain queues
         try:
@@ -539,7 +821,8 @@ class Spider:
             self.merger_thread.join()
             self.__logger.debug("merger joined")
 
-        self.observer_process.join()
+        for observer_process in self.observer_processes:
+            observer_process.join()
         self.__logger.debug("observer joined")
 
         self.outqueue.put(SHUTDOWN_SENTINEL)
@@ -554,6 +837,9 @@ class Spider:
 
         If PATHspider is currently stopping, the job will not be added to the
         queue.
+
+        With several uplinks, jobs are assigned to the uplinks in turn, and
+        the uplink is recorded in the ``interface`` field of the job.
         """
 
         if self.stopping:
@@ -561,14 +847,20 @@ class Spider:
 
         if not self.server_mode:
             if 'dip' in job.keys():
+                (source, source_public,
+                 source_asn) = self.uplink_sources[self.uplink_next]
+                if len(self.uplinks) > 1:
+                    job['interface'] = self.uplinks[self.uplink_next]
+                    self.uplink_next = ((self.uplink_next + 1) %
+                                        len(self.uplinks))
                 sourceindex = 1 if ':' in job['dip'] else 0
-                job['sip'] = self.source[sourceindex]
+                job['sip'] = source[sourceindex]
                 job['path'] = [job['sip']]
-                job['sip_public'] = self.source_public[sourceindex]
+                job['sip_public'] = source_public[sourceindex]
                 if not ( job['sip'] == job['sip_public'] ):
                     job['path'].append(job['sip_public'])
-                if self.source_asn[sourceindex] is not None:
-                    job['sip_asn'] = self.source_asn[sourceindex]
+                if source_asn[sourceindex] is not None:
+                    job['sip_asn'] = source_asn[sourceindex]
                     job['path'].append("AS" + str(job['sip_asn']))
                 if 'dip_asn' in job.keys(): # This may be generated by other tools
                     job['path'].append("AS" + job['dip_asn'])
@@ -9,26 +9,100 @@ implementations of flow analysis chains for PATHspider's Observer.
 
 """
 
+import collections
+
+#: A field in the flow record used by a chain. The ``default`` value is set
+#: for every new flow and should be immutable (e.g. ``None``, ``False`` or
+#: ``0``), as it is not copied.
+Field = collections.namedtuple("Field", ("name", "type", "default"))
+
+class _Retire:
+    __slots__ = ()
+
+    def __repr__(self):
+        return "RETIRE"
+
+#: Returned by a chain function in place of True when the chain has learned
+#: all it can from a flow. The flow continues to be observed, but none of the
+#: chain's functions are called for the rest of the flow's packets.
+RETIRE = _Retire()
+
 class Chain:
     """
     This is an abstract flow analysis chain. It is intended that all flow
     analysis chains will subclass this class and it is not intended for this
     class to be directly used by PATHspider plugins.
+
+    Chains should declare the fields they use in the flow record in
+    :attr:`fields`. The Observer builds compact slot-backed flow records from
+    these declarations, initialising each field to its default value. Fields
+    that are not declared can still be used, but are stored less compactly.
+
+    Facts derived from the current packet that are needed by more than one
+    chain, such as the TCP flags, the ECN codepoint or the parsed TCP
+    options, should be taken from :attr:`ctx` so that they are only decoded
+    once for each packet.
+
+    Chains that only apply to some flows should declare the
+    :attr:`protocols` and :attr:`ports` of those flows, and chains that only
+    look at packets in one direction should declare the :attr:`direction`.
+    The Observer then leaves the chain out of the dispatch for other flows
+    and packets when the flow is created, so that none of its functions,
+    including :meth:`new_flow`, are called for flows it does not apply to.
+    Its fields are still in the flow records of every flow, with their
+    default values.
+
+    A chain that has nothing more to learn from a flow, such as a chain that
+    only looks at the TCP handshake, should return :data:`RETIRE` from a
+    chain function rather than True. The Observer then stops calling the
+    chain's functions for that flow, while the other chains continue to see
+    its packets.
     """
 
-    def new_flow(self, rec, ip):
+    #: The fields this chain uses in the flow record, as a tuple of
+    #: :class:`Field`
+    fields = ()
+
+    #: The IP protocol numbers of the flows this chain applies to, as a
+    #: :class:`frozenset`, or None if it applies to flows of any protocol
+    protocols = None
+
+    #: The ports of the flows this chain applies to, as a :class:`frozenset`,
+    #: or None if it applies to flows on any port. A flow is on a port if
+    #: either of its endpoints uses it. Flows of protocols without ports are
+    #: not on any port.
+    ports = None
+
+    #: The direction of the packets this chain is passed, ``"fwd"`` or
+    #: ``"rev"``, or None if it is passed packets in both directions
+    direction = None
+
+    #: The :class:`pathspider.chains.context.PacketContext` for the packet
+    #: being observed, set by the Observer before any chain function is
+    #: called
+    ctx = None
+
+    def new_flow(self, rec, ip): # pylint: disable=unused-argument,no-self-use
         """
         This function is called for every new flow to initialise a flow record
-        with the fields that will be used by this chain. It is recommended to
-        initialise all fields to None until other functions have set values for
-        them to make clear which fields are set by this chain and to avoid key
-        errors later.
+        with any fields that will be used by this chain that cannot be given a
+        constant default value in :attr:`fields`, and to decide whether the
+        flow should be kept. Declared fields have already been initialised to
+        their default values when this function is called. It is recommended
+        to initialise any undeclared fields to None until other functions have
+        set values for them to make clear which fields are set by this chain
+        and to avoid key errors later.
+
+        Chains that only need their declared fields initialised do not need
+        to override this function.
 
         :param rec: the flow record
-        :type rec: dict
+        :type rec: pathspider.records.FlowRecord
         :param ip: the IP or IPv6 packet that triggered the creation of a new
                    flow record
         :type ip: plt.ip or plt.ip6
+        :return: True if flow should be kept, False if flow should be discarded
+        :rtype: bool
         """
 
-        raise NotImplementedError("Cannot create a new flow with an abstract Observer chain")
+        return True
@@ -9,6 +9,7 @@ packet/octet counts.
 """
 
 from pathspider.chains.base import Chain
+from pathspider.chains.base import Field
 
 class BasicChain(Chain):
     """
@@ -37,6 +38,18 @@ class BasicChain(Chain):
     +------------+------+-----------------------------------------------------+
     """
 
+    fields = (
+        Field("sip", str, None),
+        Field("dip", str, None),
+        Field("proto", int, None),
+        Field("sp", int, None),
+        Field("dp", int, None),
+        Field("pkt_fwd", int, 0),
+        Field("pkt_rev", int, 0),
+        Field("oct_fwd", int, 0),
+        Field("oct_rev", int, 0),
+    )
+
     def _extract_ports(self, ip):
         if ip.udp:
             return (ip.udp.src_port, ip.udp.dst_port)
@@ -54,12 +67,6 @@ class BasicChain(Chain):
         (rec['sip'], rec['dip'], rec['proto']) = (str(ip.src_prefix), str(ip.dst_prefix), ip.proto)
         (rec['sp'], rec['dp']) = self._extract_ports(ip)
 
-        # Initialize counters
-        rec['pkt_fwd'] = 0
-        rec['pkt_rev'] = 0
-        rec['oct_fwd'] = 0
-        rec['oct_rev'] = 0
-
         # we want to keep this flow
         return True
 
@@ -0,0 +1,133 @@
+"""
+.. module:: pathspider.chains.context
+   :synopsis: Per-packet decode cache shared by flow analysis chains
+
+This module contains the PacketContext class used by PATHspider's Observer to
+share facts derived from the current packet between the flow analysis chains.
+Each fact is decoded the first time a chain asks for it and remembered until
+the Observer moves on to the next packet, so that it is computed at most once
+per packet whichever chains are in use.
+
+.. codeauthor:: Iain R. Learmonth <irl@fsfe.org>
+
+"""
+
+from pathspider.chains.tcp import tcp_options
+from pathspider.chains.tcp import TCP_ACK
+from pathspider.chains.tcp import TCP_SYN
+
+
+class _memoized: # pylint: disable=invalid-name,too-few-public-methods
+    """
+    A read-only attribute that is computed on first use and then stored in
+    the instance dictionary, where it is found directly by later lookups
+    until the dictionary is cleared.
+    """
+
+    def __init__(self, fn):
+        self._fn = fn
+        self._name = fn.__name__
+        self.__doc__ = fn.__doc__
+
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self
+        value = obj.__dict__[self._name] = self._fn(obj)
+        return value
+
+
+class PacketContext:
+    """
+    Lazily decoded facts about the packet currently being observed.
+
+    The Observer creates a single context for its packet and makes it
+    available to each of its chains as :attr:`pathspider.chains.base.Chain.ctx`.
+    It is reset before each packet is dispatched, so chain functions can use
+    it in place of decoding the same headers and values from the packet that
+    they were passed.
+
+    Values returned by the context are shared between chains and must not be
+    modified.
+    """
+
+    __slots__ = ("_pkt", "__dict__")
+
+    def __init__(self, pkt):
+        """
+        :param pkt: the packet object that is filled in for each packet read
+                    by the Observer
+        :type pkt: plt.packet
+        """
+
+        self._pkt = pkt
+
+    def reset(self):
+        """
+        Forget everything decoded from the previous packet.
+        """
+
+        self.__dict__.clear()
+
+    @_memoized
+    def ip(self):
+        """The IPv4 or IPv6 header of the packet, or ``None``"""
+        return self._pkt.ip or self._pkt.ip6
+
+    @_memoized
+    def tcp(self):
+        """The TCP header of the packet, or ``None``"""
+        return self._pkt.tcp
+
+    @_memoized
+    def tcp_flags(self):
+        """The TCP flags of the packet, or ``None`` if it is not TCP"""
+        tcp = self.tcp
+        return tcp.flags if tcp else None
+
+    @_memoized
+    def syn(self):
+        """``True`` if the packet is a TCP segment with the SYN flag set"""
+        tcp = self.tcp
+        return bool(tcp) and tcp.flags & TCP_SYN == TCP_SYN
+
+    @_memoized
+    def ack(self):
+        """``True`` if the packet is a TCP segment with the ACK flag set"""
+        tcp = self.tcp
+        return bool(tcp) and tcp.flags & TCP_ACK == TCP_ACK
+
+    @_memoized
+    def payload_len(self):
+        """
+        The length of the TCP payload according to the IP header, or
+        ``None`` if the packet is not TCP
+        """
+        tcp = self.tcp
+        if not tcp:
+            return None
+        ip = self.ip
+        if ip.version == 4:
+            return ip.pkt_len - (ip.hdr_len + tcp.doff) * 4
+        return ip.payload_len - tcp.doff * 4
+
+    @_memoized
+    def ecn(self):
+        """The ECN codepoint from the IP header, or ``None``"""
+        ip = self.ip
+        return ip.traffic_class & 0x03 if ip else None
+
+    @_memoized
+    def dscp(self):
+        """The DSCP value from the IP header, or ``None``"""
+        ip = self.ip
+        return ip.traffic_class >> 2 if ip else None
+
+    @_memoized
+    def tcp_options(self):
+        """
+        The TCP options of the packet as parsed by
+        :func:`pathspider.chains.tcp.tcp_options`, or ``None`` if it is not
+        TCP
+        """
+        tcp = self.tcp
+        return tcp_options(tcp) if tcp else None
@@ -10,6 +10,7 @@ PATHspider's Observer for recording Domain Name System [RFC1035]_ details.
 """
 
 from pathspider.chains.base import Chain
+from pathspider.chains.base import Field
 
 class DNSChain(Chain):
     """
@@ -23,22 +24,14 @@ class DNSChain(Chain):
     +------------------------+------+-----------------------------------------+
     """
 
-    def new_flow(self, rec, ip):
-        """
-        For a new flow, all fields will be initialised to ``False``.
-
-        :param rec: the flow record
-        :type rec: dict
-        :param ip: the IP or IPv6 packet that triggered the creation of a new
-                   flow record
-        :type ip: plt.ip or plt.ip6
-        :return: Always ``True``
-        :rtype: bool
-        """
-
-        rec['dns_response_valid'] = False
+    fields = (
+        Field("dns_response_valid", bool, False),
+    )
 
-        return True
+    # responses from DNS servers over TCP or UDP only. servers are not only
+    # on port 53, as the plugins query servers on the port given by each job.
+    protocols = frozenset((6, 17))
+    direction = "rev"
 
     def tcp(self, rec, tcp, rev):
         """
@@ -10,7 +10,7 @@ PATHspider's Observer for recording Differentiated Services [RFC2474]_ details.
 """
 
 from pathspider.chains.base import Chain
-from pathspider.chains.tcp import TCP_SYN
+from pathspider.chains.base import Field
 
 class DSCPChain(Chain):
     """
@@ -38,24 +38,12 @@ class DSCPChain(Chain):
     +-----------------------+------+------------------------------------------------+
     """
 
-    def new_flow(self, rec, ip):
-        """
-        For a new flow, all fields will be initialised to ``None``.
-
-        :param rec: the flow record
-        :type rec: dict
-        :param ip: the IP or IPv6 packet that triggered the creation of a new
-                   flow record
-        :type ip: plt.ip or plt.ip6
-        :return: Always ``True``
-        :rtype: bool
-        """
-
-        rec['dscp_mark_syn_fwd'] = None
-        rec['dscp_mark_syn_rev'] = None
-        rec['dscp_mark_data_fwd'] = None
-        rec['dscp_mark_data_rev'] = None
-        return True
+    fields = (
+        Field("dscp_mark_syn_fwd", int, None),
+        Field("dscp_mark_syn_rev", int, None),
+        Field("dscp_mark_data_fwd", int, None),
+        Field("dscp_mark_data_rev", int, None),
+    )
 
     def ip4(self, rec, ip, rev):
         """
@@ -102,20 +90,16 @@ class DSCPChain(Chain):
         return self._dscp_extract(rec, ip, rev)
 
     def _dscp_extract(self, rec, ip, rev):
-        tos = ip.traffic_class
-        dscp = tos >> 2
-    
-        if ip.tcp:
-            if ip.tcp.flags & TCP_SYN == TCP_SYN:
+        ctx = self.ctx
+        dscp = ctx.dscp
+
+        if ctx.tcp:
+            if ctx.syn:
                 rec['dscp_mark_syn_rev' if rev else 'dscp_mark_syn_fwd'] = dscp
                 return True
-            if ip.version == 4:
-                if ip.pkt_len == (ip.hdr_len + ip.tcp.doff) * 4: # No payload
-                   return True
-            elif ip.version == 6:
-                if ip.payload_len == ip.tcp.doff * 4: # No payload
-                   return True
-    
+            if ctx.payload_len == 0: # No payload
+                return True
+
         # If not TCP or TCP non-SYN
         data_key = 'dscp_mark_data_rev' if rev else 'dscp_mark_data_fwd'
         rec[data_key] = rec[data_key] or dscp
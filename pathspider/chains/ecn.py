@@ -11,7 +11,7 @@ details.
 """
 
 from pathspider.chains.base import Chain
-from pathspider.chains.tcp import TCP_SYN
+from pathspider.chains.base import Field
 
 class ECNChain(Chain):
     """
@@ -58,25 +58,12 @@ class ECNChain(Chain):
     +-------------------+------+----------------------------------------------------+
     """
 
-    def new_flow(self, rec, ip): # pylint: disable=unused-argument
-        """
-        For a new flow, all fields will be initialised to ``False``.
-
-        :param rec: the flow record
-        :type rec: dict
-        :param ip: the IP or IPv6 packet that triggered the creation of a new
-                   flow record
-        :type ip: plt.ip or plt.ip6
-        :return: Always ``True``
-        :rtype: bool
-        """
-
-        for d in ['fwd', 'rev']:
-            for t in ['syn', 'data']:
-                for f in ['ect0', 'ect1', 'ce']:
-                    rec['ecn_{}_{}_{}'.format(f, t, d)] = False
-
-        return True
+    fields = tuple(
+        Field("ecn_{}_{}_{}".format(f, t, d), bool, False)
+        for d in ['fwd', 'rev']
+        for t in ['syn', 'data']
+        for f in ['ect0', 'ect1', 'ce']
+    )
 
     def ip4(self, rec, ip, rev):
         """
@@ -126,16 +113,17 @@ class ECNChain(Chain):
         ECT_CE = 0x03
 
         ipmark = None
+        ecn = self.ctx.ecn
 
-        if ip.traffic_class & ECT_CE == ECT_ZERO:
+        if ecn == ECT_ZERO:
             ipmark = 'ecn_ect0'
-        if ip.traffic_class & ECT_CE == ECT_ONE:
+        elif ecn == ECT_ONE:
             ipmark = 'ecn_ect1'
-        if ip.traffic_class & ECT_CE == ECT_CE:
+        elif ecn == ECT_CE:
             ipmark = 'ecn_ce'
 
         if ipmark is not None:
-            if ip.tcp and ip.tcp.flags & TCP_SYN == TCP_SYN:
+            if self.ctx.syn:
                 t = 'syn'
             else:
                 t = 'data'
@@ -7,8 +7,8 @@ PATHspider's Observer for recording Evil Bit connectivity [RFC3514] details.
 
 """
 
-from pathspider.chains.tcp import TCP_SYN
 from pathspider.chains.base import Chain
+from pathspider.chains.base import Field
 
 class EvilChain(Chain):
 
@@ -35,25 +35,13 @@ class EvilChain(Chain):
     +-----------------------+------+------------------------------------------------+
     """
 
-    def new_flow(self, rec, ip):
-        """
-        For a new flow, all fields will be initialised to ``None``.
-
-        :param rec: the flow record
-        :type rec: dict
-        :param ip: the IP or IPv6 packet that triggered the creation of a new
-                   flow record
-        :type ip: plt.ip or plt.ip6
-        :return: Always ``True``
-        :rtype: bool
-        """
+    fields = (
+        Field("evilbit_syn_fwd", bool, None),
+        Field("evilbit_syn_rev", bool, None),
+        Field("evilbit_data_fwd", bool, None),
+        Field("evilbit_data_rev", bool, None),
+    )
 
-        rec['evilbit_syn_fwd'] = None
-        rec['evilbit_syn_rev'] = None
-        rec['evilbit_data_fwd'] = None
-        rec['evilbit_data_rev'] = None
-        return True
-    
     def ip4(self, rec, ip, rev):
         """
         Records evil bit markings from an IPv4 header.
@@ -72,18 +60,15 @@ class EvilChain(Chain):
         :return: Always ``True``
         :rtype: bool
         """
+        ctx = self.ctx
         evil = ip.has_rf
-            
-        if ip.tcp:
-            if ip.tcp.flags & TCP_SYN == TCP_SYN:
+
+        if ctx.tcp:
+            if ctx.syn:
                 rec['evilbit_syn_rev' if rev else 'evilbit_syn_fwd'] = evil
                 return True
-            if ip.version == 4:
-                if ip.pkt_len == (ip.hdr_len + ip.tcp.doff) * 4: # No payload
-                   return True
-            elif ip.version == 6:
-                if ip.payload_len == ip.tcp.doff * 4: # No payload
-                   return True
+            if ctx.payload_len == 0: # No payload
+                return True
 
         # If not TCP or TCP non-SYN
         data_key = 'evilbit_data_rev' if rev else 'evilbit_data_fwd'
@@ -12,6 +12,7 @@ details.
 """
 
 from pathspider.chains.base import Chain
+from pathspider.chains.base import Field
 
 #: ICMPv4 Message Type - Unreachable
 ICMP4_UNREACHABLE = 3
@@ -37,21 +38,9 @@ class ICMPChain(Chain):
     +----------------------+--------+-------------------------------------------------------------+
     """
 
-    def new_flow(self, rec, ip):
-        """
-        For a new flow, all fields will be initialised to ``False``.
-
-        :param rec: the flow record
-        :type rec: dict
-        :param ip: the IP or IPv6 packet that triggered the creation of a new
-                   flow record
-        :type ip: plt.ip or plt.ip6
-        :return: Always ``True``
-        :rtype: bool
-        """
-
-        rec['icmp_unreachable'] = False
-        return True
+    fields = (
+        Field("icmp_unreachable", bool, False),
+    )
 
     def icmp4(self, rec, ip, q, rev): # pylint: disable=no-self-use,unused-argument
         """
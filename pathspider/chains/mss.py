@@ -10,7 +10,9 @@ PATHspider's Observer for recording TCP Maximum Segment Size details.
 """
 
 from pathspider.chains.base import Chain
-from pathspider.chains.tcp import tcp_options
+from pathspider.chains.base import Field
+from pathspider.chains.base import RETIRE
+from pathspider.chains.tcp import syn_seen
 from pathspider.chains.tcp import TO_MSS
 
 class MSSChain(Chain):
@@ -34,25 +36,15 @@ class MSSChain(Chain):
     +------------------+--------+-----------------------------------------------------------------+
     """
 
-    def new_flow(self, rec, ip):
-        """
-        For a new flow, all fields will be initialised to ``None``.
+    fields = (
+        Field("mss_len_fwd", int, None),
+        Field("mss_len_rev", int, None),
+        Field("mss_value_fwd", int, None),
+        Field("mss_value_rev", int, None),
+    )
 
-        :param rec: the flow record
-        :type rec: dict
-        :param ip: the IP or IPv6 packet that triggered the creation of a new
-                   flow record
-        :type ip: plt.ip or plt.ip6
-        :return: Always ``True``
-        :rtype: bool
-        """
-
-        rec['mss_len_fwd'] = None
-        rec['mss_len_rev'] = None
-        rec['mss_value_fwd'] = None
-        rec['mss_value_rev'] = None
-
-        return True
+    # TCP flows only
+    protocols = frozenset((6, ))
 
     def tcp(self, rec, tcp, rev): # pylint: disable=unused-argument
         """
@@ -70,15 +62,18 @@ class MSSChain(Chain):
         :param rev: True if the packet was in the reverse direction, False if
                     in the forward direction
         :type rev: bool
-        :return: Always True
-        :rtype: bool
+        :return: True, or :data:`pathspider.chains.base.RETIRE` once the
+                 handshake is over and TCPChain has seen a SYN in both
+                 directions
         """
 
-        # Shortcut non-SYN
+        # Nothing more is learned once the handshake is over, but a SYN/ACK
+        # may arrive late, so only retire once a SYN has been seen in both
+        # directions
         if not tcp.syn_flag:
-            return True
+            return RETIRE if syn_seen(rec) else True
 
-        opts = tcp_options(tcp)
+        opts = self.ctx.tcp_options
 
         if TO_MSS in opts:
             mss = bytes(opts[TO_MSS])
@@ -48,7 +48,9 @@ class NoOpChain(Chain):
                     in the forward direction
         :type rev: bool
         :return: True if flow should continue to be observed, False if the flow
-                 should be passed on for merging (i.e. the flow is complete)
+                 should be passed on for merging (i.e. the flow is complete),
+                 or :data:`pathspider.chains.base.RETIRE` if this chain has
+                 nothing more to learn from the flow
         :rtype: bool
         """
 
@@ -67,7 +69,9 @@ class NoOpChain(Chain):
                     in the forward direction
         :type rev: bool
         :return: True if flow should continue to be observed, False if the flow
-                 should be passed on for merging (i.e. the flow is complete)
+                 should be passed on for merging (i.e. the flow is complete),
+                 or :data:`pathspider.chains.base.RETIRE` if this chain has
+                 nothing more to learn from the flow
         :rtype: bool
         """
 
@@ -96,7 +100,9 @@ class NoOpChain(Chain):
                     in the forward direction
         :type rev: bool
         :return: True if flow should continue to be observed, False if the flow
-                 should be passed on for merging (i.e. the flow is complete)
+                 should be passed on for merging (i.e. the flow is complete),
+                 or :data:`pathspider.chains.base.RETIRE` if this chain has
+                 nothing more to learn from the flow
         :rtype: bool
         """
 
@@ -125,7 +131,9 @@ class NoOpChain(Chain):
                     in the forward direction
         :type rev: bool
         :return: True if flow should continue to be observed, False if the flow
-                 should be passed on for merging (i.e. the flow is complete)
+                 should be passed on for merging (i.e. the flow is complete),
+                 or :data:`pathspider.chains.base.RETIRE` if this chain has
+                 nothing more to learn from the flow
         :rtype: bool
         """
 
@@ -144,7 +152,9 @@ class NoOpChain(Chain):
                     in the forward direction
         :type rev: bool
         :return: True if flow should continue to be observed, False if the flow
-                 should be passed on for merging (i.e. the flow is complete)
+                 should be passed on for merging (i.e. the flow is complete),
+                 or :data:`pathspider.chains.base.RETIRE` if this chain has
+                 nothing more to learn from the flow
         :rtype: bool
         """
 
@@ -163,7 +173,9 @@ class NoOpChain(Chain):
                     in the forward direction
         :type rev: bool
         :return: True if flow should continue to be observed, False if the flow
-                 should be passed on for merging (i.e. the flow is complete)
+                 should be passed on for merging (i.e. the flow is complete),
+                 or :data:`pathspider.chains.base.RETIRE` if this chain has
+                 nothing more to learn from the flow
         :rtype: bool
         """
 
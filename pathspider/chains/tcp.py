@@ -5,16 +5,21 @@
 
 This module contains the TCPChain flow analysis chain which can be used by
 PATHspider's Observer for recording basic TCP [RFC793]_ behaviour details. This
-module also contains a helper function that may be used by chains for the
-parsing of TCP options and a number of useful TCP related constants that can be
-used to interpret the results added to flow records by TCPChain.
+module also contains helper functions that may be used by chains for the
+parsing of TCP options and for checking whether a flow's handshake has been
+seen, and a number of useful TCP related constants that can be used to
+interpret the results added to flow records by TCPChain.
 
 .. codeauthor:: Iain R. Learmonth <irl@fsfe.org>
 .. codeauthor:: Piet De Vaere <piet@devae.re>
 
 """
 
+import collections.abc
+import functools
+
 from pathspider.chains.base import Chain
+from pathspider.chains.base import Field
 
 #: TCP Flag - CWR
 TCP_CWR = 0x80
@@ -67,48 +72,148 @@ TO_EXPB = 255
 #: TCP Option Experiment ID - TCP Fast Open
 TO_EXID_FASTOPEN = (0xF9, 0x89)
 
-def tcp_options(tcp):
+#: The number of distinct TCP option blocks remembered by :func:`tcp_options`
+TCP_OPTIONS_CACHE_SIZE = 4096
+
+class TCPOptions(collections.abc.Mapping):
     """
-    Parses and extracts TCP options from a python-libtrace TCP object.
+    The parsed options from a TCP header.
 
-    .. warning:: This is a pure Python implementation of a TCP options parser
-                 and does not benefit from the speed advantage generally
-                 realised by calling to libtrace functions written in C through
-                 python-libtrace.
+    This is an immutable mapping of option kinds to option values (the bytes
+    following the kind and length). If an option kind appears more than once,
+    the mapping gives the value of the last instance and :meth:`get_all`
+    gives the values of every instance in the order they appeared. NOP and
+    EOL options are not included.
 
-    :param tcp: The TCP header to extract options from
-    :type tcp: plt.tcp
-    :returns: A mapping of option kinds to values
-    :rtype: dict
+    :attr:`malformed` is set if parsing stopped early because an option's
+    length was invalid or ran past the end of the options. Any options before
+    the malformed option are still available.
+    """
+
+    __slots__ = ("_opts", "_all", "malformed")
+
+    def __init__(self, instances, malformed=False):
+        """
+        :param instances: the options in the order they appeared, as pairs of
+                          kind and value
+        :type instances: list(tuple(int, bytes))
+        :param malformed: True if parsing stopped at a malformed option
+        :type malformed: bool
+        """
+
+        opts = {}
+        every = {}
+        for (kind, value) in instances:
+            opts[kind] = value
+            every.setdefault(kind, []).append(value)
+        self._opts = opts
+        self._all = {kind: tuple(values) for (kind, values) in every.items()}
+        self.malformed = malformed
+
+    def __getitem__(self, kind):
+        return self._opts[kind]
+
+    def __contains__(self, kind):
+        return kind in self._opts
+
+    def __iter__(self):
+        return iter(self._opts)
+
+    def __len__(self):
+        return len(self._opts)
+
+    def get(self, kind, default=None):
+        return self._opts.get(kind, default)
+
+    def get_all(self, kind):
+        """
+        Get the values of every instance of an option kind.
+
+        :param kind: the option kind
+        :type kind: int
+        :returns: the values in the order they appeared, or an empty tuple
+        :rtype: tuple(bytes)
+        """
+
+        return self._all.get(kind, ())
+
+    def __repr__(self):
+        return "TCPOptions({!r}{})".format(
+            self._opts, ", malformed" if self.malformed else "")
+
+@functools.lru_cache(maxsize=TCP_OPTIONS_CACHE_SIZE)
+def parse_tcp_options(optbytes):
     """
+    Parses a block of TCP options.
 
-    optbytes = tcp.data[20:tcp.doff*4]
-    opthash = {}
+    Most TCP stacks only use a few layouts of options on their SYNs, so the
+    parsed options are cached by the raw bytes of the options block, and
+    repeated option blocks are not parsed again.
 
-    # parse options in place
+    :param optbytes: The options block, following the fixed TCP header
+    :type optbytes: bytes
+    :returns: The parsed options
+    :rtype: pathspider.chains.tcp.TCPOptions
+    """
+
+    instances = []
+    malformed = False
+    end = len(optbytes)
     cp = 0
-    ncp = 0
 
-    while cp < len(optbytes):
+    while cp < end:
+        kind = optbytes[cp]
         # skip NOP
-        if optbytes[cp] == TO_NOP:
+        if kind == TO_NOP:
             cp += 1
             continue
-        # die on EOL
-        if optbytes[cp] == TO_EOL:
+        # stop at EOL
+        if kind == TO_EOL:
             break
 
-        # parse options length
+        # parse options length, which includes the kind and length octets
+        if cp + 1 >= end:
+            malformed = True
+            break
         ncp = cp + optbytes[cp+1]
+        if ncp < cp + 2 or ncp > end:
+            malformed = True
+            break
 
-        # copy options data into hash
-        # FIXME doesn't handle multiples (#189)
-        opthash[optbytes[cp]] = optbytes[cp+2:ncp]
-
-        # advance
+        instances.append((kind, optbytes[cp+2:ncp]))
         cp = ncp
 
-    return opthash
+    return TCPOptions(instances, malformed)
+
+def tcp_options(tcp):
+    """
+    Parses and extracts TCP options from a python-libtrace TCP object.
+
+    The options are parsed by :func:`parse_tcp_options`, which caches the
+    result for each distinct options block. The result is shared and cannot
+    be modified.
+
+    :param tcp: The TCP header to extract options from
+    :type tcp: plt.tcp
+    :returns: A mapping of option kinds to values
+    :rtype: pathspider.chains.tcp.TCPOptions
+    """
+
+    return parse_tcp_options(bytes(tcp.data[20:tcp.doff*4]))
+
+def syn_seen(rec):
+    """
+    Checks whether TCPChain has recorded a SYN in both directions of a flow.
+    Chains that only look at the handshake may use this to decide when to
+    retire from the flow. If TCPChain is not in use, this is always False.
+
+    :param rec: The flow record
+    :type rec: pathspider.records.FlowRecord
+    :rtype: bool
+    """
+
+    return (rec.get('tcp_synflags_fwd') is not None and
+            rec.get('tcp_synflags_rev') is not None)
 
 class TCPChain(Chain):
     """
@@ -135,31 +240,18 @@ class TCPChain(Chain):
     +----------------------+------+---------------------------------------------------------+
     """
 
-    def new_flow(self, rec, ip): # pylint: disable=W0613
-        """
-        For a new flow, all fields will be initialised to ``False`` except
-        ``tcp_synflags_*`` which will be set to ``None``.
-
-        :param rec: the flow record
-        :type rec: dict
-        :param ip: the IP or IPv6 packet that triggered the creation of a new
-                   flow record
-        :type ip: plt.ip or plt.ip6
-        :return: Always ``True``
-        :rtype: bool
-        """
-
-        rec['tcp_synflags_fwd'] = None
-        rec['tcp_synflags_rev'] = None
-
-        rec['tcp_fin_fwd'] = False
-        rec['tcp_fin_rev'] = False
-        rec['tcp_rst_fwd'] = False
-        rec['tcp_rst_rev'] = False
-
-        rec['tcp_connected'] = False
-
-        return True
+    fields = (
+        Field("tcp_synflags_fwd", int, None),
+        Field("tcp_synflags_rev", int, None),
+        Field("tcp_fin_fwd", bool, False),
+        Field("tcp_fin_rev", bool, False),
+        Field("tcp_rst_fwd", bool, False),
+        Field("tcp_rst_rev", bool, False),
+        Field("tcp_connected", bool, False),
+    )
+
+    # TCP flows only
+    protocols = frozenset((6, ))
 
     def tcp(self, rec, tcp, rev):
         """
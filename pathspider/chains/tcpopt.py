@@ -10,7 +10,9 @@ PATHspider's Observer for recording the presentent of the TCP TS, WS, and SACK o
 """
 
 from pathspider.chains.base import Chain
-from pathspider.chains.tcp import tcp_options
+from pathspider.chains.base import Field
+from pathspider.chains.base import RETIRE
+from pathspider.chains.tcp import syn_seen
 from pathspider.chains.tcp import TO_SACKOK
 from pathspider.chains.tcp import TO_TS
 from pathspider.chains.tcp import TO_WS
@@ -32,24 +34,14 @@ class TCPOptChain(Chain):
     +----------------+--------+------------------------------------------------------------------+
     """
 
-    def new_flow(self, rec, ip):
-        """
-        For a new flow, all fields will be initialised to ``None``.
-
-        :param rec: the flow record
-        :type rec: dict
-        :param ip: the IP or IPv6 packet that triggered the creation of a new
-                   flow record
-        :type ip: plt.ip or plt.ip6
-        :return: Always ``True``
-        :rtype: bool
-        """
-
-        rec['tcpopt_ts'] = None
-        rec['tcpopt_ws'] = None
-        rec['tcpopt_sack'] = None
+    fields = (
+        Field("tcpopt_ts", bool, None),
+        Field("tcpopt_ws", bool, None),
+        Field("tcpopt_sack", bool, None),
+    )
 
-        return True
+    # TCP flows only
+    protocols = frozenset((6, ))
 
     def tcp(self, rec, tcp, rev): # pylint: disable=unused-argument,no-self-use
         """
@@ -62,19 +54,22 @@ class TCPOptChain(Chain):
         :param rev: True if the packet was in the reverse direction, False if
                     in the forward direction
         :type rev: bool
-        :return: Always True
-        :rtype: bool
+        :return: True, or :data:`pathspider.chains.base.RETIRE` once the
+                 handshake is over and TCPChain has seen a SYN in both
+                 directions
         """
 
-        # Shortcut non-SYN
+        # Nothing more is learned once the handshake is over, but a SYN/ACK
+        # may arrive late, so only retire once a SYN has been seen in both
+        # directions
         if not tcp.syn_flag:
-            return True
+            return RETIRE if syn_seen(rec) else True
 
         # Only look at reverse path for SYN/ACK
         if not rev:
             return True
 
-        opts = tcp_options(tcp)
+        opts = self.ctx.tcp_options
 
         if TO_TS in opts:
             rec['tcpopt_ts'] = True
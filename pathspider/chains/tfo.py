@@ -14,7 +14,9 @@ PATHspider's Observer for recording TCP Fast Open [RFC7413]_ details.
 """
 
 from pathspider.chains.base import Chain
-from pathspider.chains.tcp import tcp_options
+from pathspider.chains.base import Field
+from pathspider.chains.base import RETIRE
+from pathspider.chains.tcp import syn_seen
 from pathspider.chains.tcp import TO_FASTOPEN
 from pathspider.chains.tcp import TO_EXID_FASTOPEN
 from pathspider.chains.tcp import TO_EXPA
@@ -44,8 +46,8 @@ class TFOChain(Chain):
     +------------------+--------+-----------------------------------------------------------------+
     """
 
-    def _cookie(self, tcp):
-        opts = tcp_options(tcp)
+    def _cookie(self):
+        opts = self.ctx.tcp_options
 
         if TO_FASTOPEN in opts:
             return (TO_FASTOPEN, bytes(opts[TO_FASTOPEN]))
@@ -56,28 +58,18 @@ class TFOChain(Chain):
         else:
             return (None, None)
 
-    def new_flow(self, rec, ip):
-        """
-        For a new flow, all fields will be initialised to ``int(0)``.
+    fields = (
+        Field("tfo_synkind", int, 0),
+        Field("tfo_ackkind", int, 0),
+        Field("tfo_synclen", int, 0),
+        Field("tfo_ackclen", int, 0),
+        Field("tfo_seq", int, 0),
+        Field("tfo_dlen", int, 0),
+        Field("tfo_ack", int, 0),
+    )
 
-        :param rec: the flow record
-        :type rec: dict
-        :param ip: the IP or IPv6 packet that triggered the creation of a new
-                   flow record
-        :type ip: plt.ip or plt.ip6
-        :return: Always ``True``
-        :rtype: bool
-        """
-
-        rec['tfo_synkind'] = 0
-        rec['tfo_ackkind'] = 0
-        rec['tfo_synclen'] = 0
-        rec['tfo_ackclen'] = 0
-        rec['tfo_seq'] = 0
-        rec['tfo_dlen'] = 0
-        rec['tfo_ack'] = 0
-
-        return True
+    # TCP flows only
+    protocols = frozenset((6, ))
 
     def tcp(self, rec, tcp, rev): # pylint: disable=unused-argument
         """
@@ -112,17 +104,20 @@ class TFOChain(Chain):
         :param rev: True if the packet was in the reverse direction, False if
                     in the forward direction
         :type rev: bool
-        :return: Always True
-        :rtype: bool
+        :return: True, or :data:`pathspider.chains.base.RETIRE` once the
+                 handshake is over and TCPChain has seen a SYN in both
+                 directions
         """
 
-        # Shortcut non-SYN
+        # Nothing more is learned once the handshake is over, but a SYN/ACK
+        # may arrive late, so only retire once a SYN has been seen in both
+        # directions
         if not tcp.syn_flag:
-            return True
+            return RETIRE if syn_seen(rec) else True
 
         # Check for TFO cookie and data on SYN
         if tcp.syn_flag and not tcp.ack_flag:
-            (tfo_kind, tfo_cookie) = self._cookie(tcp)
+            (tfo_kind, tfo_cookie) = self._cookie()
             if tfo_kind is not None:
                 rec['tfo_synkind'] = tfo_kind
                 rec['tfo_synclen'] = len(tfo_cookie)
@@ -133,7 +128,7 @@ class TFOChain(Chain):
         # Look for ACK of TFO data (and cookie)
         elif tcp.syn_flag and tcp.ack_flag and rec['tfo_synkind']:
             rec['tfo_ack'] = tcp.ack_nbr
-            (tfo_kind, tfo_cookie) = self._cookie(tcp)
+            (tfo_kind, tfo_cookie) = self._cookie()
             if tfo_kind is not None:
                 rec['tfo_ackkind'] = tfo_kind
                 rec['tfo_ackclen'] = len(tfo_cookie)
@@ -10,6 +10,7 @@ PATHspider's Observer for recording UDP details.
 """
 
 from pathspider.chains.base import Chain
+from pathspider.chains.base import Field
 
 class UDPChain(Chain):
     """
@@ -27,22 +28,13 @@ class UDPChain(Chain):
     +---------------------------+------+---------------------------------------+
     """
 
-    def new_flow(self, rec, ip):
-        """
-        For a new flow, all fields will be initialised to ``None``.
-
-        :param rec: the flow record
-        :type rec: dict
-        :param ip: the IP or IPv6 packet that triggered the creation of a new
-                   flow record
-        :type ip: plt.ip or plt.ip6
-        :return: Always ``True``
-        :rtype: bool
-        """
+    fields = (
+        Field("udp_zero_checksum_fwd", bool, None),
+        Field("udp_zero_checksum_rev", bool, None),
+    )
 
-        rec['udp_zero_checksum_fwd'] = None
-        rec['udp_zero_checksum_rev'] = None
-        return True
+    # UDP flows only
+    protocols = frozenset((17, ))
 
     def udp(self, rec, udp, rev):
         """
@@ -72,8 +72,14 @@ def run_measurement(args):
 
     try:
         if hasattr(args, "spider"):
-            if interface_up(args.interface):
-                spider = args.spider(args.workers, "int:" + args.interface, args)
+            interfaces = args.interface.split(",")
+            if all(interface_up(interface) for interface in interfaces):
+                # several interfaces can only be captured on through rings
+                capture = ("ring:" if args.observer_capture == "ring" or
+                           len(interfaces) > 1 else "int:")
+                uris = [capture + interface for interface in interfaces]
+                spider = args.spider(args.workers,
+                                     uris[0] if len(uris) == 1 else uris, args)
             else:
                 logger.error("The chosen interface is not up! Cannot continue.")
                 sys.exit(1)
@@ -124,7 +130,11 @@ def register_args(subparsers):
                                    help="Perform a PATHspider measurement",
                                    formatter_class=SubcommandHelpFormatter)
     parser.add_argument('-i', '--interface', default="eth0",
-                        help="The interface to use for the observer. (Default: eth0)")
+                        help=("The interface to use for the observer. A "
+                              "comma-separated list of interfaces spreads the "
+                              "jobs over several uplinks, with one observer "
+                              "capturing on all of them through AF_PACKET "
+                              "rings. (Default: eth0)"))
     parser.add_argument('-w', '--workers', type=int, default=20,
                         help="Number of workers to use. (Default: 20)")
     parser.add_argument('--input', default='/dev/stdin', metavar='INPUTFILE',
@@ -137,6 +147,99 @@ def register_args(subparsers):
                               "Defaults to standard output."))
     parser.add_argument('--output-flows', action='store_true',
                         help="Include flow results in output.")
+    parser.add_argument('--observer-shards', type=int, default=1,
+                        metavar='SHARDS',
+                        help=("Number of observer processes to use, each "
+                              "handling a disjoint share of the flows. "
+                              "(Default: 1)"))
+    parser.add_argument('--observer-capture', choices=['libtrace', 'ring'],
+                        default='libtrace',
+                        help=("How the observer captures packets: with "
+                              "libtrace, or through a memory-mapped AF_PACKET "
+                              "ring (Linux only). With more than one "
+                              "observer shard, the kernel shares the packets "
+                              "between the rings of the shards by flow. "
+                              "(Default: libtrace)"))
+    parser.add_argument('--observer-remote', metavar='HOST:PORT',
+                        help=("Receive flows from an observer run on another "
+                              "host with 'pspdr observe --serve', instead of "
+                              "running the observer locally. The remote "
+                              "observer must use the chains required by the "
+                              "plugin."))
+    parser.add_argument('--observer-remote-token', metavar='TOKEN',
+                        help=("The token to give the remote observer. "
+                              "(Default: the PATHSPIDER_REMOTE_TOKEN "
+                              "environment variable)"))
+    parser.add_argument('--observer-filter', action='store_true',
+                        help=("Only create flow records for traffic to or "
+                              "from the targets of jobs in progress."))
+    parser.add_argument('--observer-flush-interval', type=float, default=1,
+                        metavar='SECONDS',
+                        help=("Maximum time a completed flow is held by the "
+                              "observer before being passed on with others "
+                              "in a batch. (Default: 1)"))
+    parser.add_argument('--observer-stats', type=float, metavar='SECONDS',
+                        help=("Time the observer's chain functions and log "
+                              "the timings with the flow table sizes every "
+                              "SECONDS seconds. (Default: disabled)"))
+    parser.add_argument('--observer-early', action='store_true',
+                        help=("Have the observer pass on completed flows "
+                              "as soon as the merger is waiting for them, "
+                              "rather than after the expiry timeout."))
+    parser.add_argument('--observer-idle-tick', type=float,
+                        metavar='SECONDS',
+                        help=("Advance the observer's packet clock using the "
+                              "wall clock when no packets have been captured "
+                              "for SECONDS seconds, so that completed flows "
+                              "are passed on promptly. Only used when "
+                              "capturing live from an interface. "
+                              "(Default: disabled)"))
+    parser.add_argument('--observer-overload-lag', type=float,
+                        metavar='SECONDS',
+                        help=("Shed new flows unrelated to jobs while the "
+                              "observer is more than SECONDS behind the "
+                              "packets being captured. (Default: disabled)"))
+    parser.add_argument('--observer-overload-backlog', type=int,
+                        metavar='BATCHES',
+                        help=("Shed new flows unrelated to jobs while more "
+                              "than BATCHES batches of flows are waiting "
+                              "for the merger. (Default: disabled)"))
+    parser.add_argument('--observer-overload-sample', type=float, default=0,
+                        metavar='FRACTION',
+                        help=("Fraction of new flows unrelated to jobs, "
+                              "chosen by flow hash, that are still observed "
+                              "while the observer is overloaded. "
+                              "(Default: 0)"))
+    parser.add_argument('--observer-pcap', metavar='PCAPFILE',
+                        help=("Keep the first packets of the flows to or "
+                              "from the targets of jobs, and write them to "
+                              "PCAPFILE when the flows are passed on, for "
+                              "looking into odd results. (Default: "
+                              "disabled)"))
+    parser.add_argument('--observer-pcap-match', action='append',
+                        metavar='FIELD=VALUE',
+                        help=("Only write the packets of flows whose record "
+                              "has FIELD set to VALUE, given in JSON. May be "
+                              "given more than once, to write flows matching "
+                              "any of the conditions."))
+    parser.add_argument('--observer-pcap-packets', type=int, default=32,
+                        metavar='PACKETS',
+                        help=("Number of packets kept for each flow. "
+                              "(Default: 32)"))
+    parser.add_argument('--observer-pcap-memory', type=int, default=64,
+                        metavar='MB',
+                        help=("Memory used by each observer for the packets "
+                              "kept, above which packets are not kept. "
+                              "(Default: 64)"))
+    parser.add_argument('--observer-pcap-size', type=int, metavar='MB',
+                        help=("Start a new capture file when the current "
+                              "file reaches MB megabytes, and name the files "
+                              "PCAPFILE.1, PCAPFILE.2 and so on. (Default: "
+                              "one file)"))
+    parser.add_argument('--observer-pcap-files', type=int, default=1,
+                        metavar='FILES',
+                        help=("Number of capture files to rotate through, "
+                              "overwriting the oldest. (Default: 1)"))
 
     # Set the command entry point
     parser.set_defaults(cmd=run_measurement)
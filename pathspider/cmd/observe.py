@@ -1,10 +1,15 @@
 
 import argparse
+import glob
+import heapq
 import logging
 import json
+import multiprocessing as mp
+import os
 import queue
 import signal
 import sys
+import tempfile
 import threading
 
 from straight.plugin import load
@@ -12,14 +17,169 @@ from straight.plugin import load
 from pathspider.base import SHUTDOWN_SENTINEL
 from pathspider.base import QUEUE_SIZE
 
+from pathspider.aggregate import Aggregator
+
 from pathspider.chains.base import Chain
 
 from pathspider.observer import Observer
+from pathspider.observer import flow_fields
+from pathspider.observer import packet_shard
 
 from pathspider.network import interface_up
 
+from pathspider.remote import FlowServer
+from pathspider.remote import TOKEN_ENV
+from pathspider.remote import parse_address
+
+from pathspider import traces
+
 chains = load("pathspider.chains", subclasses=Chain)
 
+def _input_files(patterns):
+    files = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern))
+        if not matches:
+            raise FileNotFoundError("No capture files match " + pattern)
+        files.extend(matches)
+    return files
+
+def _split_file(task):
+    """
+    Split a capture file into one capture file for each partition, in the
+    given directory, by the flow keys of its packets. Returns the paths of
+    the files written, in partition order.
+    """
+
+    (index, path, partitions, directory) = task
+    extension = os.path.splitext(path)[1]
+    paths = [os.path.join(directory, "split_{}_{}{}".format(
+        partition, index, extension)) for partition in range(partitions)]
+    traces.split_capture(path, paths,
+                         lambda pkt: packet_shard(pkt, partitions))
+    return paths
+
+def _observe_partition(task):
+    """
+    Observe one partition of the flows in a list of capture files, writing
+    the flows to a file in the given directory ordered by their first packet
+    time and then by their JSON encoding. Each line is prefixed with the first
+    packet time of the flow, for merging the partitions.
+
+    If ``shard_count`` is greater than 1, the capture files hold all of the
+    flows and the partition's flows are picked out by sharding the Observer.
+    Otherwise, the capture files hold only the partition's flows.
+    """
+
+    (uris, chosen_chains, partition, shard_count, stats, columnar, aggregate,
+     directory) = task
+    shard = partition if shard_count > 1 else 0
+    if columnar and not aggregate:
+        # NumPy is only needed for columnar observation
+        from pathspider.columnar import ColumnarObserver
+        observer = ColumnarObserver(uris, chosen_chains, shard=shard,
+                                    shard_count=shard_count)
+    else:
+        observer = Observer(uris, chosen_chains, shard=shard,
+                            shard_count=shard_count, stats_interval=stats,
+                            aggregate=_aggregator(aggregate))
+    flowqueue = queue.Queue()
+    observer.run_flow_enqueuer(flowqueue)
+
+    flows = []
+    for batch in iter(flowqueue.get, SHUTDOWN_SENTINEL):
+        flows.extend((flow['pkt_first'], json.dumps(flow)) for flow in batch)
+    flows.sort()
+
+    path = os.path.join(directory, "partition_{}.ndjson".format(partition))
+    with open(path, 'w') as partitionfile:
+        for (pkt_first, line) in flows:
+            partitionfile.write("{!r}\t{}\n".format(pkt_first, line))
+    return path
+
+def _partition_tasks(args, chosen_chains, partition_uris, shard_count,
+                     directory):
+    return [(partition_uris[partition], chosen_chains, partition, shard_count,
+             args.observer_stats, getattr(args, 'columnar', False),
+             getattr(args, 'aggregate', None), directory)
+            for partition in range(len(partition_uris))]
+
+def _aggregator(interval):
+    return Aggregator(interval=interval) if interval else False
+
+def _read_partition(path):
+    with open(path) as partitionfile:
+        for line in partitionfile:
+            (pkt_first, flow) = line.split("\t", 1)
+            yield (float(pkt_first), flow)
+
+def run_offline(args, chosen_chains):
+    """
+    Observe the flows in a list of capture files, splitting the flows into
+    partitions by their flow keys (in the same way as Observer shards) that
+    are observed in parallel. The output is ordered by the first packet time
+    of each flow, and then by its JSON encoding, so that it doesn't depend on
+    the number of partitions.
+
+    If there are at least as many capture files as partitions, each capture
+    file is first split into one file for each partition (in parallel, one
+    process per capture file), so that each packet is only decoded in full by
+    the partition that observes its flow. The split files are written to a
+    temporary directory, which needs as much space as the capture files.
+    Each partition then reads its files in turn, so flows spanning the
+    boundary between two capture files are observed as one flow.
+
+    Otherwise, or if any of the capture files can only be read with
+    libtrace, each partition reads all of the packets and skips those of
+    other partitions' flows, so only the work of the chains is done in
+    parallel. Splitting a single file costs about as much as skipping its
+    packets in every partition, so it is only worth doing in parallel.
+
+    With ``--columnar``, the flows are observed with a
+    :class:`pathspider.columnar.ColumnarObserver`, which falls back to an
+    Observer if it doesn't support the chosen chains.
+
+    With ``--aggregate``, each partition produces its own summaries of its
+    share of the flows.
+    """
+
+    logger = logging.getLogger("pathspider")
+
+    files = _input_files(args.read)
+    uris = ["pcapfile:" + path for path in files]
+    logger.info("observing %d capture files in %d partitions", len(files),
+                args.jobs)
+
+    with tempfile.TemporaryDirectory() as directory:
+        if args.jobs > 1:
+            with mp.Pool(args.jobs) as pool:
+                partition_uris = [uris] * args.jobs
+                shard_count = args.jobs
+                if (len(files) >= args.jobs and
+                        all(traces.supports(uri) for uri in uris)):
+                    logger.info("splitting capture files into partitions")
+                    split = pool.map(_split_file, [
+                        (index, path, args.jobs, directory)
+                        for (index, path) in enumerate(files)])
+                    # each partition reads its share of every file in turn
+                    partition_uris = [["pcapfile:" + split_paths[partition]
+                                       for split_paths in split]
+                                      for partition in range(args.jobs)]
+                    shard_count = 1
+                paths = pool.map(_observe_partition, _partition_tasks(
+                    args, chosen_chains, partition_uris, shard_count,
+                    directory))
+        else:
+            paths = [_observe_partition(_partition_tasks(
+                args, chosen_chains, [uris], 1, directory)[0])]
+
+        logger.info("merging partitions into " + args.output)
+        with open(args.output, 'w') as outputfile:
+            for (_, flow) in heapq.merge(*[_read_partition(path)
+                                           for path in paths]):
+                outputfile.write(flow)
+    logger.info("output complete")
+
 def run_observer(args):
     logger = logging.getLogger("pathspider")
 
@@ -30,21 +190,6 @@ def run_observer(args):
         print("\nSpider safely!")
         sys.exit(0)
 
-    interface = args.interface
-
-    if not ":" in args.interface:
-        if interface.endswith(".pcap") or interface.startswith("/"):
-            interface = "pcapfile:" + interface
-        else:
-            interface = "int:" + interface
-
-    if interface.startswith("int:") and not interface_up(interface[4:]):
-        logger.error("The chosen interface is not up! Cannot continue.")
-        logger.error("Try --help for more information.")
-        sys.exit(1)
-
-    logger.info("creating observer...")
-
     chosen_chains = []
     for chosen_chain in args.chains:
         for chain in chains:
@@ -55,27 +200,120 @@ def run_observer(args):
         logger.error("Unable to find one or more of the requested chains.")
         logger.error("Try --list-chains to list the available chains.")
 
-    observer_shutdown_queue = queue.Queue(QUEUE_SIZE)
-    flowqueue = queue.Queue(QUEUE_SIZE)
+    if args.read:
+        run_offline(args, chosen_chains)
+        return
+
+    if args.serve and args.aggregate:
+        logger.error("Aggregate summaries cannot be served to spiders.")
+        logger.error("Try --help for more information.")
+        sys.exit(1)
+
+    interfaces = []
+    for interface in args.interface.split(","):
+        if not ":" in interface:
+            if interface.endswith(".pcap") or interface.startswith("/"):
+                interface = "pcapfile:" + interface
+            else:
+                interface = "int:" + interface
+
+        if (interface.startswith(("int:", "ring:")) and
+                not interface_up(interface.partition(":")[2])):
+            logger.error("The chosen interface is not up! Cannot continue.")
+            logger.error("Try --help for more information.")
+            sys.exit(1)
+        interfaces.append(interface)
+
+    # several interfaces are captured on at once
+    interface = interfaces[0] if len(interfaces) == 1 else interfaces
+
+    server = None
+    if args.serve:
+        # spiders can connect while the observers are starting
+        try:
+            server = FlowServer(parse_address(args.serve), flow_fields(
+                chosen_chains, interface=len(interfaces) > 1),
+                                token=(args.serve_token or
+                                       os.environ.get(TOKEN_ENV)),
+                                allow_all=args.serve_all)
+        except ValueError as error:
+            logger.error("Cannot serve flows: %s", error)
+            sys.exit(1)
+        logger.info("serving flows on %s:%d", *server.address)
 
-    observer = Observer(interface, chosen_chains)
+    logger.info("creating observer...")
+
+    if args.observer_shards > 1:
+        observer_shutdown_queue = mp.Queue(QUEUE_SIZE)
+        flowqueue = mp.Queue(QUEUE_SIZE)
+    else:
+        observer_shutdown_queue = queue.Queue(QUEUE_SIZE)
+        flowqueue = queue.Queue(QUEUE_SIZE)
+
+    observers = [Observer(interface, chosen_chains, shard=shard,
+                          shard_count=args.observer_shards,
+                          flush_interval=args.observer_flush_interval,
+                          stats_interval=args.observer_stats,
+                          idle_tick=args.observer_idle_tick or None,
+                          merge=len(interfaces) > 1,
+                          aggregate=_aggregator(args.aggregate))
+                 for shard in range(args.observer_shards)]
 
     logger.info("starting observer...")
-    threading.Thread(target=observer.run_flow_enqueuer, args=(flowqueue,observer_shutdown_queue)).start()
+    if len(observers) > 1:
+        for shard, observer in enumerate(observers):
+            mp.Process(target=observer.run_flow_enqueuer,
+                       args=(flowqueue, observer_shutdown_queue),
+                       name='observer_{}'.format(shard),
+                       daemon=True).start()
+    else:
+        threading.Thread(target=observers[0].run_flow_enqueuer,
+                         args=(flowqueue, observer_shutdown_queue)).start()
+
+    logger.info("registering interrupt...")
+    def signal_handler(signal, frame):
+        for _ in observers:
+            observer_shutdown_queue.put(True)
+    signal.signal(signal.SIGINT, signal_handler)
+
+    if server is not None:
+        serve_flows(server, flowqueue, len(observers))
+        return
 
     logger.info("opening output file " + args.output)
     with open(args.output, 'w') as outputfile:
-        logger.info("registering interrupt...")
-        def signal_handler(signal, frame):
-            observer_shutdown_queue.put(True)
-        signal.signal(signal.SIGINT, signal_handler)
-        while True:
-            result = flowqueue.get()
-            if result == SHUTDOWN_SENTINEL:
-                logger.info("output complete")
-                break
-            outputfile.write(json.dumps(result) + "\n")
-            logger.debug("wrote a result")
+        for results in _flow_batches(flowqueue, len(observers)):
+            for result in results:
+                outputfile.write(json.dumps(result) + "\n")
+            logger.debug("wrote %d results", len(results))
+        logger.info("output complete")
+
+def _flow_batches(flowqueue, observers_running):
+    """
+    Get the batches of flows passed on by the observers, until all of them
+    have finished.
+    """
+
+    while observers_running > 0:
+        results = flowqueue.get()
+        if results == SHUTDOWN_SENTINEL:
+            observers_running -= 1
+            continue
+        yield results
+
+def serve_flows(server, flowqueue, observers_running):
+    """
+    Stream the flows passed on by the observers to the spiders connected to
+    a flow server, until all of the observers have finished.
+    """
+
+    logger = logging.getLogger("pathspider")
+
+    for results in _flow_batches(flowqueue, observers_running):
+        server.send(results)
+        logger.debug("served %d results", len(results))
+    server.close()
+    logger.info("serving complete")
 
 def register_args(subparsers):
     class SubcommandHelpFormatter(argparse.RawDescriptionHelpFormatter):
@@ -95,10 +333,82 @@ def register_args(subparsers):
                         help=("The interface to use for the observer. If this "
                               "argument ends with '.pcap' then it will instead "
                               "be treated as a PCAP file for offline analysis. "
-                              "(Default: eth0)"))
+                              "Prefix the interface with 'ring:' to capture "
+                              "through a memory-mapped AF_PACKET ring (Linux "
+                              "only). A comma-separated list of 'ring:' "
+                              "interfaces or capture files is merged into "
+                              "one capture. (Default: eth0)"))
+    parser.add_argument('-r', '--read', action='append', metavar='PCAP',
+                        help=("A capture file, or a glob pattern (quoted to "
+                              "protect it from the shell) matching capture "
+                              "files, to analyse offline instead of observing "
+                              "an interface. May be given more than once. All "
+                              "files are read in turn as one continuous "
+                              "capture, in the order given with the files "
+                              "matching each pattern sorted by name."))
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help=("Number of processes to use for offline "
+                              "analysis, each observing a disjoint partition "
+                              "of the flows. With at least as many capture "
+                              "files as processes, the files are first split "
+                              "by partition, one process per file. Otherwise, "
+                              "or for files that only libtrace can read, "
+                              "every process decodes every packet and only "
+                              "the work of the chains is done in parallel. "
+                              "(Default: 1)"))
+    parser.add_argument('--columnar', action='store_true',
+                        help=("Observe the capture files read with -r using "
+                              "vectorized equivalents of the basic, tcp, ecn, "
+                              "dscp and udp chains, which is much faster for "
+                              "large captures. If other chains are chosen, "
+                              "the files are observed as usual. Requires "
+                              "NumPy."))
+    parser.add_argument('--aggregate', type=float, metavar='SECONDS',
+                        help=("Output a summary of the traffic observed in "
+                              "each SECONDS seconds, kept in fixed memory, "
+                              "instead of a record for each flow. Each "
+                              "observer shard or partition summarises its "
+                              "own share of the flows. (Default: disabled)"))
     parser.add_argument('--output', default='/dev/stdout', metavar='OUTPUTFILE',
                         help=("The file to output results data to. "
                               "Defaults to standard output."))
+    parser.add_argument('--serve', metavar='HOST:PORT',
+                        help=("Stream the flows to spiders connecting to "
+                              "HOST:PORT (with 'pspdr measure "
+                              "--observer-remote') instead of writing them "
+                              "to the output file. Each spider is sent the "
+                              "flows to or from its own addresses. A port on "
+                              "its own listens on the loopback address."))
+    parser.add_argument('--serve-token', metavar='TOKEN',
+                        help=("The token spiders must give to be sent flows. "
+                              "Required unless serving on a loopback "
+                              "address. (Default: the {} environment "
+                              "variable)".format(TOKEN_ENV)))
+    parser.add_argument('--serve-all', action='store_true',
+                        help=("Send all of the flows to spiders that give no "
+                              "addresses, rather than refusing them."))
+    parser.add_argument('--observer-shards', type=int, default=1,
+                        metavar='SHARDS',
+                        help=("Number of observer processes to use, each "
+                              "handling a disjoint share of the flows. "
+                              "(Default: 1)"))
+    parser.add_argument('--observer-flush-interval', type=float, default=1,
+                        metavar='SECONDS',
+                        help=("Maximum time a completed flow is held by the "
+                              "observer before being passed on with others "
+                              "in a batch. (Default: 1)"))
+    parser.add_argument('--observer-stats', type=float, metavar='SECONDS',
+                        help=("Time the observer's chain functions and log "
+                              "the timings with the flow table sizes every "
+                              "SECONDS seconds. (Default: disabled)"))
+    parser.add_argument('--observer-idle-tick', type=float,
+                        metavar='SECONDS',
+                        help=("Advance the observer's packet clock using the "
+                              "wall clock when no packets have been captured "
+                              "for SECONDS seconds, so that completed flows "
+                              "are passed on promptly. Only used when "
+                              "capturing live from an interface. "
+                              "(Default: disabled)"))
     parser.add_argument('chains', nargs='*', help="Observer chains to use")
 
     # Set the command entry point
@@ -0,0 +1,818 @@
+"""
+.. module:: pathspider.columnar
+   :synopsis: Vectorized offline flow observation with NumPy
+
+This module contains an alternative to the Observer for the offline analysis
+of large capture files. Rather than passing each packet to the chain
+functions in turn, the packets are decoded into columns of NumPy arrays
+(timestamps, flow keys, directions, lengths, traffic classes and TCP flags),
+divided into flows following the Observer's idle and expiry timeouts, and the
+fields of the chains are then computed for all of the flows at once as
+reductions over the packets of each flow.
+
+Vectorized equivalents exist for the chains in :data:`COLUMNAR_CHAINS`.
+The flow records are the same as those of an Observer reading the capture
+files with the pure Python packet sources in :mod:`pathspider.traces`,
+although they may be passed on in a different order. Packets that need more
+than the common case of decoding (such as ICMP messages quoting another
+packet, IPv6 extension headers and fragments) are decoded one at a time as
+the Observer would. Where the same records cannot be guaranteed, for other
+chains, timeouts of less than a second or packets that are not in timestamp
+order, the capture files are observed with an Observer instead.
+
+NumPy is required by this module, but is not otherwise needed by PATHspider.
+
+.. codeauthor:: Iain R. Learmonth <irl@fsfe.org>
+
+"""
+
+import logging
+import math
+import socket
+import struct
+import time
+
+import numpy as np
+
+from pathspider.base import SHUTDOWN_SENTINEL
+from pathspider.chains.basic import BasicChain
+from pathspider.chains.context import PacketContext
+from pathspider.chains.dscp import DSCPChain
+from pathspider.chains.ecn import ECNChain
+from pathspider.chains.tcp import TCP_ACK
+from pathspider.chains.tcp import TCP_FIN
+from pathspider.chains.tcp import TCP_RST
+from pathspider.chains.tcp import TCP_SA
+from pathspider.chains.tcp import TCP_SYN
+from pathspider.chains.tcp import TCPChain
+from pathspider.chains.udp import UDPChain
+from pathspider.observer import ICMP4_WITH_PAYLOAD
+from pathspider.observer import ICMP6_WITH_PAYLOAD
+from pathspider.observer import PROTOS_WITH_PORTS
+from pathspider.observer import Observer
+from pathspider.observer import _flow4_key
+from pathspider.observer import _flow6_key
+from pathspider.observer import flow_fields
+from pathspider.observer import flow_shard
+from pathspider import traces
+from pathspider.traces.packet import ETHERTYPE_IPV4
+from pathspider.traces.packet import ETHERTYPE_IPV6
+from pathspider.traces.packet import ETHERTYPE_VLAN
+from pathspider.traces.packet import LINKTYPE_ETHERNET
+from pathspider.traces.packet import LINKTYPE_IPV4
+from pathspider.traces.packet import LINKTYPE_IPV6
+from pathspider.traces.packet import LINKTYPE_LINUX_SLL
+from pathspider.traces.packet import LINKTYPE_LINUX_SLL2
+from pathspider.traces.packet import LINKTYPE_LOOP
+from pathspider.traces.packet import LINKTYPE_NULL
+from pathspider.traces.packet import LINKTYPE_RAW
+from pathspider.traces.packet import LINKTYPE_RAW_BSD
+from pathspider.traces.packet import LINKTYPE_RAW_OBSD
+from pathspider.traces.packet import Packet
+
+#: The chains that have vectorized equivalents
+COLUMNAR_CHAINS = (BasicChain, TCPChain, ECNChain, DSCPChain, UDPChain)
+
+_RAW_LINKTYPES = (LINKTYPE_RAW, LINKTYPE_RAW_BSD, LINKTYPE_RAW_OBSD,
+                  LINKTYPE_IPV4, LINKTYPE_IPV6)
+_ETHERTYPES_IP = (ETHERTYPE_IPV4, ETHERTYPE_IPV6)
+
+# IPv6 extension headers, including the fragment header
+_IP6_EXTENSION_HEADERS = (0, 43, 44, 51, 60)
+
+# Packets without a flow record, decoded as the common case, and decoded one
+# at a time
+_DROP = 0
+_SIMPLE = 1
+_COMPLEX = 2
+
+# The width of a flow key row: the key length, the protocol and the two
+# endpoints, each an address and port padded to the size of an IPv6 endpoint
+_EP = 18
+_ROW = 2 + 2 * _EP
+
+_ECN_MARKS = (("ect0", 0x02), ("ect1", 0x01), ("ce", 0x03))
+
+_HASH = np.uint64(0x9e3779b97f4a7c15)
+
+
+def supports(chains, idle_timeout=30, expiry_timeout=5):
+    """
+    Check whether flows can be observed with vectorized equivalents of the
+    given chains, with the same results as an Observer.
+
+    :param chains: the chain classes
+    :type chains: list
+    :param idle_timeout: the idle timeout in seconds
+    :type idle_timeout: float
+    :param expiry_timeout: the expiry timeout in seconds
+    :type expiry_timeout: float
+    :rtype: bool
+    """
+
+    # a timer that is due as soon as it is scheduled fires at the next tick
+    # of the packet clock rather than at its deadline
+    return (all(chain in COLUMNAR_CHAINS for chain in chains) and
+            idle_timeout >= 1 and math.ceil(expiry_timeout) >= 1)
+
+
+def _next_true(flag):
+    """
+    Get the position of the next true value at or after each position, or
+    the length of the array if there is none. The result has an extra
+    element for the position after the end.
+    """
+
+    n = len(flag)
+    index = np.where(flag, np.arange(n), n)
+    return np.append(np.minimum.accumulate(index[::-1])[::-1], n)
+
+
+def _prev_true(flag):
+    """
+    Get the position of the last true value at or before each position, or
+    -1 if there is none.
+    """
+
+    return np.maximum.accumulate(np.where(flag, np.arange(len(flag)), -1))
+
+
+class _Frames:
+    """
+    The captured frames of a capture file, and the columns decoded from them.
+    """
+
+    def __init__(self, trace):
+        self.trace = trace
+        # pylint: disable=protected-access
+        self.buf = np.frombuffer(trace._buf, np.uint8)
+        (self.start, self.end, self.seconds, self.linktype) = self._index()
+        n = len(self.start)
+        self.kind = np.zeros(n, np.uint8)
+        self.key = np.full(n, -1, np.int64)
+        self.direction = np.zeros(n, np.uint8)
+        self.l3 = np.full(n, -1, np.int64)
+        self.version = np.zeros(n, np.uint8)
+        self.size = np.zeros(n, np.int64)
+        self.tc = np.zeros(n, np.int64)
+        self.proto = np.zeros(n, np.int64)
+        self.sp = np.full(n, -1, np.int64)
+        self.dp = np.full(n, -1, np.int64)
+        self.tcp = np.zeros(n, bool)
+        self.flags = np.zeros(n, np.int64)
+        self.payload_len = np.zeros(n, np.int64)
+        self.udp = np.zeros(n, bool)
+        self.udp_zero = np.zeros(n, bool)
+
+    def _index(self):
+        # pylint: disable=protected-access
+        trace = self.trace
+        rec = getattr(trace, "_rec", None)
+        if rec is None:
+            # pcapng blocks are walked by the packet source
+            pkt = Packet()
+            frames = []
+            while trace.read_packet(pkt):
+                frames.append((pkt._start, pkt._end, pkt.seconds,
+                               pkt.linktype))
+            if not frames:
+                return (np.zeros(0, np.int64), np.zeros(0, np.int64),
+                        np.zeros(0), np.zeros(0, np.int64))
+            (start, end, seconds, linktype) = zip(*frames)
+            return (np.array(start, np.int64), np.array(end, np.int64),
+                    np.array(seconds, np.float64),
+                    np.array(linktype, np.int64))
+
+        # only the record offsets are found one record at a time, the record
+        # headers are then decoded together
+        buf = trace._buf
+        size = trace._size
+        caplen = struct.Struct(trace._endian + "I").unpack_from
+        offsets = []
+        append = offsets.append
+        pos = trace._pos
+        while pos + 16 <= size:
+            end = pos + 16 + caplen(buf, pos + 8)[0]
+            if end > size:
+                break
+            append(pos)
+            pos = end
+        offsets = np.array(offsets, np.int64)
+        header = self.buf[offsets[:, None] + np.arange(16)]
+        header = np.ascontiguousarray(header).view(trace._endian + "u4")
+        start = offsets + 16
+        seconds = (header[:, 0].astype(np.float64) +
+                   header[:, 1].astype(np.float64) * trace._tsres)
+        return (start, start + header[:, 2].astype(np.int64), seconds,
+                np.full(len(offsets), trace._linktype, np.int64))
+
+    def _u8(self, pos):
+        return self.buf[np.minimum(pos, len(self.buf) - 1)].astype(np.int64)
+
+    def _u16(self, pos):
+        return (self._u8(pos) << 8) | self._u8(pos + 1)
+
+    def _network_offsets(self):
+        """
+        Find the offset of the network layer header of each frame, as
+        :func:`pathspider.traces.packet.network_offset`.
+        """
+
+        (start, end, linktype) = (self.start, self.end, self.linktype)
+        l3 = np.full(len(start), -1, np.int64)
+
+        raw = np.isin(linktype, _RAW_LINKTYPES)
+        l3[raw] = start[raw]
+
+        eth = np.flatnonzero((linktype == LINKTYPE_ETHERNET) &
+                             (start + 14 <= end))
+        off = start[eth] + 12
+        ethertype = self._u16(off)
+        vlan = np.isin(ethertype, ETHERTYPE_VLAN) & (off + 6 <= end[eth])
+        while vlan.any():
+            off[vlan] += 4
+            ethertype[vlan] = self._u16(off[vlan])
+            vlan &= np.isin(ethertype, ETHERTYPE_VLAN) & (off + 6 <= end[eth])
+        ip = np.isin(ethertype, _ETHERTYPES_IP)
+        l3[eth[ip]] = off[ip] + 2
+
+        sll = np.flatnonzero((linktype == LINKTYPE_LINUX_SLL) &
+                             (start + 16 <= end))
+        ip = np.isin(self._u16(start[sll] + 14), _ETHERTYPES_IP)
+        l3[sll[ip]] = start[sll[ip]] + 16
+
+        sll2 = np.flatnonzero((linktype == LINKTYPE_LINUX_SLL2) &
+                              (start + 20 <= end))
+        ip = np.isin(self._u16(start[sll2]), _ETHERTYPES_IP)
+        l3[sll2[ip]] = start[sll2[ip]] + 20
+
+        loop = np.isin(linktype, (LINKTYPE_NULL, LINKTYPE_LOOP)) & (
+            start + 4 < end)
+        l3[loop] = start[loop] + 4
+        return l3
+
+    def decode(self):
+        """
+        Decode the frames that are IPv4 or IPv6 packets, as far as the common
+        case goes. The flow key rows and directions of the packets decoded
+        are returned, and the packets that need more decoding are marked.
+
+        :returns: the positions of the packets decoded, their key rows and
+                  their directions
+        """
+
+        l3 = self._network_offsets()
+        index = np.flatnonzero(l3 >= 0)
+        off = l3[index]
+        end = self.end[index]
+        caplen = end - off
+        version = np.where(caplen > 0, self._u8(off) >> 4, 0)
+        self.l3[index] = off
+        self.version[index] = version
+        self.size[index] = caplen
+
+        rows = []
+        for (ipv, minlen) in ((4, 20), (6, 40)):
+            sel = (version == ipv) & (caplen >= minlen)
+            rows.append(self._decode_ip(index[sel], off[sel], end[sel], ipv))
+        return tuple(np.concatenate(parts) for parts in zip(*rows))
+
+    def _decode_ip(self, index, off, end, version):
+        u8 = self._u8
+        u16 = self._u16
+        if version == 4:
+            ihl = u8(off) & 0x0f
+            total = u16(off + 2)
+            tend = np.minimum(end, off + total)
+            proto = u8(off + 9)
+            toff = off + ihl * 4
+            tc = u8(off + 1)
+            (alen, aoff, icmp, quotation) = (4, 12, 1, ICMP4_WITH_PAYLOAD)
+            minlen = 20
+            irregular = ((ihl < 5) | (tend - off < 20) |
+                         ((u16(off + 6) & 0x1fff) != 0))
+        else:
+            plen = u16(off + 4)
+            tend = np.minimum(end, off + 40 + plen)
+            proto = u8(off + 6)
+            toff = off + 40
+            tc = ((u8(off) & 0x0f) << 4) | (u8(off + 1) >> 4)
+            (alen, aoff, icmp, quotation) = (16, 8, 58, ICMP6_WITH_PAYLOAD)
+            minlen = 40
+            irregular = np.isin(proto, _IP6_EXTENSION_HEADERS)
+        tlen = tend - toff
+        ports = np.isin(proto, tuple(PROTOS_WITH_PORTS))
+        tcp = proto == 6
+        udp = proto == 17
+        irregular |= ((ports & (tlen < 4)) | (tcp & (tlen < 20)) |
+                      (udp & (tlen < 8)) | ((proto == icmp) & (tlen < 8)))
+
+        # ICMP messages quoting a packet belong to the flow of the quoted
+        # packet, in the opposite direction
+        quoted = ((proto == icmp) & (tlen >= 8) &
+                  np.isin(u8(toff), tuple(quotation)))
+        qoff = toff + 8
+        valid = (tend - qoff >= minlen) & (u8(qoff) >> 4 == version)
+        irregular |= quoted & ~valid
+        koff = np.where(quoted, qoff, off)
+        if version == 4:
+            kproto = np.where(quoted, u8(qoff + 9), proto)
+            ktoff = np.where(quoted, qoff + (u8(qoff) & 0x0f) * 4, toff)
+        else:
+            kproto = np.where(quoted, u8(qoff + 6), proto)
+            ktoff = np.where(quoted, qoff + 40, toff)
+            irregular |= quoted & np.isin(kproto, _IP6_EXTENSION_HEADERS)
+        ports = np.isin(kproto, tuple(PROTOS_WITH_PORTS))
+        irregular |= ports & (tend - ktoff < 4)
+
+        self.kind[index[irregular]] = _COMPLEX
+        sel = ~irregular
+        (index, toff, proto, tcp, udp) = (
+            index[sel], toff[sel], proto[sel], tcp[sel], udp[sel])
+        (koff, kproto, ktoff, ports, quoted) = (
+            koff[sel], kproto[sel], ktoff[sel], ports[sel], quoted[sel])
+        self.kind[index] = _SIMPLE
+        self.tc[index] = tc[sel]
+        self.proto[index] = proto
+        self.tcp[index] = tcp
+        self.udp[index] = udp
+        transport = tcp | udp
+        self.sp[index[transport]] = u16(toff[transport])
+        self.dp[index[transport]] = u16(toff[transport] + 2)
+        doff = u8(toff[tcp] + 12) >> 4
+        self.flags[index[tcp]] = u8(toff[tcp] + 13)
+        if version == 4:
+            self.payload_len[index[tcp]] = (
+                total[sel][tcp] - (ihl[sel][tcp] + doff) * 4)
+        else:
+            self.payload_len[index[tcp]] = plen[sel][tcp] - doff * 4
+        self.udp_zero[index[udp]] = u16(toff[udp] + 6) == 0
+
+        # the endpoints of each packet, as addresses followed by ports
+        src = np.zeros((len(index), _EP), np.uint8)
+        dst = np.zeros((len(index), _EP), np.uint8)
+        src[:, :alen] = self.buf[koff[:, None] + aoff + np.arange(alen)]
+        dst[:, :alen] = self.buf[koff[:, None] + aoff + alen +
+                                 np.arange(alen)]
+        portbytes = self.buf[ktoff[ports][:, None] + np.arange(4)]
+        src[ports, alen:alen + 2] = portbytes[:, 0:2]
+        dst[ports, alen:alen + 2] = portbytes[:, 2:4]
+
+        # canonical keys, as built by pathspider.observer._flow_key
+        differ = src != dst
+        first = differ.argmax(axis=1)
+        rows = np.arange(len(index))
+        direction = differ.any(axis=1) & (src[rows, first] > dst[rows, first])
+        swap = direction[:, None]
+        key = np.empty((len(index), _ROW), np.uint8)
+        key[:, 0] = 1 + 2 * np.where(ports, alen + 2, alen)
+        key[:, 1] = kproto
+        key[:, 2:2 + _EP] = np.where(swap, dst, src)
+        key[:, 2 + _EP:] = np.where(swap, src, dst)
+        return (index, key, (direction ^ quoted).astype(np.uint8))
+
+    def decode_complex(self, keys):
+        """
+        Decode the packets that were not decoded as the common case, one at a
+        time as the Observer would.
+
+        :param keys: the flow keys seen so far, and their numbers
+        :type keys: dict
+        """
+
+        pkt = Packet()
+        ctx = PacketContext(pkt)
+        buf = self.trace._buf # pylint: disable=protected-access
+        for i in np.flatnonzero(self.kind == _COMPLEX).tolist():
+            pkt.set(buf, int(self.start[i]), int(self.end[i]),
+                    float(self.seconds[i]), int(self.linktype[i]))
+            ctx.reset()
+            ip = pkt.ip
+            try:
+                if ip:
+                    (fid, direction) = _flow4_key(ip)
+                else:
+                    ip = pkt.ip6
+                    (fid, direction) = _flow6_key(ip)
+            except ValueError:
+                self.kind[i] = _DROP
+                continue
+            ctx.ip = ip
+            self.key[i] = keys.setdefault(fid, len(keys))
+            self.direction[i] = direction
+            self.tc[i] = ip.traffic_class
+            self.proto[i] = ip.proto
+            tcp = ctx.tcp
+            udp = pkt.udp
+            if ip.udp:
+                (self.sp[i], self.dp[i]) = (ip.udp.src_port, ip.udp.dst_port)
+            elif ip.tcp:
+                (self.sp[i], self.dp[i]) = (ip.tcp.src_port, ip.tcp.dst_port)
+            if tcp:
+                self.tcp[i] = True
+                self.flags[i] = tcp.flags
+                self.payload_len[i] = ctx.payload_len
+            elif udp:
+                self.udp[i] = True
+                self.udp_zero[i] = udp.checksum == 0
+
+    def address(self, i, dst):
+        """
+        Get the source or destination address of a packet as a string.
+        """
+
+        off = int(self.l3[i])
+        if self.version[i] == 4:
+            off += 16 if dst else 12
+            return socket.inet_ntop(socket.AF_INET,
+                                    self.buf[off:off + 4].tobytes())
+        off += 24 if dst else 8
+        return socket.inet_ntop(socket.AF_INET6,
+                                self.buf[off:off + 16].tobytes())
+
+
+def _key_numbers(rows, keys):
+    """
+    Number the flow key rows, adding new keys to the keys seen so far.
+    """
+
+    if len(rows) == 0:
+        return np.zeros(0, np.int64)
+
+    # rows are grouped by a hash, which is checked for collisions
+    words = np.zeros((len(rows), 40), np.uint8)
+    words[:, :_ROW] = rows
+    words = words.view(np.uint64)
+    digest = words[:, 0] * _HASH
+    for column in range(1, words.shape[1]):
+        digest = (digest ^ words[:, column]) * _HASH
+    (_, first, inverse) = np.unique(digest, return_index=True,
+                                    return_inverse=True)
+    if not np.array_equal(rows[first][inverse], rows):
+        packed = np.ascontiguousarray(rows).view("V{}".format(_ROW)).ravel()
+        (_, first, inverse) = np.unique(packed, return_index=True,
+                                        return_inverse=True)
+
+    numbers = np.empty(len(first), np.int64)
+    for (number, row) in enumerate(rows[first]):
+        eplen = (int(row[0]) - 1) // 2
+        fid = (row[1:2].tobytes() + row[2:2 + eplen].tobytes() +
+               row[2 + _EP:2 + _EP + eplen].tobytes())
+        numbers[number] = keys.setdefault(fid, len(keys))
+    return numbers[inverse.ravel()]
+
+
+class ColumnarObserver:
+    """
+    Observes the flows in capture files with vectorized equivalents of the
+    built-in chains, as a drop-in replacement for an
+    :class:`pathspider.observer.Observer` in offline analysis.
+
+    .. code-block:: python
+
+     observer = ColumnarObserver(["pcapfile:capture.pcap"],
+                                 [BasicChain, TCPChain])
+     observer.run_flow_enqueuer(flowqueue)
+
+    :param lturi: The URI of a capture file, or a list of URIs of capture
+                  files to be read in turn as one continuous capture
+    :type lturi: str or list(str)
+    :param chains: the chain classes
+    :type chains: list
+    :param idle_timeout: as for :class:`pathspider.observer.Observer`
+    :type idle_timeout: float
+    :param expiry_timeout: as for :class:`pathspider.observer.Observer`
+    :type expiry_timeout: float
+    :param shard: as for :class:`pathspider.observer.Observer`
+    :type shard: int
+    :param shard_count: as for :class:`pathspider.observer.Observer`
+    :type shard_count: int
+    :param batch_size: The maximum number of flows passed on together by
+                       :meth:`run_flow_enqueuer`
+    :type batch_size: int
+    """
+
+    def __init__(self, lturi, chains=None, idle_timeout=30, expiry_timeout=5,
+                 shard=0, shard_count=1, batch_size=100):
+        if not 0 <= shard < shard_count:
+            raise ValueError("Observer shard must be in the range "
+                             "0 <= shard < shard_count")
+        self._lturis = [lturi] if isinstance(lturi, str) else list(lturi)
+        if not self._lturis:
+            raise ValueError("Observer needs at least one libtrace URI")
+        self._chains = list(chains) if chains is not None else []
+        self._idle_timeout = idle_timeout
+        self._expiry_timeout = expiry_timeout
+        self._shard = shard
+        self._shard_count = shard_count
+        self._batch_size = batch_size
+        self._logger = logging.getLogger("observer")
+
+    def _observer(self):
+        return Observer(self._lturis, self._chains,
+                        idle_timeout=self._idle_timeout,
+                        expiry_timeout=self._expiry_timeout,
+                        shard=self._shard, shard_count=self._shard_count,
+                        batch_size=self._batch_size, packet_source="python")
+
+    def run_flow_enqueuer(self, flowqueue, irqueue=None):
+        """
+        Observe the capture files, passing the flows to ``flowqueue`` as
+        lists of flow records followed by
+        :data:`pathspider.base.SHUTDOWN_SENTINEL`.
+
+        :param flowqueue: The queue to pass flow batches to
+        :type flowqueue: queue.Queue or multiprocessing.Queue
+        :param irqueue: Not used, the capture files are always read to the
+                        end
+        """
+
+        flows = self.flows()
+        if flows is None:
+            self._observer().run_flow_enqueuer(flowqueue, irqueue)
+            return
+        for i in range(0, len(flows), self._batch_size):
+            flowqueue.put(flows[i:i + self._batch_size])
+        flowqueue.put(SHUTDOWN_SENTINEL)
+
+    def flows(self):
+        """
+        Observe the capture files.
+
+        :returns: the flow records, ordered by the last packet of each flow,
+                  or None if the flows cannot be observed with the same
+                  results as an Observer
+        :rtype: list(dict)
+        """
+
+        if not supports(self._chains, self._idle_timeout,
+                        self._expiry_timeout):
+            self._logger.info("chains or timeouts not supported by the "
+                              "columnar observer, using the observer")
+            return None
+        if not all(traces.supports(uri) and not traces.is_ring(uri)
+                   for uri in self._lturis):
+            self._logger.info("columnar observer only reads capture files, "
+                              "using the observer")
+            return None
+
+        started = time.perf_counter()
+        opened = [traces.trace(uri) for uri in self._lturis]
+        try:
+            frames = [_Frames(trace) for trace in opened]
+            keys = {}
+            for frame in frames:
+                (index, rows, direction) = frame.decode()
+                frame.key[index] = _key_numbers(rows, keys)
+                frame.direction[index] = direction
+                frame.decode_complex(keys)
+            flows = self._observe(frames, list(keys))
+        finally:
+            for trace in opened:
+                trace.close()
+        if flows is None:
+            self._logger.info("packets are not in timestamp order, using "
+                              "the observer")
+            return None
+
+        self._logger.info("observed %u packets into %u flows in %.3f s",
+                          sum(len(frame.start) for frame in frames),
+                          len(flows), time.perf_counter() - started)
+        return flows
+
+    def _observe(self, frames, keys):
+        # pylint: disable=too-many-locals
+        column = lambda name: np.concatenate(
+            [getattr(frame, name) for frame in frames])
+        seconds = column("seconds")
+        if len(seconds) == 0:
+            return []
+        key = column("key")
+        kept = column("kind") != _DROP
+        if self._shard_count > 1:
+            shards = np.array([flow_shard(fid, self._shard_count)
+                               for fid in keys], np.int64)
+            kept &= shards[np.maximum(key, 0)] == self._shard
+
+        # the Observer's packet clock advances with every packet, so the
+        # flows are divided as it would only if the packets with flow
+        # records are never older than the clock
+        clock = np.maximum.accumulate(seconds)
+        if seconds[0] <= 0 or not np.array_equal(seconds[kept], clock[kept]):
+            return None
+
+        # packets are sorted by flow key, keeping them in order within each
+        # key, so that each flow is a run of packets
+        position = np.flatnonzero(kept)
+        if len(position) == 0:
+            return []
+        order = position[np.argsort(key[position], kind="stable")]
+        packets = {name: column(name)[order] for name in (
+            "key", "direction", "size", "tc", "proto", "sp", "dp", "tcp",
+            "flags", "payload_len", "udp", "udp_zero")}
+        packets["seconds"] = seconds[order]
+        starts = self._divide(packets)
+
+        # where each packet came from, for the addresses of the first packets
+        source = np.concatenate([np.full(len(frame.start), number, np.int64)
+                                 for (number, frame) in enumerate(frames)])
+        local = np.concatenate([np.arange(len(frame.start))
+                                for frame in frames])
+        firsts = order[starts]
+        lasts = order[np.append(starts[1:], len(order)) - 1]
+        columns = self._reduce(packets, starts)
+        if "sip" in columns:
+            for (name, dst) in (("sip", False), ("dip", True)):
+                columns[name] = [
+                    frames[frame].address(i, dst) for (frame, i) in zip(
+                        source[firsts].tolist(), local[firsts].tolist())]
+
+        names = [field.name for field in flow_fields(self._chains)]
+        flows = [dict(zip(names, values))
+                 for values in zip(*[columns[name] for name in names])]
+        return [flows[i] for i in np.argsort(lasts, kind="stable").tolist()]
+
+    def _divide(self, packets):
+        """
+        Divide the packets of each flow key into flows, as the Observer's
+        idle and expiry timers would.
+
+        :returns: the position of the first packet of each flow
+        """
+
+        seconds = packets["seconds"]
+        key = packets["key"]
+        n = len(seconds)
+        tick = np.ceil(seconds).astype(np.int64)
+        expiry = math.ceil(self._expiry_timeout)
+
+        first = np.ones(n, bool)
+        first[1:] = key[1:] != key[:-1]
+        group_start = np.flatnonzero(first)
+        group = np.cumsum(first) - 1
+        group_end = np.append(group_start[1:], n)
+
+        # a flow is completed by the idle timer before a packet if the clock
+        # has reached the idle deadline after the previous packet
+        idle_deadline = np.zeros(n, np.int64)
+        idle_deadline[1:] = np.ceil(seconds[:-1] +
+                                    self._idle_timeout).astype(np.int64)
+        next_idle = _next_true(~first & (tick >= idle_deadline))
+
+        # a TCP flow is completed by TCPChain once FINs have been seen in
+        # both directions, or a RST in either
+        if TCPChain in self._chains:
+            tcp = packets["tcp"]
+            flags = packets["flags"]
+            forward = packets["direction"] == 0
+            fin = tcp & (flags & TCP_FIN != 0)
+            next_fin_fwd = _next_true(fin & forward)
+            next_fin_rev = _next_true(fin & ~forward)
+            next_rst = _next_true(tcp & (flags & TCP_RST != 0))
+
+        # flows end at the first packet once the expiry timer has fired,
+        # found by searching the ticks of the packets of each key
+        base = tick.min()
+        span = int(tick.max() - base) + 2
+        ticks = group * span + (tick - base)
+
+        # the first flows of every key are found together, then the second
+        # flows of the keys that have more than one, and so on
+        starts = []
+        (start, end, groups) = (group_start, group_end, np.arange(
+            len(group_start)))
+        never = n + 1
+        while len(start):
+            starts.append(start)
+            idle = next_idle[start + 1]
+            idle = np.where(idle < end, idle, never)
+            if TCPChain in self._chains:
+                done = np.minimum(next_rst[start],
+                                  np.maximum(next_fin_fwd[start],
+                                             next_fin_rev[start]))
+                done = np.where(done < end, done, never)
+            else:
+                done = np.full(len(start), never)
+            by_idle = idle <= done
+            completed = (idle < never) | (done < never)
+            deadline = np.where(
+                by_idle, idle_deadline[np.minimum(idle, n - 1)],
+                tick[np.minimum(done, n - 1)]) + expiry
+            after = np.searchsorted(
+                ticks, groups * span + np.clip(deadline - base, 0, span - 1))
+            after = np.where(completed, np.minimum(after, end), end)
+            more = after < end
+            (start, end, groups) = (after[more], end[more], groups[more])
+        return np.sort(np.concatenate(starts))
+
+    def _reduce(self, packets, starts):
+        """
+        Compute the fields of the chains for each flow.
+
+        :returns: the values of each field, by field name
+        """
+
+        # pylint: disable=too-many-locals,too-many-statements
+        n = len(packets["seconds"])
+        lengths = np.diff(np.append(starts, n))
+        lasts = starts + lengths - 1
+        first_of = np.repeat(starts, lengths)
+        rev = packets["direction"] != packets["direction"][first_of]
+        fwd = ~rev
+        tcp = packets["tcp"]
+        flags = packets["flags"]
+        syn = tcp & (flags & TCP_SYN != 0)
+
+        def count(mask):
+            return np.add.reduceat(mask.astype(np.int64), starts)
+
+        def any_(mask):
+            return (count(mask) > 0).tolist()
+
+        def last(mask, values, convert=None):
+            at = _prev_true(mask)[lasts]
+            found = at >= starts
+            values = values[np.maximum(at, 0)].tolist()
+            if convert is not None:
+                values = [convert(value) for value in values]
+            return [value if has else None
+                    for (value, has) in zip(values, found.tolist())]
+
+        columns = {
+            "pkt_first": packets["seconds"][starts].tolist(),
+            "pkt_last": packets["seconds"][lasts].tolist(),
+        }
+
+        if BasicChain in self._chains:
+            size = packets["size"]
+            columns.update({
+                # addresses are filled in from the first packets later
+                "sip": None,
+                "dip": None,
+                "proto": packets["proto"][starts].tolist(),
+                "sp": [None if port < 0 else port
+                       for port in packets["sp"][starts].tolist()],
+                "dp": [None if port < 0 else port
+                       for port in packets["dp"][starts].tolist()],
+                "pkt_fwd": count(fwd).tolist(),
+                "pkt_rev": count(rev).tolist(),
+                "oct_fwd": np.add.reduceat(np.where(fwd, size, 0),
+                                           starts).tolist(),
+                "oct_rev": np.add.reduceat(np.where(rev, size, 0),
+                                           starts).tolist(),
+            })
+
+        if TCPChain in self._chains:
+            # the 3WHS completes with a forward ACK once a forward SYN and a
+            # reverse SYN-ACK have been seen, the last SYN in each direction
+            # being the one recorded
+            syn_fwd = _prev_true(syn & fwd)
+            syn_rev = _prev_true(syn & rev)
+            connected = (tcp & fwd & (flags & TCP_ACK != 0) &
+                         (syn_fwd >= first_of) & (syn_rev >= first_of) &
+                         (flags[np.maximum(syn_rev, 0)] & TCP_SA == TCP_SA))
+            fin = tcp & (flags & TCP_FIN != 0)
+            rst = tcp & (flags & TCP_RST != 0)
+            columns.update({
+                "tcp_synflags_fwd": last(syn & fwd, flags),
+                "tcp_synflags_rev": last(syn & rev, flags),
+                # TCPChain records a FIN in the reverse direction as
+                # tcp_fin_fwd, and in the forward direction as tcp_fin_rev
+                "tcp_fin_fwd": any_(fin & rev),
+                "tcp_fin_rev": any_(fin & fwd),
+                "tcp_rst_fwd": any_(rst & fwd),
+                "tcp_rst_rev": any_(rst & rev),
+                "tcp_connected": any_(connected),
+            })
+
+        if ECNChain in self._chains:
+            ecn = packets["tc"] & 0x03
+            for (direction, dmask) in (("fwd", fwd), ("rev", rev)):
+                for (kind, kmask) in (("syn", syn), ("data", ~syn)):
+                    for (mark, value) in _ECN_MARKS:
+                        name = "ecn_{}_{}_{}".format(mark, kind, direction)
+                        columns[name] = any_((ecn == value) & kmask & dmask)
+
+        if DSCPChain in self._chains:
+            dscp = packets["tc"] >> 2
+            # DSCPChain records the DSCP of the last SYN, and the first
+            # non-zero DSCP of a non-TCP packet or a TCP packet with payload
+            data = ~tcp | (~syn & (packets["payload_len"] != 0))
+            for (direction, dmask) in (("fwd", fwd), ("rev", rev)):
+                columns["dscp_mark_syn_" + direction] = last(syn & dmask, dscp)
+                marked = _next_true(data & dmask & (dscp != 0))[starts]
+                seen = count(data & dmask) > 0
+                values = dscp[np.minimum(marked, n - 1)]
+                columns["dscp_mark_data_" + direction] = [
+                    (value if at <= end else 0) if has else None
+                    for (value, at, end, has) in zip(
+                        values.tolist(), marked.tolist(), lasts.tolist(),
+                        seen.tolist())]
+
+        if UDPChain in self._chains:
+            udp = packets["udp"]
+            zero = packets["udp_zero"]
+            columns["udp_zero_checksum_fwd"] = last(udp & fwd, zero)
+            columns["udp_zero_checksum_rev"] = last(udp & rev, zero)
+
+        return columns
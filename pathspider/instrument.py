@@ -0,0 +1,165 @@
+"""
+.. module:: pathspider.instrument
+   :synopsis: Timing instrumentation for Observer chain functions
+
+This module contains the instrumentation used by the Observer to find out
+where its time goes. When enabled, each chain function in the Observer's
+dispatch tables is wrapped to count its calls and record the time taken by
+each call in a histogram. The wrappers are only installed when the
+instrumentation is enabled, so there is no cost to chain dispatch otherwise.
+
+.. codeauthor:: Iain R. Learmonth <irl@fsfe.org>
+
+"""
+
+import time
+
+try:
+    _clock_ns = time.perf_counter_ns
+except AttributeError: # Python < 3.7
+    def _clock_ns():
+        return int(time.perf_counter() * 1e9)
+
+
+class HookStats:
+    """
+    Call count and timing statistics for one chain function.
+
+    Call times are recorded in a histogram with a bucket for each power of
+    two nanoseconds, so percentiles are accurate to within a factor of two.
+    """
+
+    __slots__ = ("chain", "hook", "calls", "total", "buckets")
+
+    def __init__(self, chain, hook):
+        """
+        :param chain: the name of the chain
+        :type chain: str
+        :param hook: the name of the chain function
+        :type hook: str
+        """
+
+        self.chain = chain
+        self.hook = hook
+        self.calls = 0
+        self.total = 0
+        self.buckets = [0] * 64
+
+    def add(self, elapsed):
+        """
+        Record a call.
+
+        :param elapsed: the time taken by the call in nanoseconds
+        :type elapsed: int
+        """
+
+        self.calls += 1
+        self.total += elapsed
+        self.buckets[min(elapsed.bit_length(), 63)] += 1
+
+    def percentile(self, percent):
+        """
+        Get an upper bound for a percentile of the call times.
+
+        :param percent: the percentile, between 0 and 100
+        :type percent: float
+        :returns: the upper bound in nanoseconds, or 0 if there were no calls
+        :rtype: int
+        """
+
+        target = self.calls * percent / 100
+        seen = 0
+        for (bucket, count) in enumerate(self.buckets):
+            seen += count
+            if count and seen >= target:
+                return 1 << bucket
+        return 0
+
+
+def timed(fn, stats):
+    """
+    Wrap a chain function to record its calls.
+
+    :param fn: the chain function
+    :type fn: callable
+    :param stats: the statistics to record the calls in
+    :type stats: pathspider.instrument.HookStats
+    :rtype: callable
+    """
+
+    clock = _clock_ns
+    add = stats.add
+
+    def timed_fn(*args, **kwargs):
+        start = clock()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            add(clock() - start)
+
+    return timed_fn
+
+
+class Instrumentation:
+    """
+    Timing statistics for the chain functions of an Observer.
+    """
+
+    def __init__(self, interval):
+        """
+        :param interval: the time in seconds between periodic reports
+        :type interval: float
+        """
+
+        self.interval = interval
+        self.hooks = []
+        self._next_report = time.monotonic() + interval
+
+    def wrap(self, chain, hook, fn):
+        """
+        Wrap a chain function to record its calls.
+
+        :param chain: the chain instance
+        :type chain: pathspider.chains.base.Chain
+        :param hook: the name of the chain function
+        :type hook: str
+        :param fn: the bound chain function
+        :type fn: callable
+        :rtype: callable
+        """
+
+        stats = HookStats(type(chain).__name__, hook)
+        self.hooks.append(stats)
+        return timed(fn, stats)
+
+    def due(self):
+        """
+        Check whether a periodic report is due, and if so schedule the next.
+
+        :rtype: bool
+        """
+
+        now = time.monotonic()
+        if now < self._next_report:
+            return False
+        self._next_report = now + self.interval
+        return True
+
+    def log(self, logger):
+        """
+        Log the statistics for each chain function that has been called,
+        slowest in total first.
+
+        :param logger: the logger to use
+        :type logger: logging.Logger
+        """
+
+        for stats in sorted(self.hooks, key=lambda s: s.total, reverse=True):
+            if stats.calls == 0:
+                continue
+            logger.info("%s.%s: %u calls, %.3f s total, %.1f us mean, "
+                        "p50 <= %.1f us, p99 <= %.1f us",
+                        stats.chain, stats.hook, stats.calls,
+                        stats.total / 1e9, stats.total / stats.calls / 1e3,
+                        stats.percentile(50) / 1e3,
+                        stats.percentile(99) / 1e3)
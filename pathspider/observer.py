@@ -1,71 +1,504 @@
 import collections
+import ipaddress
+import json
 import logging
-import base64
+import multiprocessing as mp
 import queue
 import math
+import os
+import threading
+import time
+import zlib
 
 from pathspider.base import SHUTDOWN_SENTINEL
+from pathspider.chains.base import Chain
+from pathspider.chains.base import Field
+from pathspider.chains.base import RETIRE
+from pathspider.chains.context import PacketContext
+from pathspider.records import record_class
+from pathspider.timers import TimingWheel
 
 
-def _flow4_ids(ip):
+# ICMP types carrying a quotation of the packet that caused them
+ICMP4_WITH_PAYLOAD = frozenset((3, 4, 5, 11, 12))
+ICMP6_WITH_PAYLOAD = frozenset((1, 2, 3, 4))
+
+# IP protocols whose headers start with a source and destination port
+PROTOS_WITH_PORTS = frozenset((6, 17, 132, 136))
+
+# Seed for the flow hash used to sample flows while overloaded, so that the
+# sample is independent of the sharding of flows
+OVERLOAD_SAMPLE_SEED = 0x5bd1e995
+
+# The maximum number of keys of flows the merger is waiting for that are
+# remembered until the flows complete
+EARLY_KEYS = 65536
+
+# The shortest time in seconds between checks for a partial batch of flows
+# to pass on while a live packet source is quiet
+FLUSH_TICK = 0.05
+
+
+def _flow_key(src, dst, proto, ports):
+    """
+    Build the canonical key for a flow from the endpoints of a packet.
+
+    The key is the protocol number followed by the lesser endpoint (address
+    and port) and then the greater endpoint, so both directions of a flow map
+    to the same key. The direction bit is 0 if the packet was sent from the
+    lesser endpoint and 1 otherwise.
+
+    :param src: the source address
+    :type src: bytes-like object
+    :param dst: the destination address
+    :type dst: bytes-like object
+    :param proto: the IP protocol number
+    :type proto: bytes
+    :param ports: the first four bytes of the transport header, or an empty
+                  value for protocols without ports
+    :type ports: bytes
+    :returns: the flow key and the direction bit
+    :rtype: tuple(bytes, int)
+    """
+
+    if ports:
+        src = b"".join((src, ports[0:2]))
+        dst = b"".join((dst, ports[2:4]))
+    else:
+        src = bytes(src)
+        dst = bytes(dst)
+    if src <= dst:
+        return (b"".join((proto, src, dst)), 0)
+    else:
+        return (b"".join((proto, dst, src)), 1)
+
+
+def _flow4_key(ip):
     # FIXME keep map of fragment IDs to keys (#144)
 
-    icmp_with_payload = {3, 4, 5, 11, 12}
-    quotation_fid = False
-    if ip.proto == 1 and ip.icmp.type in icmp_with_payload:
+    quotation = False
+    if ip.proto == 1 and ip.icmp.type in ICMP4_WITH_PAYLOAD:
         if ip.icmp.payload is not None and len(ip.icmp.payload.data) >= 20:
             ip = ip.icmp.payload
-            quotation_fid = True
+            quotation = True
 
-    protos_with_ports = {6, 17, 132, 136}
-    if ip.proto in protos_with_ports:
+    hdr = ip.data
+    if hdr[9] in PROTOS_WITH_PORTS:
         # key includes ports
-        fid = ip.src_prefix.addr + ip.dst_prefix.addr + ip.data[
-            9:10] + ip.payload[0:4]
-        rid = ip.dst_prefix.addr + ip.src_prefix.addr + ip.data[
-            9:10] + ip.payload[2:4] + ip.payload[0:2]
+        (key, direction) = _flow_key(hdr[12:16], hdr[16:20], hdr[9:10],
+                                     ip.payload[0:4])
     else:
         # no ports, just 3-tuple
-        fid = ip.src_prefix.addr + ip.dst_prefix.addr + ip.data[9:10]
-        rid = ip.dst_prefix.addr + ip.src_prefix.addr + ip.data[9:10]
-
-    if quotation_fid:
-        # If the fid is based on an ICMP quotation, need to be reversed
-        return (base64.b64encode(rid), base64.b64encode(fid))
-    else:
-        return (base64.b64encode(fid), base64.b64encode(rid))
+        (key, direction) = _flow_key(hdr[12:16], hdr[16:20], hdr[9:10], None)
 
+    # If the key is based on an ICMP quotation, the direction is reversed
+    return (key, direction ^ quotation)
 
-def _flow6_ids(ip6):
-    icmp_with_payload = {1, 2, 3, 4}
-    quotation_fid = False
 
-    if ip6.proto == 58 and ip6.icmp6.type in icmp_with_payload:
+def _flow6_key(ip6):
+    quotation = False
+    if ip6.proto == 58 and ip6.icmp6.type in ICMP6_WITH_PAYLOAD:
         if ip6.icmp6.payload is not None and len(ip6.icmp6.payload.data) >= 40:
             ip6 = ip6.icmp6.payload
-            quotation_fid = True
+            quotation = True
 
-    protos_with_ports = {6, 17, 132, 136}
-    if ip6.proto in protos_with_ports:
+    hdr = ip6.data
+    if ip6.proto in PROTOS_WITH_PORTS:
         # key includes ports
-        fid = ip6.src_prefix.addr + ip6.dst_prefix.addr + ip6.data[
-            6:7] + ip6.payload[0:4]
-        rid = ip6.dst_prefix.addr + ip6.src_prefix.addr + ip6.data[
-            6:7] + ip6.payload[2:4] + ip6.payload[0:2]
+        (key, direction) = _flow_key(hdr[8:24], hdr[24:40], hdr[6:7],
+                                     ip6.payload[0:4])
     else:
         # no ports, just 3-tuple
-        fid = ip6.src_prefix.addr + ip6.dst_prefix.addr + ip6.data[6:7]
-        rid = ip6.dst_prefix.addr + ip6.src_prefix.addr + ip6.data[6:7]
+        (key, direction) = _flow_key(hdr[8:24], hdr[24:40], hdr[6:7], None)
 
-    if quotation_fid:
-        # If the fid is based on an ICMP quotation, need to be reversed
-        return (base64.b64encode(rid), base64.b64encode(fid))
-    else:
-        return (base64.b64encode(fid), base64.b64encode(rid))
+    # If the key is based on an ICMP quotation, the direction is reversed
+    return (key, direction ^ quotation)
+
+
+def flow_fields(chains, overload=False, interface=False):
+    """
+    Get the fields of the flow records emitted by an Observer using the given
+    chains, in the order they appear in the records.
+
+    :param chains: the chains (or chain classes) used by the Observer
+    :type chains: list
+    :param overload: True if the Observer sheds load when overloaded, and so
+                     marks the flows observed while it was overloaded
+    :type overload: bool
+    :param interface: True if the Observer merges several packet sources,
+                      and so tags each flow with the interface it was seen on
+    :type interface: bool
+    :rtype: list(pathspider.chains.base.Field)
+    """
+
+    return ([Field("pkt_first", float, None)] +
+            [field for chain in chains for field in chain.fields] +
+            [Field("pkt_last", float, None)] +
+            ([Field("observer_overload", bool, False)] if overload else []) +
+            ([Field("interface", str, None)] if interface else []))
+
+
+def _packet_source(lturis, packet_source=None):
+    """
+    Get the module providing the packet sources for the given libtrace URIs:
+    python-libtrace, or the pure Python packet sources in
+    :mod:`pathspider.traces` (which read capture files, and capture from
+    ``ring:`` URIs). Unless libtrace is asked for, ``ring:`` URIs are always
+    read with the pure Python packet sources.
+    """
+
+    if packet_source not in (None, "libtrace", "python"):
+        raise ValueError("Unknown packet source " + repr(packet_source))
+    from pathspider import traces
+    if packet_source is None and all(traces.is_ring(lturi)
+                                     for lturi in lturis):
+        packet_source = "python"
+    if packet_source != "python":
+        try:
+            # Only import this when needed
+            import plt
+            return plt
+        except ImportError:
+            if packet_source == "libtrace":
+                raise
+    for lturi in lturis:
+        if not traces.supports(lturi):
+            raise ValueError("Cannot read " + repr(lturi) + " without "
+                             "python-libtrace")
+    return traces
+
+
+def flow_shard(key, shard_count):
+    """
+    Map a flow to an Observer shard.
+
+    Flow keys are direction-normalised, so both directions of a flow (and
+    ICMP messages quoting it) are mapped to the same shard.
+    :func:`zlib.crc32` is used rather than :func:`hash` so that the mapping is
+    stable across processes.
+
+    :param key: the flow key
+    :type key: bytes
+    :param shard_count: the number of shards
+    :type shard_count: int
+    :rtype: int
+    """
+
+    return zlib.crc32(key) % shard_count
+
+
+def packet_shard(pkt, shard_count):
+    """
+    Map a packet to the Observer shard that tracks its flow.
+
+    Packets that no Observer tracks a flow for (non-IP packets, and packets
+    too short to build a flow key from) are mapped to shard 0, so that they
+    are still counted once.
+
+    :param pkt: the packet
+    :type pkt: plt.packet or pathspider.traces.packet.Packet
+    :param shard_count: the number of shards
+    :type shard_count: int
+    :rtype: int
+    """
+
+    try:
+        if pkt.ip:
+            (key, _) = _flow4_key(pkt.ip)
+        elif pkt.ip6:
+            (key, _) = _flow6_key(pkt.ip6)
+        else:
+            return 0
+    except ValueError:
+        return 0
+    return flow_shard(key, shard_count)
+
+
+def _key_addresses(key):
+    """
+    Get the two addresses from a flow key built by :func:`_flow_key`.
+
+    :param key: the flow key
+    :type key: bytes
+    :returns: the lesser and greater endpoint addresses
+    :rtype: tuple(bytes, bytes)
+    """
+
+    alen = 4 if len(key) < 33 else 16
+    plen = (len(key) - 1) // 2 - alen
+    return (key[1:1 + alen], key[1 + alen + plen:1 + 2 * alen + plen])
+
+
+def _key_ports(key):
+    """
+    Get the two ports from a flow key built by :func:`_flow_key`.
+
+    :param key: the flow key
+    :type key: bytes
+    :returns: the ports of the lesser and greater endpoints, or None if the
+              flow's protocol has no ports
+    :rtype: tuple(int, int)
+    """
+
+    alen = 4 if len(key) < 33 else 16
+    plen = (len(key) - 1) // 2 - alen
+    if not plen:
+        return None
+    return (int.from_bytes(key[1 + alen:1 + alen + plen], "big"),
+            int.from_bytes(key[-plen:], "big"))
+
+
+def _shed_record(key, direction, pt):
+    """
+    Build the record passed on for a flow that was shed while the Observer
+    was overloaded, from its flow key. The record has the addresses, protocol
+    and ports of the flow, as set by
+    :class:`pathspider.chains.basic.BasicChain`, so that it can be merged
+    with the job that created the flow.
+    """
+
+    alen = 4 if len(key) < 33 else 16
+    plen = (len(key) - 1) // 2 - alen
+    lesser = key[1:1 + alen + plen]
+    greater = key[1 + alen + plen:]
+    (src, dst) = (lesser, greater) if direction == 0 else (greater, lesser)
+    return {
+        'pkt_first': pt,
+        'sip': str(ipaddress.ip_address(src[:alen])),
+        'dip': str(ipaddress.ip_address(dst[:alen])),
+        'proto': key[0],
+        'sp': int.from_bytes(src[alen:], "big") if plen else None,
+        'dp': int.from_bytes(dst[alen:], "big") if plen else None,
+        'pkt_last': pt,
+        'observer_shed': True,
+    }
+
+
+class AddressFilter:
+    """
+    A set of addresses shared between a Spider and its Observer processes.
+
+    The Spider adds the address of each target before connecting to it and
+    removes it again once it no longer expects packets for new flows to or
+    from that address. The Observer checks packets that do not belong to a
+    tracked flow against the filter, and does not create flow records for
+    unrelated traffic.
+
+    This is a counting Bloom filter held in shared memory: an address may be
+    added more than once (e.g. for concurrent jobs with the same target), and
+    is only removed when it has been discarded as many times as it was added.
+    Membership tests may give false positives, causing some unrelated flows to
+    be tracked, but never false negatives.
+
+    :param size: The number of counters in the filter
+    :type size: int
+    """
+
+    def __init__(self, size=65536):
+        self._size = size
+        self._counts = mp.RawArray('I', size)
+        self._lock = threading.Lock()
+
+    def _indices(self, addr):
+        return (zlib.crc32(addr) % self._size,
+                zlib.crc32(addr, 0x9e3779b9) % self._size)
+
+    def add(self, addr):
+        """
+        Add an address to the filter.
+
+        :param addr: the address
+        :type addr: str
+        """
+
+        with self._lock:
+            for index in self._indices(ipaddress.ip_address(addr).packed):
+                self._counts[index] += 1
+
+    def discard(self, addr):
+        """
+        Remove an address that was previously added to the filter.
+
+        :param addr: the address
+        :type addr: str
+        """
+
+        with self._lock:
+            for index in self._indices(ipaddress.ip_address(addr).packed):
+                if self._counts[index] > 0:
+                    self._counts[index] -= 1
+
+    def __contains__(self, addr):
+        """
+        Test if a packed address may be in the filter.
+
+        :param addr: the address in network byte order
+        :type addr: bytes
+        """
+
+        (first, second) = self._indices(addr)
+        return self._counts[first] > 0 and self._counts[second] > 0
+
+    def match_key(self, key):
+        """
+        Test if either endpoint of a flow key may be in the filter.
+
+        :param key: the flow key
+        :type key: bytes
+        :rtype: bool
+        """
+
+        (first, second) = _key_addresses(key)
+        return first in self or second in self
+
+
+class IgnoredFlows:
+    """
+    A bounded table of the flows that chains have asked the Observer to
+    ignore.
+
+    Flows are kept in the order they were last seen. A flow is forgotten once
+    no packet has been seen for it for ``timeout`` seconds of packet time, or
+    when the table is full and a flow is ignored that was not seen more
+    recently, so the memory used stays bounded however long the Observer
+    runs. A forgotten flow will be offered to the chains again if it sends
+    another packet.
+
+    :param size: The maximum number of flows in the table
+    :type size: int
+    :param timeout: The time in seconds after the last packet of an ignored
+                    flow that it is forgotten
+    :type timeout: float
+    """
+
+    def __init__(self, size=65536, timeout=30):
+        self._size = size
+        self._timeout = timeout
+        self._flows = collections.OrderedDict()
+        #: The number of flows forgotten because the table was full
+        self.evicted = 0
+        #: The number of flows forgotten because they were idle
+        self.expired = 0
+
+    def add(self, fid, pt):
+        """
+        Ignore a flow.
+
+        :param fid: the flow key
+        :type fid: bytes
+        :param pt: the packet time
+        :type pt: float
+        """
+
+        flows = self._flows
+        flows[fid] = pt
+        flows.move_to_end(fid)
+        while len(flows) > self._size:
+            flows.popitem(last=False)
+            self.evicted += 1
+
+    def seen(self, fid, pt):
+        """
+        Check if a flow is ignored, and if so note that it has been seen.
+
+        :param fid: the flow key
+        :type fid: bytes
+        :param pt: the packet time
+        :type pt: float
+        :returns: True if the flow is ignored
+        :rtype: bool
+        """
+
+        flows = self._flows
+        if fid not in flows:
+            return False
+        flows[fid] = pt
+        flows.move_to_end(fid)
+        return True
+
+    def expire(self, pt):
+        """
+        Forget the flows that have been idle for longer than the timeout.
+
+        :param pt: the packet time
+        :type pt: float
+        """
+
+        flows = self._flows
+        horizon = pt - self._timeout
+        while flows:
+            (fid, last) = next(iter(flows.items()))
+            if last > horizon:
+                break
+            del flows[fid]
+            self.expired += 1
+
+    def clear(self):
+        """
+        Forget all ignored flows.
+        """
+
+        self._flows.clear()
+
+    def __contains__(self, fid):
+        return fid in self._flows
+
+    def __len__(self):
+        return len(self._flows)
 
 
 PacketClockTimer = collections.namedtuple("PacketClockTimer", ("time", "fn"))
 
+#: The chain functions called for the packets of a flow, for each hook,
+#: leaving out the chains that do not apply to the flow or have retired from
+#: it. ``skipped`` has a bit set for each of these chains, in chain order. The
+#: plan is for packets in the forward direction, and ``reverse`` holds the
+#: functions called for packets in the reverse direction.
+DispatchPlan = collections.namedtuple("DispatchPlan", (
+    "skipped", "new_flow", "ip4", "ip6", "icmp4", "icmp6", "tcp", "udp",
+    "ip_hooks", "transport_hooks", "reverse"))
+
+
+class FlowMatch:
+    """
+    Matches flow records on the values of their fields, for choosing the
+    flows whose packets are written by the Observer.
+
+    A flow record matches if any of the conditions holds. Conditions are
+    given as ``FIELD=VALUE`` expressions, with the value in JSON (e.g.
+    ``tcp_connected=false`` or ``dp=443``). A value that is not valid JSON
+    is taken to be a string.
+
+    :param expressions: the conditions
+    :type expressions: list(str)
+    :raises ValueError: if a condition has no field name
+    """
+
+    def __init__(self, expressions):
+        self.conditions = []
+        for expression in expressions:
+            (field, sep, value) = expression.partition("=")
+            if not field or not sep:
+                raise ValueError("Expected FIELD=VALUE, not " +
+                                 repr(expression))
+            try:
+                value = json.loads(value)
+            except ValueError:
+                pass
+            self.conditions.append((field, value))
+
+    def __call__(self, flow):
+        """
+        Test if a flow record matches any of the conditions.
+
+        :param flow: the flow record
+        :type flow: dict
+        :rtype: bool
+        """
+
+        return any(field in flow and flow[field] == value
+                   for (field, value) in self.conditions)
+
 
 class Observer:
     """
@@ -76,48 +509,315 @@ class Observer:
     """
 
     def __init__(self, lturi, chains=None, idle_timeout=30, expiry_timeout=5,
-                 aggregate=False):
+                 aggregate=False, shard=0, shard_count=1, address_filter=None,
+                 batch_size=100, flush_interval=1, stats_interval=None,
+                 packet_source=None, ignored_size=65536, overload_lag=None,
+                 overload_backlog=None, overload_sample=0,
+                 overload_filter=None, idle_tick=None, early_queue=None,
+                 early_key=("dip", "sp"), merge=False, pcap_writer=None,
+                 pcap_flows=None, pcap_match=None, pcap_packets=32,
+                 pcap_memory=1 << 24):
         """
         Create an Observer.
 
+        :param lturi: The libtrace URI of the packet source, or a list of
+                      URIs of capture files to be read in turn as one
+                      continuous capture (e.g. files rotated by the capture
+                      tool, in the order they were written). On Linux,
+                      a ``ring:`` URI (e.g. ``ring:eth0``) captures from
+                      the named interface through a memory-mapped
+                      AF_PACKET ring, see
+                      :class:`pathspider.traces.ring.RingTrace`.
+        :type lturi: str or list(str)
         :param chains: Array of Observer chain classes
+        :param aggregate: When True, or given an aggregator, the Observer
+                          keeps no flow records. Instead it summarises the
+                          packets it sees in fixed memory, passing on a
+                          summary for each interval of packet time in place
+                          of flow records, for monitoring a link over long
+                          periods. See
+                          :class:`pathspider.aggregate.Aggregator`.
+        :type aggregate: bool or pathspider.aggregate.Aggregator
+        :param shard: The shard of the flow space handled by this Observer
+        :type shard: int
+        :param shard_count: The total number of Observer shards. When greater
+                            than 1, only flows whose symmetric flow hash
+                            falls into ``shard`` are tracked, and packets for
+                            all other flows are skipped. The shards of
+                            a ``ring:`` capture instead join a PACKET_FANOUT
+                            group, and the kernel delivers each flow to one
+                            shard only. ICMP messages quoting a flow may
+                            then be delivered to another shard than the
+                            flow, and are not matched to the flow.
+        :type shard_count: int
+        :param address_filter: When given, flow records are only created for
+                               flows to or from an address in the filter.
+                               Packets of other flows are skipped.
+        :type address_filter: pathspider.observer.AddressFilter
+        :param batch_size: The maximum number of flows passed on together by
+                           :meth:`run_flow_enqueuer`
+        :type batch_size: int
+        :param flush_interval: The maximum time in seconds a flow is held
+                               waiting for a batch to fill. For live packet
+                               sources this is checked by a timer, so that
+                               flows are passed on while no packets are
+                               being received.
+        :type flush_interval: float
+        :param stats_interval: When given, the calls to each chain function
+                               are counted and timed, and these statistics
+                               are logged along with the sizes of the flow
+                               tables every ``stats_interval`` seconds and
+                               when the Observer finishes. Instrumentation
+                               slows down chain dispatch, and is disabled by
+                               default.
+        :type stats_interval: float
+        :param packet_source: ``"libtrace"`` to read packets with
+                              python-libtrace, or ``"python"`` to read
+                              capture files with the pure Python packet
+                              source in :mod:`pathspider.traces`. By default,
+                              libtrace is used if it is installed.
+        :type packet_source: str
+        :param ignored_size: The maximum number of flows that chains have
+                             asked to be ignored that are remembered. Ignored
+                             flows are also forgotten after ``idle_timeout``
+                             seconds without a packet.
+        :type ignored_size: int
+        :param overload_lag: When given, the Observer is overloaded while the
+                             time of the packets it is processing lags the
+                             wall clock by more than ``overload_lag`` seconds.
+                             This is only useful for live packet sources.
+        :type overload_lag: float
+        :param overload_backlog: When given, the Observer is overloaded while
+                                 more than ``overload_backlog`` batches of
+                                 flows are waiting in the flow queue.
+        :type overload_backlog: int
+        :param overload_sample: The fraction of new flows, chosen by flow
+                                hash, that are tracked while the Observer is
+                                overloaded. Other new flows are shed: they
+                                are counted and ignored, and a record marked
+                                with ``observer_shed`` is passed on for each
+                                so that the merger knows it was not observed.
+        :type overload_sample: float
+        :param overload_filter: New flows to or from an address in this
+                                filter are always tracked while the Observer
+                                is overloaded. When given, the records for
+                                shed flows are not passed on, as only flows
+                                unrelated to the Spider's jobs are shed.
+        :type overload_filter: pathspider.observer.AddressFilter
+        :param idle_tick: When given, the packet clock is advanced using the
+                          wall clock if no packet has been received for
+                          ``idle_tick`` seconds, so that completed flows are
+                          passed on without waiting for another packet. This
+                          is only used for live packet sources, whose
+                          packets are timestamped with the wall clock, and
+                          is ignored when reading capture files. It requires
+                          a packet source that allows other threads to run
+                          while it waits for packets.
+        :type idle_tick: float
+        :param early_queue: A queue on which the merger sends the keys of
+                            the flows it is waiting for. A completed flow
+                            with one of these keys is passed on as soon as it
+                            is complete, marked with ``observer_early``,
+                            rather than after the expiry timeout. If further
+                            packets are seen for the flow before it expires,
+                            it is passed on again marked with
+                            ``observer_update``.
+        :type early_queue: queue.Queue or multiprocessing.Queue
+        :param early_key: The fields of the flow record that make up the
+                          keys sent on ``early_queue``
+        :type early_key: tuple(str)
+        :param merge: When True, the packet sources given by ``lturi`` are
+                      read at once rather than in turn, and their packets
+                      are merged in timestamp order into one flow table, as
+                      for capturing on several interfaces of a multi-homed
+                      host. Each flow record is tagged with the name of the
+                      interface (or capture file) that its first packet was
+                      seen on, in the ``interface`` field. This requires the
+                      pure Python packet sources in
+                      :mod:`pathspider.traces`, so live capture is only
+                      possible with ``ring:`` URIs.
+        :type merge: bool
+        :param pcap_writer: When given, the first packets of each flow are
+                            kept while the flow is tracked, and written with
+                            this writer when the flow is passed on, for
+                            looking into odd results after a measurement
+                            without running a second capture.
+        :type pcap_writer: pathspider.traces.pcap.PcapWriter
+        :param pcap_flows: When given, packets are only kept for new flows to
+                           or from an address in this filter, i.e. the flows
+                           of the Spider's jobs
+        :type pcap_flows: pathspider.observer.AddressFilter
+        :param pcap_match: When given, the packets of a flow are only written
+                           if this returns True for the flow record when it
+                           is passed on, otherwise they are discarded
+        :type pcap_match: callable
+        :param pcap_packets: The maximum number of packets kept for each flow
+        :type pcap_packets: int
+        :param pcap_memory: The maximum number of bytes of packets kept for
+                            all flows together. Packets are not kept while
+                            the limit is reached.
+        :type pcap_memory: int
         :see also: :ref:`Observer Documentation <observer>`
         """
 
-        # Only import this when needed
-        import plt as libtrace
-
         # Control
         self._irq = None
         self._irq_fired = False
-        self._aggregate = aggregate
 
-        # Libtrace initialization
-        self._trace = libtrace.trace(lturi)  # pylint: disable=no-member
-        self._trace.start()
+        # Aggregate statistics in place of flow records
+        self._aggregator = None
+        if aggregate is not False:
+            from pathspider.aggregate import Aggregator
+            self._aggregator = (aggregate if isinstance(aggregate, Aggregator)
+                                else Aggregator())
+
+        # Sharding
+        if not 0 <= shard < shard_count:
+            raise ValueError("Observer shard must be in the range "
+                             "0 <= shard < shard_count")
+        self._shard = shard
+        self._shard_count = shard_count
+
+        # Filtering
+        self._address_filter = (None if self._aggregator is not None
+                                else address_filter)
+
+        # Overload shedding, the overload state is checked as the packet
+        # clock advances
+        self._overload_lag = overload_lag
+        self._overload_backlog = overload_backlog
+        self._overload = self._aggregator is None and (
+            overload_lag is not None or overload_backlog is not None)
+        self._overload_sample = int(overload_sample * 2**32)
+        self._overload_filter = overload_filter
+        self._overloaded = False
+        self._flowqueue = None
+
+        # Libtrace initialization, further traces are opened when the
+        # current one is exhausted
+        self._lturis = collections.deque(
+            [lturi] if isinstance(lturi, str) else lturi)
+        if not self._lturis:
+            raise ValueError("Observer needs at least one libtrace URI")
+        from pathspider import traces
+        live = all(traces.is_live(lturi) for lturi in self._lturis)
+        self._merge = merge
+        if merge:
+            if packet_source == "libtrace":
+                raise ValueError("Merging packet sources requires the pure "
+                                 "Python packet sources")
+            packet_source = "python"
+        libtrace = self._libtrace = _packet_source(self._lturis,
+                                                   packet_source)
+        self._drops = 0
+
+        # The shards of a capture ring share the packets seen on the
+        # interface through a PACKET_FANOUT group. All shards are created by
+        # the same process before the observer processes are started.
+        self._fanout = None
+        self._shard_check = shard_count > 1
+        if shard_count > 1 and getattr(libtrace, "is_ring", None) and any(
+                libtrace.is_ring(lturi) for lturi in self._lturis):
+            self._fanout = os.getpid() & 0xffff
+            self._shard_check = False
+
+        self._trace = self._open_trace()
         self._pkt = libtrace.packet()  # pylint: disable=no-member
 
-        # Chains of functions to evaluate
+        # Chains of functions to evaluate, sharing facts decoded from each
+        # packet through the packet context
         chains = chains if chains is not None else []
         self._chains = [chain() for chain in chains]
-
-        # Packet timer and bintables
+        self._ctx = PacketContext(self._pkt)
+        for chain in self._chains:
+            chain.ctx = self._ctx
+
+        # Instrumentation of the chain functions
+        self._instrumentation = None
+        if stats_interval is not None:
+            from pathspider.instrument import Instrumentation
+            self._instrumentation = Instrumentation(stats_interval)
+
+        # Per-hook dispatch tables, and the dispatch plans for flows that
+        # chains do not apply to or have retired from
+        self._chain_bits = {}
+        self._plans = {}
+        self._applies = tuple(
+            (1 << index, chain.protocols, chain.ports)
+            for (index, chain) in enumerate(self._chains)
+            if chain.protocols is not None or chain.ports is not None)
+        for chain in self._chains:
+            if chain.direction not in (None, "fwd", "rev"):
+                raise ValueError("Invalid chain direction " +
+                                 repr(chain.direction))
+        self._forward_only = sum(1 << index for (index, chain)
+                                 in enumerate(self._chains)
+                                 if chain.direction == "fwd")
+        self._reverse_only = sum(1 << index for (index, chain)
+                                 in enumerate(self._chains)
+                                 if chain.direction == "rev")
+        self._new_flow_chains = self._get_chains(
+            "new_flow", [c for c in self._chains
+                         if type(c).new_flow is not Chain.new_flow])
+        self._ip4_chains = self._get_chains("ip4")
+        self._ip6_chains = self._get_chains("ip6")
+        self._icmp4_chains = self._get_chains("icmp4")
+        self._icmp6_chains = self._get_chains("icmp6")
+        self._tcp_chains = self._get_chains("tcp")
+        self._udp_chains = self._get_chains("udp")
+
+        # Flow record class with the fields declared by the chains
+        self._record = record_class(
+            flow_fields(self._chains, self._overload, merge) +
+            [Field("_kdir", int, 0), Field("_plan", DispatchPlan,
+                                           self._dispatch_plan(0))] +
+            ([Field("_pcap", list, None)] if pcap_writer is not None else []))
+        if self._aggregator is not None:
+            self._aggregator.set_fields(flow_fields(self._chains))
+
+        # Packet timer and timing wheels
         self._ptq = 0  # current packet timer, quantized
-        self._idle_bins = {}  # map bin number to set of fids
-        self._expiry_bins = {}  # map bin number to set of fids
         self._idle_timeout = idle_timeout
         self._expiry_timeout = expiry_timeout
         self._bin_quantum = 1
+        self._idle_timers = TimingWheel()
+        self._expiry_timers = TimingWheel()
 
         #self._tq = []                  # packet timer queue (heap)
 
         # Flow tables
         self._active = {}
         self._expiring = {}
-        self._ignored = set()
+        self._ignored = IgnoredFlows(ignored_size, idle_timeout)
 
-        # Emitter queue
+        # Emitter queue and batching
         self._emitted = collections.deque()
+        self._batch = []
+        self._batch_deadline = 0
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+
+        # Wall clock ticks while the packet source is quiet, which would
+        # corrupt the packet clock of a capture file
+        self._live = live
+        self._idle_tick = idle_tick if live else None
+
+        # Early emission of the flows the merger is waiting for, the keys
+        # are checked as the packet clock advances
+        self._early_queue = early_queue
+        self._early_key = early_key
+        self._early_wanted = collections.OrderedDict()
+        self._early_expiring = {}
+        # whether each flow passed on early has seen packets since
+        self._early_emitted = {}
+
+        # Packets kept for each flow until it is passed on
+        self._pcap_writer = pcap_writer
+        self._pcap_flows = pcap_flows
+        self._pcap_match = pcap_match
+        self._pcap_packets = pcap_packets
+        self._pcap_memory = pcap_memory
+        self._pcap_bytes = 0
 
         # Statistics and logging
         self._logger = logging.getLogger("observer")
@@ -126,6 +826,16 @@ class Observer:
         self._ct_shortkey = 0
         self._ct_ignored = 0
         self._ct_flow = 0
+        self._ct_othershard = 0
+        self._ct_filtered = 0
+        self._ct_shed = 0
+        self._ct_overload = 0
+        self._ct_early = 0
+        self._ct_update = 0
+        self._ct_pcap_skipped = 0
+        self._ct_pcap_flows = 0
+        self._ct_summary = 0
+        self._ct_retired = 0
 
     def _interrupted(self):
         if not self._irq_fired and self._irq is not None:
@@ -137,29 +847,150 @@ class Observer:
 
         return self._irq_fired
 
-    def _get_chains(self, name):
-        return [
-            c.__getattribute__(name) for c in self._chains if hasattr(c, name)
-        ]
+    def _get_chains(self, name, chains=None):
+        """
+        Resolve the bound chain functions implementing a hook, in chain order.
+        This is done once when the Observer is created rather than for every
+        packet. When instrumentation is enabled, the functions are wrapped to
+        record their calls.
+        """
+
+        chains = self._chains if chains is None else chains
+        fns = [(c, c.__getattribute__(name))
+               for c in chains if hasattr(c, name)]
+        if self._instrumentation is not None:
+            fns = [(c, self._instrumentation.wrap(c, name, fn))
+                   for (c, fn) in fns]
+        for (c, fn) in fns:
+            self._chain_bits[fn] = 1 << self._chains.index(c)
+        return tuple(fn for (_, fn) in fns)
+
+    def _dispatch_plan(self, skipped):
+        """
+        Get the dispatch plan for flows that the chains with the given bits
+        set do not apply to or have retired from. Plans are only created once
+        for each set of skipped chains.
+
+        :param skipped: the bits of the skipped chains
+        :type skipped: int
+        :rtype: DispatchPlan
+        """
+
+        plan = self._plans.get(skipped)
+        if plan is None:
+            def hooks(skipped):
+                def active(fns):
+                    return tuple(fn for fn in fns
+                                 if not self._chain_bits[fn] & skipped)
+                (ip4, ip6, icmp4, icmp6, tcp, udp) = (
+                    active(self._ip4_chains), active(self._ip6_chains),
+                    active(self._icmp4_chains), active(self._icmp6_chains),
+                    active(self._tcp_chains), active(self._udp_chains))
+                return (ip4, ip6, icmp4, icmp6, tcp, udp,
+                        bool(ip4 or ip6 or icmp4 or icmp6), bool(tcp or udp))
+            new_flow = tuple(fn for fn in self._new_flow_chains
+                             if not self._chain_bits[fn] & skipped)
+            reverse = DispatchPlan(
+                skipped, new_flow, *hooks(skipped | self._forward_only),
+                reverse=None)
+            plan = self._plans[skipped] = DispatchPlan(
+                skipped, new_flow, *hooks(skipped | self._reverse_only),
+                reverse=reverse)
+        return plan
+
+    def _flow_plan(self, fid):
+        """
+        Get the dispatch plan for a new flow, leaving out the chains that do
+        not apply to the flow's protocol or ports.
+
+        :param fid: the flow key
+        :type fid: bytes
+        :rtype: DispatchPlan
+        """
+
+        skipped = 0
+        ports = _key_ports(fid)
+        for (bit, protocols, chain_ports) in self._applies:
+            if protocols is not None and fid[0] not in protocols:
+                skipped |= bit
+            elif chain_ports is not None and (
+                    ports is None or (ports[0] not in chain_ports and
+                                      ports[1] not in chain_ports)):
+                skipped |= bit
+        return self._dispatch_plan(skipped)
+
+    def _chain_done(self, rec, fn, result):
+        """
+        Handle a chain function returning something other than True, retiring
+        the chain from the flow if it returned
+        :data:`pathspider.chains.base.RETIRE`.
+
+        :returns: True if the flow is to be completed
+        :rtype: bool
+        """
+
+        if result is RETIRE:
+            # pylint: disable=protected-access
+            rec._plan = self._dispatch_plan(
+                rec._plan.skipped | self._chain_bits[fn])
+            self._ct_retired += 1
+            return False
+        return not result
+
+    def _open_trace(self):
+        # pylint: disable=no-member
+        if self._merge:
+            # all of the packet sources are read at once. each ring joins its
+            # own fanout group, as a group only spans one interface.
+            lturis = list(self._lturis)
+            self._lturis.clear()
+            trace = self._libtrace.MergedTrace(
+                [self._open_source(lturi, index)
+                 for (index, lturi) in enumerate(lturis)],
+                [lturi.partition(":")[2] for lturi in lturis])
+        else:
+            trace = self._open_source(self._lturis.popleft())
+        trace.start()
+        return trace
 
-    def _next_packet(self):
-        # Import only when needed
-        import plt as libtrace
+    def _open_source(self, lturi, index=0):
+        # pylint: disable=no-member
+        if self._fanout is not None and self._libtrace.is_ring(lturi):
+            return self._libtrace.trace(
+                lturi, fanout=(self._fanout + index) & 0xffff)
+        return self._libtrace.trace(lturi)
 
+    def _pkt_drops(self):
+        return self._drops + self._trace.pkt_drops()
+
+    def _read_packet(self):
         # see if someone told us to stop
         if self._interrupted():
             return False
 
-        # see if we're done iterating
-        if not self._trace.read_packet(self._pkt):
-            return False
+        # see if we're done iterating, moving on to the next trace if there
+        # is one
+        while not self._trace.read_packet(self._pkt):
+            if not self._lturis:
+                return False
+            self._drops += self._trace.pkt_drops()
+            self._trace.close()
+            self._trace = self._open_trace()
 
-        # count the packet
+        return True
+
+    def _process_packet(self):
+        # count the packet, and forget anything decoded from the last one
         self._ct_pkt += 1
+        self._ctx.reset()
 
         # advance the packet clock
         self._tick(self._pkt.seconds)
 
+        if self._aggregator is not None:
+            self._aggregate_packet()
+            return
+
         # get a flow ID and associated flow record for the packet
         (fid, rec, rev) = self._get_flow()
 
@@ -167,41 +998,136 @@ class Observer:
         # (this happens for non-IP packets and flows
         #  we know we want to ignore)
         if not rec:
-            return True
-
-        keep_flow = True
+            return
 
-        # run IP header chains
-        if self._pkt.ip:
-            for fn in self._get_chains("ip4"):
-                keep_flow = keep_flow and fn(rec, self._pkt.ip, rev=rev)
-            if self._pkt.icmp:
-                for fn in self._get_chains("icmp4"):
-                    q = self._pkt.icmp.payload # pylint: disable=no-member
-                    keep_flow = keep_flow and fn(rec, self._pkt.ip, q, rev=rev)
-
-        elif self._pkt.ip6:
-            for fn in self._get_chains("ip6"):
-                keep_flow = keep_flow and fn(rec, self._pkt.ip6, rev=rev)
-            if self._pkt.icmp6:
-                for fn in self._get_chains("icmp6"):
-                    q = self._pkt.icmp6.payload # pylint: disable=no-member
-                    keep_flow = keep_flow and fn(
-                        rec, self._pkt.ip6, q, rev=rev)
-
-        # run transport header chains
-        if self._pkt.tcp:
-            for fn in self._get_chains("tcp"):
-                keep_flow = keep_flow and fn(rec, self._pkt.tcp, rev=rev)
-        elif self._pkt.udp:
-            for fn in self._get_chains("udp"):
-                keep_flow = keep_flow and fn(rec, self._pkt.udp, rev=rev)
+        # keep the packet if the flow's packets are being kept
+        if (self._pcap_writer is not None and
+                rec._pcap is not None): # pylint: disable=protected-access
+            self._keep_packet(rec)
 
         # complete the flow if any chain function asked us to
-        if not keep_flow:
+        if not self._dispatch(rec, rev):
             self._flow_complete(fid)
 
-        # we processed a packet, keep going
+    def _aggregate_packet(self):
+        """
+        Add the current packet to the aggregate statistics. The packet is
+        passed to the chains in a new record, as a flow of its own, so no
+        state is kept for each flow.
+        """
+
+        pkt = self._pkt
+        try:
+            if pkt.ip:
+                ip = pkt.ip
+                (fid, direction) = _flow4_key(ip)
+            elif pkt.ip6:
+                ip = pkt.ip6
+                (fid, direction) = _flow6_key(ip)
+            else:
+                self._ct_nonip += 1
+                return
+        except ValueError:
+            self._ct_shortkey += 1
+            return
+        self._ctx.ip = ip
+
+        if (self._shard_check and
+                flow_shard(fid, self._shard_count) != self._shard):
+            self._ct_othershard += 1
+            return
+
+        rec = self._record()
+        rec.pkt_first = rec.pkt_last = ip.seconds
+        if self._applies:
+            rec._plan = self._flow_plan(fid) # pylint: disable=protected-access
+        for fn in rec._plan.new_flow: # pylint: disable=protected-access
+            if not fn(rec, ip):
+                self._ct_ignored += 1
+                return
+        self._dispatch(rec, self._aggregator.reverse(fid, direction))
+
+        # the summary is passed on once a packet is seen after its interval
+        if self._aggregator.due(ip.seconds):
+            self._emit_summary()
+        self._aggregator.add(fid, ip, rec)
+
+    def _emit_summary(self):
+        self._emitted.append(self._aggregator.summary())
+        self._ct_summary += 1
+
+    def _dispatch(self, rec, rev):
+        """
+        Pass the current packet to the chain functions for each of its
+        headers, following the flow's dispatch plan. Hook families that no
+        chain implements are skipped without inspecting the packet, and
+        chains that do not apply to the flow or to packets in this direction,
+        or that have retired from the flow, are not called.
+
+        :returns: False as soon as any chain function asks for the flow to be
+                  completed (no further chain functions are called for the
+                  packet), otherwise True
+        """
+
+        # pylint: disable=protected-access
+        pkt = self._pkt
+        plan = rec._plan.reverse if rev else rec._plan
+
+        # run IP header chains
+        if plan.ip_hooks:
+            ip = pkt.ip
+            if ip:
+                for fn in plan.ip4:
+                    done = fn(rec, ip, rev=rev)
+                    if done is not True and self._chain_done(rec, fn, done):
+                        return False
+                if plan.icmp4:
+                    icmp = pkt.icmp
+                    if icmp:
+                        q = icmp.payload # pylint: disable=no-member
+                        for fn in plan.icmp4:
+                            done = fn(rec, ip, q, rev=rev)
+                            if (done is not True and
+                                    self._chain_done(rec, fn, done)):
+                                return False
+            else:
+                ip6 = pkt.ip6
+                if ip6:
+                    for fn in plan.ip6:
+                        done = fn(rec, ip6, rev=rev)
+                        if (done is not True and
+                                self._chain_done(rec, fn, done)):
+                            return False
+                    if plan.icmp6:
+                        icmp6 = pkt.icmp6
+                        if icmp6:
+                            q = icmp6.payload # pylint: disable=no-member
+                            for fn in plan.icmp6:
+                                done = fn(rec, ip6, q, rev=rev)
+                                if (done is not True and
+                                        self._chain_done(rec, fn, done)):
+                                    return False
+            # chains may have retired from the flow
+            plan = rec._plan.reverse if rev else rec._plan
+
+        # run transport header chains, the TCP header is shared with the
+        # chains through the packet context
+        if plan.transport_hooks:
+            tcp = self._ctx.tcp
+            if tcp:
+                for fn in plan.tcp:
+                    done = fn(rec, tcp, rev=rev)
+                    if done is not True and self._chain_done(rec, fn, done):
+                        return False
+            elif plan.udp:
+                udp = pkt.udp
+                if udp:
+                    for fn in plan.udp:
+                        done = fn(rec, udp, rev=rev)
+                        if (done is not True and
+                                self._chain_done(rec, fn, done)):
+                            return False
+
         return True
 
     # def _set_timer(self, delay, fid):
@@ -214,16 +1140,14 @@ class Observer:
         Get a flow record for the given packet.
         Create a new basic flow record
         """
-        # get possible a flow IDs for the packet
+        # get the canonical flow key and direction for the packet
         try:
             if self._pkt.ip:
-                (ffid, rfid) = (4, 5) if self._aggregate else _flow4_ids(
-                    self._pkt.ip)
                 ip = self._pkt.ip
+                (fid, direction) = _flow4_key(ip)
             elif self._pkt.ip6:
-                (ffid, rfid) = (4, 5) if self._aggregate else _flow6_ids(
-                    self._pkt.ip6)
                 ip = self._pkt.ip6
+                (fid, direction) = _flow6_key(ip)
             else:
                 # we don't care about non-IP packets
                 self._ct_nonip += 1
@@ -232,132 +1156,325 @@ class Observer:
             self._ct_shortkey += 1
             return (None, None, False)
 
-        # now look for forward and reverse in ignored, active,
-        # and expiring tables.
-        if ffid in self._ignored:
-            return (None, None, False)
-        elif rfid in self._ignored:
+        # the IP header is shared with the chains through the packet context
+        self._ctx.ip = ip
+
+        # skip flows belonging to other shards
+        if (self._shard_check and
+                flow_shard(fid, self._shard_count) != self._shard):
+            self._ct_othershard += 1
             return (None, None, False)
-        elif ffid in self._active:
-            (fid, rec, active) = (ffid, self._active[ffid], True)
-            #self._logger.debug("found forward flow for "+str(ffid))
-        elif ffid in self._expiring:
-            (fid, rec, active) = (ffid, self._expiring[ffid], False)
-            #self._logger.debug("found expiring forward flow for "+str(ffid))
-        elif rfid in self._active:
-            (fid, rec, active) = (rfid, self._active[rfid], True)
-            #self._logger.debug("found reverse flow for "+str(rfid))
-        elif rfid in self._expiring:
-            (fid, rec, active) = (rfid, self._expiring[rfid], False)
-            #self._logger.debug("found expiring reverse flow for "+str(rfid))
-        else:
-            # nowhere to be found. new flow.
-            rec = {'pkt_first': ip.seconds, '_idle_bin': 0}
-            for fn in self._get_chains("new_flow"):
-                if not fn(rec, ip):
-                    # self._logger.debug("ignoring "+str(ffid))
-                    self._ignored.add(ffid)
-                    self._ct_ignored += 1
+
+        # now look for the flow in the active, expiring and ignored tables.
+        rec = self._active.get(fid)
+        if rec is None:
+            rec = self._expiring.get(fid)
+            if rec is not None:
+                if fid in self._early_emitted:
+                    # the flow was passed on early, so is passed on again
+                    # when it expires
+                    self._early_emitted[fid] = True
+            else:
+                if self._ignored.seen(fid, ip.seconds):
                     return (None, None, False)
 
-            # wasn't vetoed. add to active table.
-            fid = ffid
-            self._active[ffid] = rec
-            active = True
-            # self._logger.debug("new flow for "+str(ffid))
-            self._ct_flow += 1
+                # skip flows unrelated to the Spider's jobs
+                if (self._address_filter is not None and
+                        not self._address_filter.match_key(fid)):
+                    self._ct_filtered += 1
+                    return (None, None, False)
 
-        # update time and idle bin and return record
-        rec['pkt_last'] = ip.seconds
+                # shed new flows while overloaded
+                if self._overloaded and self._shed(fid, direction, ip.seconds):
+                    return (None, None, False)
 
-        # update idle bin if we're not expiring
-        if active:
-            new_idle_bin = math.ceil((rec['pkt_last'] + self._idle_timeout) /
-                                     self._bin_quantum) * self._bin_quantum
+                # nowhere to be found. new flow.
+                rec = self._record()
+                rec.pkt_first = ip.seconds
+                rec._kdir = direction # pylint: disable=protected-access
+                if self._overloaded:
+                    rec.observer_overload = True
+                if self._merge:
+                    rec.interface = self._trace.name
+                if self._pcap_writer is not None and (
+                        self._pcap_flows is None or
+                        self._pcap_flows.match_key(fid)):
+                    rec._pcap = [] # pylint: disable=protected-access
+
+                # chains that do not apply to the flow are left out of its
+                # dispatch plan
+                # pylint: disable=protected-access
+                if self._applies:
+                    rec._plan = self._flow_plan(fid)
+                for fn in rec._plan.new_flow:
+                    if not fn(rec, ip):
+                        # self._logger.debug("ignoring "+str(fid))
+                        self._ignored.add(fid, ip.seconds)
+                        self._ct_ignored += 1
+                        return (None, None, False)
+
+                # wasn't vetoed. add to active table and start idle timer.
+                self._active[fid] = rec
+                self._idle_timers.schedule(
+                    self._quantize(ip.seconds + self._idle_timeout), fid)
+                # self._logger.debug("new flow for "+str(fid))
+                self._ct_flow += 1
+
+        # update time and return record. the idle timer checks pkt_last
+        # when it fires, so doesn't need to be moved here.
+        rec.pkt_last = ip.seconds
+
+        return (fid, rec,
+                direction != rec._kdir) # pylint: disable=protected-access
+
+    def _shed(self, fid, direction, pt):
+        """
+        Decide whether to shed a new flow while the Observer is overloaded.
+        Shed flows are ignored until they go idle.
 
-            if new_idle_bin > rec["_idle_bin"]:
+        :returns: True if the flow was shed
+        """
 
-                if rec['_idle_bin'] in self._idle_bins:
-                    self._idle_bins[rec['_idle_bin']] -= set((fid, ))
-                if new_idle_bin in self._idle_bins:
-                    self._idle_bins[new_idle_bin] |= set((fid, ))
-                else:
-                    self._idle_bins[new_idle_bin] = set((fid, ))
+        if (self._overload_filter is not None and
+                self._overload_filter.match_key(fid)):
+            return False
+        if zlib.crc32(fid, OVERLOAD_SAMPLE_SEED) < self._overload_sample:
+            return False
+
+        self._ct_shed += 1
+        self._ignored.add(fid, pt)
+        if self._overload_filter is None:
+            # this may be the flow for a job
+            self._emitted.append(_shed_record(fid, direction, pt))
+        return True
+
+    def _emit_early(self, fid, rec):
+        """
+        Pass on a completed flow before it expires, remembering it so that
+        it can be passed on again when it does expire if any more packets
+        are seen for it.
+        """
+
+        self._early_emitted[fid] = False
+        self._emit_flow(rec)
+        self._emitted[-1]['observer_early'] = True
+        self._ct_early += 1
+
+    def _expire_early(self, fid, rec):
+        """
+        Emit an expired flow when early emission is enabled. A flow that was
+        already passed on early is only passed on again if packets were seen
+        for it since.
+        """
+
+        key = tuple(rec[field] for field in self._early_key)
+        if self._early_expiring.get(key) == fid:
+            del self._early_expiring[key]
+        if fid not in self._early_emitted:
+            self._emit_flow(rec)
+        elif self._early_emitted.pop(fid):
+            self._emit_flow(rec)
+            self._emitted[-1]['observer_update'] = True
+            self._ct_update += 1
+
+    def _check_early(self):
+        """
+        Read the keys of the flows the merger is waiting for, passing on
+        matching flows that have already completed. Keys for flows that have
+        not completed yet are remembered until the flows complete, up to a
+        limit.
+        """
+
+        while True:
+            try:
+                key = self._early_queue.get_nowait()
+            except queue.Empty:
+                break
+            fid = self._early_expiring.pop(key, None)
+            if fid is not None and fid not in self._early_emitted:
+                rec = self._expiring.get(fid)
+                if rec is not None:
+                    self._emit_early(fid, rec)
+                    continue
+            self._early_wanted[key] = True
+            if len(self._early_wanted) > EARLY_KEYS:
+                self._early_wanted.popitem(last=False)
+
+    def _check_overload(self, pt):
+        """
+        Enter or leave the overloaded state. The Observer leaves the
+        overloaded state once the lag and backlog have fallen below half of
+        their thresholds.
+        """
+
+        lag = time.time() - pt
+        backlog = 0
+        if self._overload_backlog is not None and self._flowqueue is not None:
+            try:
+                backlog = self._flowqueue.qsize()
+            except NotImplementedError:
+                pass
 
-                rec['_idle_bin'] = new_idle_bin
+        scale = 0.5 if self._overloaded else 1
+        overloaded = ((self._overload_lag is not None and
+                       lag > self._overload_lag * scale) or
+                      (self._overload_backlog is not None and
+                       backlog > self._overload_backlog * scale))
+        if overloaded == self._overloaded:
+            return
 
-        return (fid, rec, bool(fid == rfid))
+        self._overloaded = overloaded
+        if overloaded:
+            self._ct_overload += 1
+            self._logger.warning("observer overloaded (%.1f s behind, %u "
+                                 "batches waiting), shedding new flows",
+                                 lag, backlog)
+            # packets may be lost for flows already being observed
+            for rec in self._active.values():
+                rec.observer_overload = True
+        else:
+            self._logger.warning("observer no longer overloaded, %u flows "
+                                 "shed so far", self._ct_shed)
 
     def _flow_complete(self, fid):
         """
         Mark a given flow ID as complete
         """
         # skip all of this unless the flow is still in the active table
-        if fid not in self._active:
+        rec = self._active.pop(fid, None)
+        if rec is None:
             return
 
-        # remove flow ID from idle bin
-        rec = self._active[fid]
-        self._idle_bins[rec['_idle_bin']] -= set((fid, ))
-
-        del rec['_idle_bin']
-
-        # move record to expiring table
+        # move record to expiring table and start expiry timer
         self._expiring[fid] = rec
-        del self._active[fid]
-
-        # assign expiry bin
-        expiry_bin = math.ceil((self._ptq + self._expiry_timeout) /
-                               self._bin_quantum) * self._bin_quantum
-        #self._logger.debug("Completing flow "+str(fid)+" at "+str(self._ptq)+" to expire "+str(expiry_bin)+" (in "+str(expiry_bin-self._ptq)+"s)")
+        self._expiry_timers.schedule(self._idle_timers.time + self._quantize(
+            self._expiry_timeout), fid)
+
+        # pass the flow on now if the merger is waiting for it
+        if self._early_queue is not None:
+            key = tuple(rec[field] for field in self._early_key)
+            if key in self._early_wanted:
+                del self._early_wanted[key]
+                self._emit_early(fid, rec)
+            else:
+                self._early_expiring[key] = fid
 
-        if expiry_bin in self._expiry_bins:
-            self._expiry_bins[expiry_bin] |= set((fid, ))
-        else:
-            self._expiry_bins[expiry_bin] = set((fid, ))
+    def _quantize(self, pt):
+        """
+        Convert a packet time to timing wheel ticks, rounding up.
+        """
+        return math.ceil(pt / self._bin_quantum)
 
     def _emit_flow(self, rec):
-        self._emitted.append(rec)
+        # emitted flows are plain dicts. the key direction, dispatch plan and
+        # kept packets are only needed while the flow is tracked.
+        flow = rec.to_dict()
+        del flow['_kdir']
+        del flow['_plan']
+        if self._pcap_writer is not None:
+            del flow['_pcap']
+            if rec._pcap: # pylint: disable=protected-access
+                self._write_packets(rec, flow)
+        self._emitted.append(flow)
+
+    def _keep_packet(self, rec):
+        """
+        Keep the current packet of a flow whose packets are being kept, as
+        long as neither the flow's nor the overall limit has been reached.
+        """
+
+        # pylint: disable=protected-access
+        if (len(rec._pcap) >= self._pcap_packets or
+                self._pcap_bytes >= self._pcap_memory):
+            self._ct_pcap_skipped += 1
+            return
+        ip = self._ctx.ip
+        data = bytes(ip.data[:self._pcap_writer.snaplen])
+        rec._pcap.append((ip.seconds, data))
+        self._pcap_bytes += len(data)
 
-    def _next_flow(self):
-        while len(self._emitted) == 0:
-            if not self._next_packet():
-                return None
+    def _write_packets(self, rec, flow):
+        """
+        Write the packets kept for a flow that is being passed on, if it
+        matches, and release them. Packets seen for the flow later are kept
+        and written if it is passed on again.
+        """
 
-        return self._emitted.popleft()
+        # pylint: disable=protected-access
+        if self._pcap_match is None or self._pcap_match(flow):
+            for (seconds, data) in rec._pcap:
+                self._pcap_writer.write(seconds, data)
+            self._ct_pcap_flows += 1
+        self._pcap_bytes -= sum(len(data) for (_, data) in rec._pcap)
+        rec._pcap = []
 
     def _tick(self, pt):
         # quantize and skip if we're not advancing
-        next_ptq = math.ceil(pt / self._bin_quantum) * self._bin_quantum
+        next_ptq = self._quantize(pt) * self._bin_quantum
         if next_ptq <= self._ptq:
             return
         elif self._ptq == 0:
             # handle zero case
             self._ptq = next_ptq
+            self._idle_timers.advance(self._quantize(pt))
+            self._expiry_timers.advance(self._quantize(pt))
             return
 
-        # advance quantum
-        for bint in range(self._ptq + self._bin_quantum,
-                          next_ptq + self._bin_quantum, self._bin_quantum):
-            self._logger.debug("tick: " + str(bint))
-
-            # process idle
-            if bint in self._idle_bins:
-                if len(self._idle_bins[bint]) > 0:
-                    for fid in self._idle_bins[bint].copy():
-                        self._flow_complete(fid)
-                del self._idle_bins[bint]
-
-            # process expiry
-            if bint in self._expiry_bins:
-                if len(self._expiry_bins[bint]) > 0:
-                    for fid in self._expiry_bins[bint].copy():
-                        self._emit_flow(self._expiring[fid])
-                        del self._expiring[fid]
-                del self._expiry_bins[bint]
+        # fire idle timers up to the new packet time. a flow may have more
+        # than one idle timer if its flow ID was reused after an earlier flow
+        # was completed, so timers are checked against the flow record
+        # rather than cancelled.
+        for fid in self._idle_timers.expire(self._quantize(pt)):
+            rec = self._active.get(fid)
+            if rec is None:
+                continue
+            # complete the flow if it has been idle for long enough,
+            # otherwise wait for the idle timeout again
+            idle_tick = self._quantize(rec.pkt_last + self._idle_timeout)
+            if idle_tick > self._idle_timers.time:
+                self._idle_timers.schedule(idle_tick, fid)
+            else:
+                self._flow_complete(fid)
+
+        # fire expiry timers, emitting expired flows
+        for fid in self._expiry_timers.expire(self._quantize(pt)):
+            rec = self._expiring.pop(fid, None)
+            if rec is not None:
+                if self._early_queue is None:
+                    self._emit_flow(rec)
+                else:
+                    self._expire_early(fid, rec)
+
+        # forget ignored flows that have gone idle
+        self._ignored.expire(pt)
+
+        # pass on the aggregate statistics once their interval has ended,
+        # also while the packet source is quiet
+        if self._aggregator is not None and self._aggregator.due(pt):
+            self._emit_summary()
+
+        if self._overload:
+            self._check_overload(pt)
+
+        if self._early_queue is not None:
+            self._check_early()
 
         self._ptq = next_ptq
 
+        if (self._instrumentation is not None and
+                self._instrumentation.due()):
+            self._log_stats()
+
+    def _log_stats(self):
+        self._logger.info("%u packets (%u dropped), %u active, %u expiring "
+                          "and %u ignored flows (%u evicted, %u expired), "
+                          "%u idle and %u expiry timers pending", self._ct_pkt,
+                          self._pkt_drops(), len(self._active),
+                          len(self._expiring), len(self._ignored),
+                          self._ignored.evicted, self._ignored.expired,
+                          len(self._idle_timers), len(self._expiry_timers))
+        self._instrumentation.log(self._logger)
+
     # def _tick(self, pt):
     #     # Advance packet clock
     #     self._pt = pt
@@ -390,10 +1507,18 @@ class Observer:
     #             self._flow_complete(fid)
 
     def flush(self):
+        if self._aggregator is not None and len(self._aggregator):
+            self._emit_summary()
+
         for fid in self._expiring:
-            self._emit_flow(self._expiring[fid])
+            if self._early_queue is None:
+                self._emit_flow(self._expiring[fid])
+            else:
+                self._expire_early(fid, self._expiring[fid])
             # self._logger.debug("emitted "+str(fid)+" expiring during flush")
         self._expiring.clear()
+        self._early_expiring.clear()
+        self._early_emitted.clear()
 
         for fid in self._active:
             self._emit_flow(self._active[fid])
@@ -401,29 +1526,155 @@ class Observer:
         self._active.clear()
 
         self._ignored.clear()
+        self._idle_timers.clear()
+        self._expiry_timers.clear()
+
+    def _pass_on(self, flowqueue):
+        """
+        Pass on emitted flows in batches once enough have accumulated, or
+        once the oldest has waited for the flush interval.
+        """
+
+        batch = self._batch
+        if self._emitted:
+            if not batch:
+                self._batch_deadline = time.monotonic() + self._flush_interval
+            batch.extend(self._emitted)
+            self._emitted.clear()
+            while len(batch) >= self._batch_size:
+                # any remainder was emitted by this packet
+                flowqueue.put(batch[:self._batch_size])
+                del batch[:self._batch_size]
+                self._batch_deadline = time.monotonic() + self._flush_interval
+        elif batch and time.monotonic() >= self._batch_deadline:
+            flowqueue.put(batch)
+            self._batch = []
+
+    def _run_ticker(self, flowqueue, lock, stop):
+        """
+        Pass on a partial batch of flows once the oldest has waited for the
+        flush interval, although no packets are being received. With
+        ``idle_tick``, also advance the packet clock using the wall clock
+        while no packets have been received for ``idle_tick`` seconds, so
+        that flows waiting for their timers to fire are passed on although
+        the packet source has gone quiet.
+        """
+
+        interval = max(self._flush_interval, FLUSH_TICK)
+        if self._idle_tick is not None:
+            interval = min(interval, self._idle_tick)
+        last_ct_pkt = 0
+        quiet_since = time.monotonic()
+        while not stop.wait(interval):
+            with lock:
+                now = time.monotonic()
+                if self._ct_pkt != last_ct_pkt or self._ct_pkt == 0:
+                    last_ct_pkt = self._ct_pkt
+                    quiet_since = now
+                elif (self._idle_tick is not None and
+                      now - quiet_since >= self._idle_tick):
+                    self._tick(time.time())
+                    quiet_since = now
+                if self._emitted or self._batch:
+                    self._pass_on(flowqueue)
 
     def run_flow_enqueuer(self, flowqueue, irqueue=None):
+        """
+        Observe packets until the packet source is exhausted or a shutdown
+        signal is received on ``irqueue``, passing completed flows to
+        ``flowqueue``. Flows are passed on as lists of flow records, followed
+        by :data:`pathspider.base.SHUTDOWN_SENTINEL` when the Observer has
+        finished.
+
+        :param flowqueue: The queue to pass flow batches to
+        :type flowqueue: queue.Queue or multiprocessing.Queue
+        :param irqueue: A queue on which a shutdown signal may be received
+        :type irqueue: queue.Queue or multiprocessing.Queue
+        """
+
         if irqueue:
             self._irq = irqueue
             self._irq_fired = None
-
-        # Run main loop until last packet seen
-        # then flush active flows and run again
-        for _ in range(2):
-            while True:
-                f = self._next_flow()
-                if f:
-                    flowqueue.put(f)
-                else:
-                    self.flush()
-                    break
+        self._flowqueue = flowqueue
+
+        # Pass on partial batches, and advance the packet clock by the wall
+        # clock, when no packets are being received from a live source
+        lock = None
+        if self._live:
+            lock = threading.Lock()
+            ticker_stop = threading.Event()
+            ticker = threading.Thread(target=self._run_ticker,
+                                      args=(flowqueue, lock, ticker_stop),
+                                      name="observer_ticker", daemon=True)
+            ticker.start()
+
+        # Run main loop until last packet seen, passing on emitted flows in
+        # batches once enough have accumulated or the oldest has waited for
+        # the flush interval
+        self._batch = []
+        self._batch_deadline = 0
+        while self._read_packet():
+            if lock is None:
+                self._process_packet()
+                if self._emitted or self._batch:
+                    self._pass_on(flowqueue)
+            else:
+                with lock:
+                    self._process_packet()
+                    if self._emitted or self._batch:
+                        self._pass_on(flowqueue)
+
+        if lock is not None:
+            ticker_stop.set()
+            ticker.join()
+
+        # log the final state of the flow tables before they are flushed
+        if self._instrumentation is not None:
+            self._log_stats()
+
+        # then flush active flows and pass on everything that is left
+        self.flush()
+        batch = self._batch
+        batch.extend(self._emitted)
+        self._emitted.clear()
+        for i in range(0, len(batch), self._batch_size):
+            flowqueue.put(batch[i:i + self._batch_size])
 
         # log observer info on shutdown
         self._logger.info(("processed %u packets "
                            "(%u dropped, %u short, %u non-ip) "
                            "into %u flows (%u ignored)"), self._ct_pkt,
-                          self._trace.pkt_drops(), self._ct_shortkey,
+                          self._pkt_drops(), self._ct_shortkey,
                           self._ct_nonip, self._ct_flow, self._ct_ignored)
+        if self._ct_retired:
+            self._logger.info("retired chains from flows %u times",
+                              self._ct_retired)
+        if self._aggregator is not None:
+            self._logger.info("passed on %u aggregate summaries",
+                              self._ct_summary)
+        if self._address_filter is not None:
+            self._logger.info("skipped %u packets not matching the address "
+                              "filter", self._ct_filtered)
+        if self._overload:
+            self._logger.info("overloaded %u times, shedding %u flows",
+                              self._ct_overload, self._ct_shed)
+        if self._early_queue is not None:
+            self._logger.info("passed on %u flows early, %u updated",
+                              self._ct_early, self._ct_update)
+        if self._pcap_writer is not None:
+            self._pcap_writer.close()
+            self._logger.info("wrote %u packets of %u flows to %s (%u "
+                              "packets not kept)", self._pcap_writer.packets,
+                              self._ct_pcap_flows, self._pcap_writer.path,
+                              self._ct_pcap_skipped)
+        if self._fanout is not None:
+            self._logger.info("shard %u of %u shared capture with fanout "
+                              "group %u", self._shard, self._shard_count,
+                              self._fanout)
+        elif self._shard_count > 1:
+            self._logger.info("shard %u of %u skipped %u packets for other "
+                              "shards", self._shard, self._shard_count,
+                              self._ct_othershard)
 
         flowqueue.put(SHUTDOWN_SENTINEL)
 
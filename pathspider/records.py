@@ -0,0 +1,118 @@
+"""
+.. module:: pathspider.records
+   :synopsis: Compact flow records built from chain field declarations
+
+This module contains the flow record classes used by PATHspider's Observer.
+A record class is generated for the chains in use from the fields they
+declare (see :class:`pathspider.chains.base.Field`), storing the declared
+fields in ``__slots__`` rather than in a :class:`dict` for every flow. Records
+support the item access used by chains (``rec['field']``) and are converted
+to plain dictionaries when the flow is emitted.
+
+.. codeauthor:: Iain R. Learmonth <irl@fsfe.org>
+
+"""
+
+import keyword
+
+
+class FlowRecord:
+    """
+    The base class for generated flow record classes.
+
+    Declared fields are stored in slots. Any other fields set by chains are
+    stored in a per-record dictionary that is only created when first used.
+    Reading a field that has not been set raises :class:`AttributeError`.
+    """
+
+    __slots__ = ("__dict__",)
+
+    #: The names of the declared fields
+    _fields = frozenset()
+
+    #: The names and default values of the declared fields, in order
+    _defaults = ()
+
+    __getitem__ = object.__getattribute__
+    __setitem__ = object.__setattr__
+    __delitem__ = object.__delattr__
+
+    def __init__(self):
+        for (name, default) in self._defaults:
+            object.__setattr__(self, name, default)
+
+    def __contains__(self, key):
+        if key in self._fields:
+            return hasattr(self, key)
+        return key in self.__dict__
+
+    def __repr__(self):
+        return "{}({!r})".format(type(self).__name__, self.to_dict())
+
+    def get(self, key, default=None):
+        """
+        Get the value of a field, or a default if the field is not set.
+
+        :param key: the field name
+        :type key: str
+        :param default: the value to return if the field is not set
+        """
+
+        if key in self:
+            return self[key]
+        return default
+
+    def to_dict(self):
+        """
+        Convert the record to a dictionary containing the declared fields,
+        in the order they were declared, followed by any other fields.
+
+        :rtype: dict
+        """
+
+        rec = {}
+        for (name, _) in self._defaults:
+            try:
+                rec[name] = object.__getattribute__(self, name)
+            except AttributeError:
+                # the field was deleted
+                pass
+        rec.update(self.__dict__)
+        return rec
+
+
+def record_class(fields, name="Record"):
+    """
+    Generate a flow record class with a slot for each declared field.
+
+    A field may be declared more than once (e.g. by two chains), as long as
+    each declaration has the same default value.
+
+    :param fields: the fields to be stored in the record
+    :type fields: iterable(pathspider.chains.base.Field)
+    :param name: the name of the generated class
+    :type name: str
+    :rtype: type
+    :raises ValueError: if a field name is not a valid identifier, clashes
+                        with an attribute of :class:`FlowRecord`, or is
+                        declared with different default values
+    """
+
+    defaults = {}
+    for field in fields:
+        if (not field.name.isidentifier() or keyword.iskeyword(field.name) or
+                hasattr(FlowRecord, field.name)):
+            raise ValueError("Invalid flow record field name: " +
+                             repr(field.name))
+        if field.name in defaults:
+            if defaults[field.name] != field.default:
+                raise ValueError("Flow record field " + repr(field.name) +
+                                 " declared with conflicting defaults")
+            continue
+        defaults[field.name] = field.default
+
+    return type(name, (FlowRecord, ), {
+        "__slots__": tuple(defaults),
+        "_fields": frozenset(defaults),
+        "_defaults": tuple(defaults.items()),
+    })
@@ -0,0 +1,521 @@
+"""
+.. module:: pathspider.remote
+   :synopsis: Streaming flows from a remote Observer over TCP
+
+This module allows the Observer to run on a different host to the Spider,
+such as a dedicated capture box receiving mirrored traffic. A
+:class:`FlowServer`, run by ``pspdr observe --serve``, streams the flows
+passed on by its Observers to the Spiders connected to it, and a
+:class:`RemoteObserver` takes the place of the Observer in a Spider, passing
+the flows it receives on to the merger.
+
+Flows are sent in batches, each framed by its length and a frame kind, and
+packed with a :class:`pathspider.transport.FlowCodec` before being encoded
+as JSON. Only JSON is decoded from the network, as it is safe to decode data
+from an untrusted peer. When a Spider connects it sends the addresses that it
+makes connections from, and it is then only sent the flows to or from those
+addresses, so that one capture box can serve several measurement hosts. A
+Spider that gives no addresses is only sent all of the flows if the server
+allows it. The server replies with the names of the fields of its flow
+records, so that the Spider can decode them.
+
+A server listening on an address other than a loopback address must be given
+a token, which each Spider must send when it connects. The token is shared
+by the server and the Spiders, for example through the
+``PATHSPIDER_REMOTE_TOKEN`` environment variable. Flows are not encrypted, so
+they should only be streamed over a network that is trusted not to eavesdrop
+on them.
+
+.. codeauthor:: Iain R. Learmonth <irl@fsfe.org>
+
+"""
+
+import hmac
+import ipaddress
+import json
+import logging
+import queue
+import select
+import socket
+import struct
+import threading
+import time
+
+from pathspider.base import SHUTDOWN_SENTINEL
+from pathspider.chains.base import Field
+from pathspider.transport import FlowCodec
+
+_FRAME = struct.Struct("!IB")
+
+# Frame kinds on the connection
+_BATCH = 0
+_SENTINEL = 1
+_HELLO = 2
+_FIELDS = 3
+_REFUSED = 4
+
+#: The environment variable holding the token shared by a flow server and the
+#: Spiders connecting to it
+TOKEN_ENV = "PATHSPIDER_REMOTE_TOKEN"
+
+# The largest handshake and batch frames accepted, in bytes
+REMOTE_MAX_HANDSHAKE = 2**16
+REMOTE_MAX_BATCH = 2**28
+
+# Seconds between attempts to connect to a remote observer, between checks
+# for an interrupt while waiting for flows, and allowed for the handshake
+REMOTE_RETRY = 1
+REMOTE_WAIT = 0.5
+REMOTE_HANDSHAKE = 10
+
+# Batches queued for a Spider before it is disconnected for falling behind,
+# seconds allowed for sending a batch to a Spider, and seconds allowed for
+# the Spiders to be sent their remaining flows when the server is closed
+REMOTE_CLIENT_QUEUE = 1000
+REMOTE_SEND = 30
+REMOTE_CLOSE = 10
+
+
+class HandshakeRefused(Exception):
+    """
+    Raised when a flow server refuses a Spider's connection.
+    """
+
+
+def parse_address(address):
+    """
+    Parse a ``HOST:PORT`` address, with IPv6 addresses in square brackets
+    (e.g. ``[2001:db8::1]:7000``). A port on its own is on the loopback
+    address.
+
+    :param address: the address
+    :type address: str
+    :rtype: tuple(str, int)
+    :raises ValueError: if the address has no host or port
+    """
+
+    if address.isdigit():
+        return ("127.0.0.1", int(address))
+    (host, _, port) = address.rpartition(":")
+    if not host or not port.isdigit():
+        raise ValueError("Expected HOST:PORT, not " + repr(address))
+    return (host.strip("[]"), int(port))
+
+
+def is_loopback(host):
+    """
+    Check whether a host is a loopback address.
+
+    :param host: the host name or address
+    :type host: str
+    :rtype: bool
+    """
+
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def _listen(address):
+    """
+    Create a socket listening for connections on an address.
+    """
+
+    (family, socktype, proto, _, sockaddr) = socket.getaddrinfo(
+        address[0], address[1], type=socket.SOCK_STREAM,
+        flags=socket.AI_PASSIVE)[0]
+    sock = socket.socket(family, socktype, proto)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(sockaddr)
+        sock.listen(socket.SOMAXCONN)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+def _abort(sock):
+    """
+    Shut down a socket, waking up any thread blocked sending to it or
+    receiving from it. The socket is closed by its owner.
+    """
+
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+
+def _send_frame(sock, kind, payload=b""):
+    sock.sendall(_FRAME.pack(len(payload), kind) + payload)
+
+
+def _send_json(sock, kind, obj):
+    _send_frame(sock, kind, json.dumps(obj).encode("utf-8"))
+
+
+def _decode_json(payload):
+    return json.loads(payload.decode("utf-8"))
+
+
+def _recv_exact(sock, length):
+    data = bytearray()
+    while len(data) < length:
+        chunk = sock.recv(length - len(data))
+        if not chunk:
+            raise ConnectionError("Connection closed by peer")
+        data += chunk
+    return bytes(data)
+
+
+def _recv_frame(sock, limit):
+    (length, kind) = _FRAME.unpack(_recv_exact(sock, _FRAME.size))
+    if length > limit:
+        raise ValueError("Frame of {} bytes is too long".format(length))
+    return (kind, _recv_exact(sock, length))
+
+
+class _Client:
+    """
+    A Spider connected to a :class:`FlowServer`, with the batches of flows
+    queued for it and the thread sending them.
+    """
+
+    def __init__(self, sock, peer, addresses):
+        self.sock = sock
+        self.peer = peer
+        self.addresses = addresses
+        self.batches = queue.Queue(REMOTE_CLIENT_QUEUE)
+        self.thread = None
+
+
+class FlowServer:
+    """
+    Streams batches of flow records to the Spiders connected to it.
+
+    Connections are accepted by a background thread. Flows passed to
+    :meth:`send` before any Spider has connected are discarded, as are the
+    flows that are not to or from the addresses given by a Spider when it
+    connected.
+
+    Each Spider is sent its flows by a thread of its own, from a bounded
+    queue, so that a slow Spider does not hold up the others. A Spider that
+    falls so far behind that its queue is full, or that takes longer than
+    ``REMOTE_SEND`` seconds to receive a batch, is disconnected.
+
+    .. code-block:: python
+
+     server = FlowServer(("0.0.0.0", 7000), flow_fields(chains),
+                         token=os.environ[TOKEN_ENV])
+     for batch in iter(flowqueue.get, SHUTDOWN_SENTINEL):
+         server.send(batch)
+     server.close()
+    """
+
+    def __init__(self, address, fields, token=None, allow_all=False):
+        """
+        Create a flow server listening on the given address.
+
+        :param address: the host and port to listen on
+        :type address: tuple(str, int)
+        :param fields: the fields of the flow records, as returned by
+                       :func:`pathspider.observer.flow_fields`
+        :type fields: list(pathspider.chains.base.Field)
+        :param token: The token Spiders must send when they connect.
+                      Required unless listening on a loopback address.
+        :type token: str
+        :param allow_all: Whether Spiders giving no addresses are sent all
+                          of the flows, rather than refused
+        :type allow_all: bool
+        :raises ValueError: if no token is given for an address other than a
+                            loopback address
+        """
+
+        if token is None and not is_loopback(address[0]):
+            raise ValueError("A token is required to serve flows on " +
+                             address[0])
+        self._codec = FlowCodec(fields)
+        self._token = token
+        self._allow_all = allow_all
+        self._logger = logging.getLogger("remote")
+        self._lock = threading.Lock()
+        self._clients = []
+        self._sock = _listen(address)
+        #: The host and port the server is listening on
+        self.address = self._sock.getsockname()[:2]
+        threading.Thread(target=self._accept, name="flow_server",
+                         daemon=True).start()
+
+    @property
+    def client_count(self):
+        """
+        The number of Spiders connected.
+
+        :rtype: int
+        """
+
+        with self._lock:
+            return len(self._clients)
+
+    def _accept(self):
+        while True:
+            try:
+                (sock, peer) = self._sock.accept()
+            except OSError:
+                # the server has been closed
+                return
+            try:
+                sock.settimeout(REMOTE_HANDSHAKE)
+                addresses = self._handshake(sock)
+                sock.settimeout(REMOTE_SEND)
+            except HandshakeRefused as error:
+                self._logger.warning("refused spider at %s: %s", peer[0],
+                                     error)
+                try:
+                    _send_json(sock, _REFUSED, str(error))
+                except OSError:
+                    pass
+                sock.close()
+                continue
+            except (OSError, ValueError):
+                self._logger.warning("handshake with %s failed", peer[0])
+                sock.close()
+                continue
+            client = _Client(sock, peer, addresses)
+            client.thread = threading.Thread(
+                target=self._write, args=(client,), name="flow_client",
+                daemon=True)
+            with self._lock:
+                self._clients.append(client)
+            client.thread.start()
+            self._logger.info("spider connected from %s for %d addresses",
+                              peer[0], len(addresses))
+
+    def _write(self, client):
+        """
+        Send the batches queued for a Spider until the server is closed, and
+        then close the connection.
+        """
+
+        try:
+            for batch in iter(client.batches.get, SHUTDOWN_SENTINEL):
+                _send_json(client.sock, _BATCH, self._codec.pack(batch))
+            _send_frame(client.sock, _SENTINEL)
+        except OSError:
+            with self._lock:
+                if client in self._clients:
+                    self._clients.remove(client)
+                    self._logger.warning("spider at %s disconnected",
+                                         client.peer[0])
+        finally:
+            client.sock.close()
+
+    def _handshake(self, sock):
+        """
+        Receive the hello from a Spider, and reply with the names of the
+        fields of the flow records.
+
+        :returns: the addresses the Spider is to be sent the flows for, or
+                  an empty set for all of the flows
+        :rtype: frozenset(str)
+        :raises HandshakeRefused: if the Spider gave the wrong token, or no
+                                  addresses when it may not be sent all of
+                                  the flows
+        """
+
+        (kind, payload) = _recv_frame(sock, REMOTE_MAX_HANDSHAKE)
+        if kind != _HELLO:
+            raise ValueError("Expected a hello frame")
+        hello = _decode_json(payload)
+        if not isinstance(hello, dict):
+            raise ValueError("Invalid hello frame")
+        addresses = hello.get("addresses")
+        token = hello.get("token")
+        if (not isinstance(addresses, list) or
+                not all(isinstance(addr, str) for addr in addresses) or
+                not (token is None or isinstance(token, str))):
+            raise ValueError("Invalid hello frame")
+
+        if self._token is not None and (token is None or not
+                                        hmac.compare_digest(
+                                            token.encode("utf-8"),
+                                            self._token.encode("utf-8"))):
+            raise HandshakeRefused("wrong token")
+        if not addresses and not self._allow_all:
+            raise HandshakeRefused("no addresses given")
+        _send_json(sock, _FIELDS, list(self._codec.names))
+        return frozenset(addresses)
+
+    def send(self, flows):
+        """
+        Queue a batch of flow records to be sent to the connected Spiders.
+        This does not wait for the flows to be sent. A Spider whose queue is
+        full is disconnected.
+
+        :param flows: the flow records
+        :type flows: list(dict)
+        """
+
+        with self._lock:
+            for client in list(self._clients):
+                batch = flows
+                if client.addresses:
+                    batch = [flow for flow in flows
+                             if flow.get('sip') in client.addresses or
+                             flow.get('dip') in client.addresses]
+                    if not batch:
+                        continue
+                try:
+                    client.batches.put_nowait(batch)
+                except queue.Full:
+                    self._logger.warning("spider at %s fell behind, "
+                                         "disconnecting", client.peer[0])
+                    self._clients.remove(client)
+                    _abort(client.sock)
+
+    def close(self):
+        """
+        Stop listening for connections, and tell the connected Spiders that
+        no more flows will be sent once they have been sent the flows queued
+        for them. Spiders that have not been sent their flows within
+        ``REMOTE_CLOSE`` seconds are disconnected.
+        """
+
+        # wake up the thread accepting connections
+        _abort(self._sock)
+        self._sock.close()
+        with self._lock:
+            clients = self._clients
+            self._clients = []
+        for client in clients:
+            try:
+                client.batches.put_nowait(SHUTDOWN_SENTINEL)
+            except queue.Full:
+                _abort(client.sock)
+        deadline = time.monotonic() + REMOTE_CLOSE
+        for client in clients:
+            client.thread.join(max(deadline - time.monotonic(), 0))
+            if client.thread.is_alive():
+                self._logger.warning("spider at %s did not receive all of "
+                                     "its flows", client.peer[0])
+                _abort(client.sock)
+
+
+class RemoteObserver:
+    """
+    Takes the place of an Observer in a Spider, passing on the flows
+    received from a :class:`FlowServer` on another host.
+
+    The connection is retried until it succeeds, and re-established if it is
+    lost, until the remote observer is told to stop or the server has sent
+    all of its flows.
+    """
+
+    def __init__(self, address, addresses=None, token=None):
+        """
+        Create a remote observer.
+
+        :param address: the host and port of the flow server
+        :type address: tuple(str, int)
+        :param addresses: The addresses to receive the flows for, typically
+                          the addresses the Spider makes connections from.
+                          All flows are received if this is not given and
+                          the server allows it.
+        :type addresses: list(str)
+        :param token: the token shared with the flow server
+        :type token: str
+        """
+
+        self.address = address
+        self.addresses = [addr for addr in (addresses or [])
+                          if addr is not None]
+        self.token = token
+        self._logger = logging.getLogger("remote")
+        self._irq = None
+        self._irq_fired = False
+
+    def _interrupted(self, timeout=None):
+        if not self._irq_fired and self._irq is not None:
+            try:
+                if timeout is None:
+                    self._irq.get_nowait()
+                else:
+                    self._irq.get(timeout=timeout)
+                self._irq_fired = True
+            except queue.Empty:
+                pass
+        return self._irq_fired
+
+    def run_flow_enqueuer(self, flowqueue, irqueue=None):
+        """
+        Receive flows from the flow server and put them on a queue, until
+        signalled to stop on the interrupt queue or the server has sent all
+        of its flows.
+
+        :param flowqueue: the queue to put batches of flows on
+        :param irqueue: the queue to listen for an interrupt on
+        """
+
+        self._irq = irqueue
+        while not self._interrupted():
+            try:
+                with socket.create_connection(self.address,
+                                              REMOTE_HANDSHAKE) as sock:
+                    if self._receive(sock, flowqueue):
+                        break
+            except HandshakeRefused as error:
+                # trying again would be refused again
+                self._logger.error("remote observer at %s:%d refused the "
+                                   "connection: %s", self.address[0],
+                                   self.address[1], error)
+                break
+            except (OSError, ValueError) as error:
+                self._logger.warning("remote observer at %s:%d: %s",
+                                     self.address[0], self.address[1], error)
+                if self._interrupted(REMOTE_RETRY):
+                    break
+        flowqueue.put(SHUTDOWN_SENTINEL)
+
+    def _receive(self, sock, flowqueue):
+        """
+        Receive flows on a connection to the flow server.
+
+        :returns: True once interrupted or all of the flows have been
+                  received
+        """
+
+        _send_json(sock, _HELLO, {"addresses": self.addresses,
+                                  "token": self.token})
+        (kind, payload) = _recv_frame(sock, REMOTE_MAX_HANDSHAKE)
+        if kind == _REFUSED:
+            raise HandshakeRefused(str(_decode_json(payload)))
+        if kind != _FIELDS:
+            raise ValueError("Expected the fields of the flow records")
+        names = _decode_json(payload)
+        if (not isinstance(names, list) or
+                not all(isinstance(name, str) for name in names)):
+            raise ValueError("Invalid fields of the flow records")
+        codec = FlowCodec([Field(name, None, None) for name in names])
+        sock.settimeout(None)
+        self._logger.info("connected to remote observer at %s:%d",
+                          self.address[0], self.address[1])
+
+        while not self._interrupted():
+            # frames are only read once they have started to arrive, so that
+            # an interrupt is noticed while the capture is quiet
+            if not select.select([sock], [], [], REMOTE_WAIT)[0]:
+                continue
+            (kind, payload) = _recv_frame(sock, REMOTE_MAX_BATCH)
+            if kind == _SENTINEL:
+                self._logger.info("remote observer finished")
+                return True
+            if kind == _BATCH:
+                records = _decode_json(payload)
+                if not isinstance(records, list):
+                    raise ValueError("Invalid batch of flow records")
+                flowqueue.put(codec.unpack(records))
+        return True
@@ -0,0 +1,99 @@
+import json
+
+from nose.tools import assert_equal
+from nose.tools import assert_raises
+
+from pathspider.aggregate import Aggregator
+from pathspider.aggregate import CountMinSketch
+from pathspider.aggregate import Histogram
+from pathspider.aggregate import HyperLogLog
+from pathspider.aggregate import _prefix
+from pathspider.chains.basic import BasicChain
+from pathspider.chains.dscp import DSCPChain
+from pathspider.chains.ecn import ECNChain
+from pathspider.chains.tcp import TCPChain
+from pathspider.tests.chains import ChainTestCase
+
+CHAINS = [BasicChain, TCPChain, ECNChain, DSCPChain]
+
+def test_aggregate_prefix():
+    addr = bytes((192, 0, 2, 129))
+    assert_equal(_prefix(addr, 24), bytes((192, 0, 2)))
+    assert_equal(_prefix(addr, 25), bytes((192, 0, 2, 128)))
+    assert_equal(_prefix(addr, 4), bytes((192,)))
+
+def test_aggregate_count_min():
+    sketch = CountMinSketch(width=64, depth=4)
+    for key in range(1000):
+        sketch.add(str(key).encode(), key % 7)
+    for key in range(1000):
+        # estimates are never lower than the true count
+        assert sketch.estimate(str(key).encode()) >= key % 7
+    sketch.clear()
+    assert_equal(sketch.estimate(b"1"), 0)
+
+def test_aggregate_hyperloglog():
+    sketch = HyperLogLog(precision=12)
+    for count in (10, 1000, 100000):
+        sketch.clear()
+        for key in range(count):
+            sketch.add(str(key).encode())
+            sketch.add(str(key).encode())
+        assert abs(sketch.count() - count) <= 0.05 * count
+    with assert_raises(ValueError):
+        HyperLogLog(precision=20)
+
+def test_aggregate_histogram():
+    histogram = Histogram(bins=2)
+    for value in (True, 3, 3, 7, False):
+        histogram.add(value)
+    assert_equal(histogram.to_dict(), {"3": 2, "true": 1, "other": 2})
+    histogram.clear()
+    assert_equal(histogram.to_dict(), {})
+
+class TestAggregate(ChainTestCase):
+
+    def _flows(self, trace, **kwargs):
+        self.create_observer(trace, CHAINS, **kwargs)
+        flows = self.run_observer()
+        self.observer_thread.join(3)
+        return flows
+
+    def test_aggregate_summary(self):
+        flows = self._flows("tcp_ecn.pcap")
+        (summary, ) = self._flows("tcp_ecn.pcap",
+                                  aggregate=Aggregator(interval=3600))
+
+        assert_equal(summary['packets'],
+                     sum(flow['pkt_fwd'] + flow['pkt_rev']
+                         for flow in flows))
+        assert_equal(summary['octets'],
+                     sum(flow['oct_fwd'] + flow['oct_rev']
+                         for flow in flows))
+        assert_equal(summary['flows'], len(flows))
+        assert_equal(summary['pkt_first'],
+                     min(flow['pkt_first'] for flow in flows))
+        assert_equal(summary['pkt_last'],
+                     max(flow['pkt_last'] for flow in flows))
+        assert_equal(sum(prefix['packets']
+                         for prefix in summary['prefixes']),
+                     2 * summary['packets'])
+
+        # the chains' fields are counted for each packet
+        assert_equal(summary['marks']['tcp_synflags_fwd'], {"194": 1})
+        assert_equal(summary['marks']['tcp_synflags_rev'], {"82": 1})
+        assert_equal(summary['marks']['ecn_ce_data_rev'], {"true": 52})
+        json.dumps(summary)
+
+    def test_aggregate_intervals(self):
+        (summary, ) = self._flows("icmp_ttl.pcap",
+                                  aggregate=Aggregator(interval=86400))
+        summaries = self._flows("icmp_ttl.pcap",
+                                aggregate=Aggregator(interval=60))
+        assert len(summaries) > 1
+        assert_equal(sum(part['packets'] for part in summaries),
+                     summary['packets'])
+        for (first, second) in zip(summaries, summaries[1:]):
+            assert first['pkt_last'] < second['pkt_first']
+            assert (int(first['pkt_last'] / 60) <
+                    int(second['pkt_first'] / 60))
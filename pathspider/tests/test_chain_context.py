@@ -0,0 +1,73 @@
+from unittest import mock
+
+from nose.tools import assert_equal
+
+import pathspider.chains.context
+from pathspider.chains.base import Chain
+from pathspider.chains.mss import MSSChain
+from pathspider.chains.tcp import tcp_options
+from pathspider.chains.tcpopt import TCPOptChain
+from pathspider.chains.tfo import TFOChain
+from pathspider.tests.chains import ChainTestCase
+
+class SynCountingChain(Chain):
+
+    def new_flow(self, rec, ip):
+        rec['_syns'] = 0
+        rec['_packets'] = 0
+        return True
+
+    def tcp(self, rec, tcp, rev):
+        rec['_packets'] += 1
+        if self.ctx.syn:
+            rec['_syns'] += 1
+        # the context describes the packet the chain was passed
+        assert_equal(self.ctx.syn, bool(tcp.syn_flag))
+        assert_equal(self.ctx.ack, bool(tcp.ack_flag))
+        return True
+
+class TestPacketContext(ChainTestCase):
+
+    def test_chain_context_shared(self):
+        self.create_observer("tfo_cookie_request.pcap",
+                             [SynCountingChain, TFOChain, TCPOptChain,
+                              MSSChain])
+        observer = self.observer
+        for chain in observer._chains:
+            assert chain.ctx is observer._ctx
+
+        with mock.patch.object(pathspider.chains.context, "tcp_options",
+                               side_effect=tcp_options) as parser:
+            flows = self.run_observer()
+            self.observer_thread.join(3)
+
+        assert_equal(len(flows), 1)
+        assert_equal(flows[0]['_syns'], 2)
+        assert flows[0]['_packets'] > 2
+        # the options are parsed once each for the SYN and the SYN/ACK,
+        # although three chains use them
+        assert_equal(parser.call_count, 2)
+        assert_equal(flows[0]['tfo_ackkind'], 254)
+        assert flows[0]['mss_value_fwd'] is not None
+
+    def test_chain_context_decode(self):
+        ip = mock.Mock(version=4, traffic_class=0x2e << 2 | 0x01, pkt_len=60,
+                       hdr_len=5)
+        tcp = mock.Mock(flags=0x12, doff=8)
+        pkt = mock.Mock(ip=ip, ip6=None, tcp=tcp)
+        ctx = pathspider.chains.context.PacketContext(pkt)
+
+        assert ctx.ip is ip
+        assert ctx.syn
+        assert ctx.ack
+        assert_equal(ctx.payload_len, 8)
+        assert_equal(ctx.ecn, 0x01)
+        assert_equal(ctx.dscp, 0x2e)
+
+        # values are remembered until the context is reset
+        pkt.tcp = None
+        assert ctx.syn
+        ctx.reset()
+        assert not ctx.syn
+        assert_equal(ctx.payload_len, None)
+        assert_equal(ctx.tcp_options, None)
@@ -1,10 +1,18 @@
 
+import nose
+
 from pathspider.tests.chains import ChainTestCase
 
 from pathspider.chains.dns import DNSChain
 
 class TestDNSChain(ChainTestCase):
 
+    def setUp(self):
+        try:
+            import pldns # python-libtrace may not be available
+        except ImportError:
+            raise nose.SkipTest
+
     def test_chain_dns_valid_response(self):
         test_trace = "dns_valid_response.pcap"
         self.create_observer(test_trace, [DNSChain])
@@ -0,0 +1,111 @@
+import json
+import os
+import queue
+import shutil
+import tempfile
+
+import nose
+from nose.tools import assert_equal
+
+from pathspider.base import SHUTDOWN_SENTINEL
+from pathspider.chains.basic import BasicChain
+from pathspider.chains.dscp import DSCPChain
+from pathspider.chains.ecn import ECNChain
+from pathspider.chains.mss import MSSChain
+from pathspider.chains.tcp import TCPChain
+from pathspider.chains.udp import UDPChain
+from pathspider.tests.chains import ChainTestCase
+from pathspider.traces.pcap import PcapTrace
+from pathspider.traces.pcap import PcapWriter
+
+ALL_CHAINS = [BasicChain, TCPChain, ECNChain, DSCPChain, UDPChain]
+
+TRACES = ["tcp_http.pcap", "tcp_ecn.pcap", "tcp_ipv6_ecn.pcap",
+          "tcp_ipv4_rst.pcap", "dscp_tcp_fwd3.pcap", "dscp_udp_fwd3.pcap",
+          "udp_zerochecksum.pcap", "basic_ipv6_non_udp_tcp.pcap",
+          "icmp_ttl.pcap", "ecn_ipv6_unreachable_ce_on_syn.pcap"]
+
+def _columnar_observer(*args, **kwargs):
+    try:
+        from pathspider.columnar import ColumnarObserver
+    except ImportError: # NumPy may not be available
+        raise nose.SkipTest
+    return ColumnarObserver(*args, **kwargs)
+
+def _canonical(flows):
+    return sorted(json.dumps(flow) for flow in flows)
+
+class TestColumnar(ChainTestCase):
+
+    def _expected(self, trace, chains, **kwargs):
+        self.create_observer(trace, chains, packet_source="python", **kwargs)
+        flows = self.run_observer()
+        self.observer_thread.join(3)
+        return _canonical(flows)
+
+    def _columnar(self, trace, chains, **kwargs):
+        observer = _columnar_observer(self.lturi, chains, **kwargs)
+        flows = observer.flows()
+        assert flows is not None
+        return _canonical(flows)
+
+    def test_columnar_chains(self):
+        for trace in TRACES:
+            for chains in (ALL_CHAINS, [BasicChain], [TCPChain, ECNChain],
+                           [UDPChain, DSCPChain]):
+                expected = self._expected(trace, chains)
+                assert_equal(self._columnar(trace, chains), expected)
+
+    def test_columnar_timeouts(self):
+        # flows are divided by the idle and expiry timers as the Observer
+        # would, including in each shard
+        for (idle_timeout, expiry_timeout) in ((1, 1), (2.5, 0.5), (10, 20)):
+            for shard in range(3):
+                kwargs = dict(idle_timeout=idle_timeout,
+                              expiry_timeout=expiry_timeout, shard=shard,
+                              shard_count=3)
+                expected = self._expected("icmp_ttl.pcap", ALL_CHAINS,
+                                          **kwargs)
+                assert_equal(self._columnar("icmp_ttl.pcap", ALL_CHAINS,
+                                            **kwargs), expected)
+
+    def test_columnar_files(self):
+        traces = ["tcp_ipv4_simple.pcap", "tcp_ipv6_simple.pcap"]
+        expected = self._expected(traces, ALL_CHAINS)
+        assert_equal(self._columnar(traces, ALL_CHAINS), expected)
+
+    def test_columnar_fallback(self):
+        # flows are observed with an Observer for other chains
+        expected = self._expected("mss_ipv4.pcap", [BasicChain, MSSChain])
+        observer = _columnar_observer(self.lturi, [BasicChain, MSSChain])
+        assert observer.flows() is None
+        flowqueue = queue.Queue()
+        observer.run_flow_enqueuer(flowqueue)
+        flows = [flow for batch in iter(flowqueue.get, SHUTDOWN_SENTINEL)
+                 for flow in batch]
+        assert_equal(_canonical(flows), expected)
+
+    def test_columnar_out_of_order(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            trace = PcapTrace(self._lturi("tcp_http.pcap")[5:])
+            packets = [(pkt.seconds, bytes(pkt.ip.data)) for pkt in trace]
+            trace.close()
+            (packets[3], packets[4]) = (packets[4], packets[3])
+            path = os.path.join(tmpdir, "reordered.pcap")
+            writer = PcapWriter(path)
+            for (seconds, data) in packets:
+                writer.write(seconds, data)
+            writer.close()
+
+            # the packet clock would not be followed exactly
+            expected = self._expected(path, ALL_CHAINS)
+            observer = _columnar_observer(self.lturi, ALL_CHAINS)
+            assert observer.flows() is None
+            flowqueue = queue.Queue()
+            observer.run_flow_enqueuer(flowqueue)
+            flows = [flow for batch in iter(flowqueue.get, SHUTDOWN_SENTINEL)
+                     for flow in batch]
+            assert_equal(_canonical(flows), expected)
+        finally:
+            shutil.rmtree(tmpdir)
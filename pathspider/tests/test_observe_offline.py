@@ -0,0 +1,86 @@
+
+import argparse
+import json
+import os
+import struct
+import tempfile
+
+import pkg_resources
+from nose.tools import assert_equal
+
+from pathspider.chains.basic import BasicChain
+from pathspider.chains.tcp import TCPChain
+from pathspider.cmd.observe import run_observer
+from pathspider.tests.chains import ChainTestCase
+
+def _split_pcap(source, directory, parts):
+    """
+    Split a pcap file into a number of files with about the same number of
+    packets, as a capture tool rotating its output file would.
+    """
+
+    with open(source, 'rb') as pcapfile:
+        data = pcapfile.read()
+    header = data[:24]
+    records = []
+    offset = 24
+    while offset < len(data):
+        (caplen, ) = struct.unpack_from("<I", data, offset + 8)
+        records.append(data[offset:offset + 16 + caplen])
+        offset += 16 + caplen
+
+    paths = []
+    size = -(-len(records) // parts)
+    for part in range(parts):
+        path = os.path.join(directory, "capture_{}.pcap".format(part))
+        with open(path, 'wb') as pcapfile:
+            pcapfile.write(header)
+            pcapfile.write(b"".join(records[part * size:(part + 1) * size]))
+        paths.append(path)
+    return paths
+
+class TestObserveOffline(ChainTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.TemporaryDirectory()
+        self.trace = pkg_resources.resource_filename(
+            "pathspider", "tests/data/tcp_ecn.pcap")
+        self.paths = _split_pcap(self.trace, self.directory.name, 3)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _observe(self, trace):
+        self.create_observer(trace, [BasicChain, TCPChain])
+        flows = self.run_observer()
+        super().tearDown()
+        return sorted(json.dumps(flow, sort_keys=True) for flow in flows)
+
+    def test_observe_offline_files(self):
+        # flows spanning the files are observed as one flow
+        expected = self._observe(self.trace)
+        assert_equal(self._observe(self.paths), expected)
+
+    def test_observe_offline_partitions(self):
+        outputs = []
+        # the three files are split for up to three partitions, and the
+        # partitions are picked out by sharding for four
+        for jobs in (1, 2, 3, 4):
+            output = os.path.join(self.directory.name,
+                                  "flows_{}.ndjson".format(jobs))
+            run_observer(argparse.Namespace(
+                list_chains=False, chains=["basic", "tcp"],
+                read=[os.path.join(self.directory.name, "capture_*.pcap")],
+                jobs=jobs, output=output, observer_stats=None))
+            with open(output) as outputfile:
+                outputs.append(outputfile.read())
+        for output in outputs[1:]:
+            assert_equal(output, outputs[0])
+
+        flows = [json.loads(line) for line in outputs[0].splitlines()]
+        assert_equal(sorted(json.dumps(flow, sort_keys=True)
+                            for flow in flows),
+                     self._observe(self.trace))
+        pkt_first = [flow['pkt_first'] for flow in flows]
+        assert_equal(pkt_first, sorted(pkt_first))
@@ -0,0 +1,86 @@
+
+from nose.tools import assert_equal
+from nose.tools import assert_raises
+
+from pathspider.chains.base import Chain
+from pathspider.chains.base import Field
+from pathspider.chains.basic import BasicChain
+from pathspider.observer import Observer
+from pathspider.observer import _flow_key
+from pathspider.observer import _key_ports
+from pathspider.tests.chains import ChainTestCase
+
+class CountingChain(Chain):
+
+    fields = (
+        Field("counting_new", bool, False),
+        Field("counting_calls", int, 0),
+    )
+
+    def new_flow(self, rec, ip):
+        rec['counting_new'] = True
+        return True
+
+    def ip4(self, rec, ip, rev):
+        rec['counting_calls'] += 1
+        return True
+
+class UDPCountingChain(CountingChain):
+    protocols = frozenset((17, ))
+
+class HTTPCountingChain(CountingChain):
+    ports = frozenset((80, 8080))
+
+class ReverseCountingChain(CountingChain):
+    direction = "rev"
+
+class ForwardCountingChain(CountingChain):
+    direction = "fwd"
+
+def test_observer_key_ports():
+    (key, _) = _flow_key(bytes(4), bytes((1, 2, 3, 4)), b"\x06",
+                         bytes((0, 80, 0xc3, 0x50)))
+    assert_equal(_key_ports(key), (80, 50000))
+    (key, _) = _flow_key(bytes(16), bytes(15) + b"\x01", b"\x11",
+                         bytes((0xc3, 0x50, 0, 53)))
+    assert_equal(_key_ports(key), (50000, 53))
+    (key, _) = _flow_key(bytes(4), bytes((1, 2, 3, 4)), b"\x01", None)
+    assert_equal(_key_ports(key), None)
+
+class TestObserverApplies(ChainTestCase):
+
+    def _flows(self, chain):
+        self.create_observer("tcp_http.pcap", [BasicChain, chain])
+        flows = self.run_observer()
+        self.observer_thread.join(3)
+        assert_equal(len(flows), 3)
+        return flows
+
+    def test_observer_applies_protocols(self):
+        for flow in self._flows(UDPCountingChain):
+            applies = flow['proto'] == 17
+            # the fields of the chain are in the records of every flow
+            assert_equal(flow['counting_new'], applies)
+            assert_equal(flow['counting_calls'],
+                         flow['pkt_fwd'] + flow['pkt_rev'] if applies else 0)
+
+    def test_observer_applies_ports(self):
+        for flow in self._flows(HTTPCountingChain):
+            applies = 80 in (flow['sp'], flow['dp'])
+            assert_equal(flow['counting_new'], applies)
+            assert_equal(flow['counting_calls'],
+                         flow['pkt_fwd'] + flow['pkt_rev'] if applies else 0)
+
+    def test_observer_applies_direction(self):
+        for flow in self._flows(ReverseCountingChain):
+            assert flow['counting_new']
+            assert_equal(flow['counting_calls'], flow['pkt_rev'])
+        for flow in self._flows(ForwardCountingChain):
+            assert flow['counting_new']
+            assert_equal(flow['counting_calls'], flow['pkt_fwd'])
+
+    def test_observer_applies_invalid_direction(self):
+        class InvalidChain(Chain):
+            direction = "both"
+        with assert_raises(ValueError):
+            Observer(self._lturi("tcp_http.pcap"), [InvalidChain])
@@ -0,0 +1,38 @@
+
+import queue
+
+from nose.tools import assert_equal
+
+from pathspider.base import BATCH_MEAN_WEIGHT
+from pathspider.base import SHUTDOWN_SENTINEL
+from pathspider.base import Spider
+from pathspider.chains.basic import BasicChain
+from pathspider.tests.chains import ChainTestCase
+
+class TestObserverBatching(ChainTestCase):
+
+    def test_observer_batch_size(self):
+        self.create_observer("icmp_ttl.pcap", [BasicChain])
+        expected = self.run_observer()
+        self.tearDown()
+
+        self.create_observer("icmp_ttl.pcap", [BasicChain], batch_size=2)
+        flowqueue = queue.Queue()
+        self.observer.run_flow_enqueuer(flowqueue)
+        flows = []
+        batch = flowqueue.get_nowait()
+        while batch != SHUTDOWN_SENTINEL:
+            assert 0 < len(batch) <= 2
+            flows.extend(batch)
+            batch = flowqueue.get_nowait()
+        assert_equal(flows, expected)
+
+def test_merge_flow_batch_mean():
+    spider = Spider(1, "", None, False)
+    spider.flowqueue = queue.Queue()
+    flows = [{'dip': "192.0.2.1", 'sp': 1024 + sp} for sp in range(11)]
+    spider.flowqueue.put(flows)
+    assert spider._merge_flows()
+    assert_equal(len(spider.flowtab), 11)
+    # the merger estimates the flows waiting from the mean batch size
+    assert_equal(spider.flow_batch_mean, 1 + 10 * BATCH_MEAN_WEIGHT)
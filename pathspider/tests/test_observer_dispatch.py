@@ -0,0 +1,49 @@
+
+from nose.tools import assert_equal
+
+from pathspider.chains.base import Chain
+from pathspider.chains.basic import BasicChain
+from pathspider.tests.chains import ChainTestCase
+
+class CompletingChain(Chain):
+
+    def new_flow(self, rec, ip):
+        rec['_ip4_calls'] = 0
+        return True
+
+    def ip4(self, rec, ip, rev):
+        rec['_ip4_calls'] += 1
+        return False
+
+class TrailingChain(Chain):
+
+    def new_flow(self, rec, ip):
+        rec['_tcp_calls'] = 0
+        return True
+
+    def tcp(self, rec, tcp, rev):
+        rec['_tcp_calls'] += 1
+        return True
+
+class TestObserverDispatch(ChainTestCase):
+
+    def test_observer_dispatch_tables(self):
+        self.create_observer("tcp_http.pcap", [BasicChain, TrailingChain])
+        self.run_observer()
+        observer = self.observer
+        assert_equal(observer._new_flow_chains,
+                     tuple(c.new_flow for c in observer._chains))
+        assert_equal(len(observer._ip4_chains), 1)
+        assert_equal(len(observer._tcp_chains), 1)
+        assert_equal(observer._udp_chains, ())
+        assert_equal(observer._icmp4_chains, ())
+
+    def test_observer_dispatch_short_circuit(self):
+        self.create_observer("tcp_http.pcap", [CompletingChain, TrailingChain])
+        flows = self.run_observer()
+
+        # The TCP chain is never called as the IP chain asks for completion
+        # on every packet
+        for flow in flows:
+            assert flow['_ip4_calls'] >= 1
+            assert_equal(flow['_tcp_calls'], 0)
@@ -0,0 +1,138 @@
+import math
+import queue
+
+from nose.tools import assert_equal
+
+from pathspider.base import Spider
+from pathspider.chains.basic import BasicChain
+from pathspider.chains.tcp import TCPChain
+from pathspider.tests.chains import ChainTestCase
+
+class CoarseTrace:
+    """
+    A trace with timestamps rounded down to the second, as if captured with
+    a coarse clock.
+    """
+
+    def __init__(self, trace):
+        self._trace = trace
+
+    def read_packet(self, pkt):
+        if not self._trace.read_packet(pkt):
+            return False
+        pkt.seconds = float(math.floor(pkt.seconds))
+        return True
+
+    def pkt_drops(self):
+        return self._trace.pkt_drops()
+
+    def close(self):
+        self._trace.close()
+
+class TestObserverEarly(ChainTestCase):
+
+    def test_observer_early(self):
+        early_queue = queue.Queue()
+        early_queue.put(("65.208.228.223", 3372))
+        self.create_observer("tcp_http.pcap", [BasicChain, TCPChain],
+                             early_queue=early_queue)
+        flows = self.run_observer()
+        self.observer_thread.join(3)
+
+        http = [flow for flow in flows if flow['dip'] == "65.208.228.223"]
+        assert_equal(len(flows), 4)
+        assert_equal(len(http), 2)
+        # the flow is passed on as soon as it is complete
+        assert http[0]['observer_early']
+        assert http[0]['tcp_fin_fwd'] and http[0]['tcp_fin_rev']
+        assert 'observer_update' not in http[0]
+        # the final ACK is seen before the flow expires
+        assert http[1]['observer_update']
+        assert 'observer_early' not in http[1]
+        assert http[1]['pkt_last'] > http[0]['pkt_last']
+        assert_equal(self.observer._ct_early, 1)
+        assert_equal(self.observer._ct_update, 1)
+        for flow in flows:
+            if flow['dip'] != "65.208.228.223":
+                assert 'observer_early' not in flow
+                assert 'observer_update' not in flow
+
+    def test_observer_early_same_time(self):
+        early_queue = queue.Queue()
+        early_queue.put(("65.208.228.223", 3372))
+        self.create_observer("tcp_http.pcap", [BasicChain, TCPChain],
+                             early_queue=early_queue)
+        self.observer._trace = CoarseTrace(self.observer._trace)
+        flows = self.run_observer()
+        self.observer_thread.join(3)
+
+        # the final ACK is seen in the same second as the FIN, and is still
+        # passed on as an update
+        http = [flow for flow in flows if flow['dip'] == "65.208.228.223"]
+        assert_equal(len(http), 2)
+        assert http[0]['observer_early']
+        assert http[1]['observer_update']
+        assert_equal(http[1]['pkt_last'], http[0]['pkt_last'])
+        assert_equal(http[1]['pkt_fwd'] + http[1]['pkt_rev'],
+                     http[0]['pkt_fwd'] + http[0]['pkt_rev'] + 1)
+
+    def test_observer_early_disabled(self):
+        self.create_observer("tcp_http.pcap", [BasicChain, TCPChain])
+        flows = self.run_observer()
+        self.observer_thread.join(3)
+
+        assert_equal(len(flows), 3)
+
+class EarlySpider(Spider):
+
+    _config_count = 2
+
+    def combine_flows(self, flows):
+        return []
+
+def test_merge_early_update():
+    spider = EarlySpider(1, "", None, False)
+    spider.early_queues = [queue.Queue()]
+    spider.outqueue = queue.Queue()
+    spider.jobtab[1] = {'dip': "192.0.2.1"}
+    for config in range(2):
+        spider.resqueue.put({'dip': "192.0.2.1", 'sp': 1024 + config,
+                             'jobId': 1, 'config': config, 'spdr_start': "",
+                             'spdr_stop': ""})
+        spider._merge_results()
+
+    # the merger asks for the flows it is waiting for
+    assert_equal(spider.early_queues[0].get_nowait(), ("192.0.2.1", 1024))
+    assert_equal(spider.early_queues[0].get_nowait(), ("192.0.2.1", 1025))
+
+    spider._merge_flow({'dip': "192.0.2.1", 'sp': 1024, 'pkt_fwd': 3,
+                        'observer_early': True})
+    spider._merge_flow({'dip': "192.0.2.1", 'sp': 1024, 'pkt_fwd': 4,
+                        'observer_update': True})
+    spider._merge_flow({'dip': "192.0.2.1", 'sp': 1025, 'pkt_fwd': 5,
+                        'observer_early': True})
+    job = spider.outqueue.get_nowait()
+    assert_equal([flow['pkt_fwd'] for flow in job['flow_results']], [4, 5])
+    for flow in job['flow_results']:
+        assert 'observer_early' not in flow
+        assert 'observer_update' not in flow
+
+    # updates that arrive after the job is complete are dropped
+    spider._merge_flow({'dip': "192.0.2.1", 'sp': 1025, 'pkt_fwd': 6,
+                        'observer_update': True})
+    assert_equal(spider.flowtab, {})
+    assert_equal(job['flow_results'][1]['pkt_fwd'], 5)
+
+def test_merge_early_update_unmerged():
+    spider = EarlySpider(1, "", None, False)
+    spider.early_queues = [queue.Queue()]
+    spider.outqueue = queue.Queue()
+    spider.jobtab[1] = {'dip': "192.0.2.1"}
+
+    # a flow passed on early before its result arrives is still updated
+    spider._merge_flow({'dip': "192.0.2.1", 'sp': 1024, 'pkt_fwd': 3,
+                        'observer_early': True})
+    spider._merge_flow({'dip': "192.0.2.1", 'sp': 1024, 'pkt_fwd': 4,
+                        'observer_update': True})
+    assert_equal(spider.flowtab[("192.0.2.1", 1024)]['pkt_fwd'], 4)
+    assert 'observer_update' not in spider.flowtab[("192.0.2.1", 1024)]
@@ -0,0 +1,55 @@
+
+import ipaddress
+
+from nose.tools import assert_equal
+
+from pathspider.tests.chains import ChainTestCase
+
+from pathspider.chains.basic import BasicChain
+from pathspider.observer import AddressFilter
+from pathspider.observer import _flow_key
+from pathspider.observer import _key_addresses
+
+def test_address_filter_counting():
+    address_filter = AddressFilter(size=1024)
+    packed = ipaddress.ip_address("192.0.2.1").packed
+    assert packed not in address_filter
+    address_filter.add("192.0.2.1")
+    address_filter.add("192.0.2.1")
+    assert packed in address_filter
+    address_filter.discard("192.0.2.1")
+    assert packed in address_filter
+    address_filter.discard("192.0.2.1")
+    assert packed not in address_filter
+
+def test_address_filter_key_addresses():
+    for (src, dst) in (("192.0.2.1", "198.51.100.7"),
+                       ("2001:db8::1", "2001:db8::2")):
+        (a, b) = (ipaddress.ip_address(src).packed,
+                  ipaddress.ip_address(dst).packed)
+        for ports in (None, b"\x9a\x4e\x00\x50"):
+            (key, _) = _flow_key(b, a, b"\x06", ports)
+            assert_equal(_key_addresses(key), (a, b))
+
+class TestObserverFilter(ChainTestCase):
+
+    def _run(self, address_filter):
+        self.create_observer("icmp_ttl.pcap", [BasicChain],
+                             address_filter=address_filter)
+        flows = self.run_observer()
+        self.tearDown()
+        return flows
+
+    def test_observer_filter(self):
+        target = "216.58.209.110"
+        expected = [f for f in self._run(None) if f['dip'] == target]
+
+        address_filter = AddressFilter()
+        assert_equal(len(self._run(address_filter)), 0)
+
+        address_filter.add(target)
+        flows = self._run(address_filter)
+        assert len(flows) > 0
+        assert_equal(len(flows), len(expected))
+        for flow in flows:
+            assert_equal(flow['dip'], target)
@@ -0,0 +1,86 @@
+import queue
+import threading
+
+from nose.tools import assert_equal
+
+from pathspider.base import SHUTDOWN_SENTINEL
+from pathspider.chains.basic import BasicChain
+from pathspider.chains.tcp import TCPChain
+from pathspider.tests.chains import ChainTestCase
+
+class QuietTrace:
+    """
+    A trace that goes quiet once the capture file has been read, like a live
+    interface with no traffic, until it is released.
+    """
+
+    def __init__(self, trace):
+        self._trace = trace
+        self.released = threading.Event()
+
+    def read_packet(self, pkt):
+        if self._trace.read_packet(pkt):
+            return True
+        self.released.wait()
+        return False
+
+    def pkt_drops(self):
+        return self._trace.pkt_drops()
+
+    def close(self):
+        self._trace.close()
+
+class TestObserverIdleTick(ChainTestCase):
+
+    def quiet_flows(self, wait, idle_tick=None, test_trace="tcp_http.pcap",
+                    count=3, **kwargs):
+        self.create_observer(test_trace, [BasicChain, TCPChain],
+                             expiry_timeout=0, **kwargs)
+        # the quiet trace stands in for a live interface, so is ticked
+        trace = self.observer._trace = QuietTrace(self.observer._trace)
+        self.observer._live = True
+        self.observer._idle_tick = idle_tick
+        self.observer_thread = threading.Thread(
+            target=self.observer.run_flow_enqueuer, args=(self.flowqueue,),
+            daemon=True)
+        self.observer_thread.start()
+
+        # collect the flows passed on while the trace is quiet
+        flows = []
+        try:
+            while len(flows) < count:
+                flows.extend(self.flowqueue.get(timeout=wait))
+        except queue.Empty:
+            pass
+        trace.released.set()
+        self.observer_thread.join(3)
+        return flows
+
+    def test_observer_idle_tick(self):
+        flows = self.quiet_flows(3, idle_tick=0.05)
+        assert_equal(len(flows), 3)
+        assert_equal(self.flowqueue.get_nowait(), SHUTDOWN_SENTINEL)
+
+    def test_observer_idle_tick_disabled(self):
+        flows = self.quiet_flows(1)
+        assert len(flows) < 3
+
+    def test_observer_idle_tick_capture_file(self):
+        self.create_observer("tcp_http.pcap", [BasicChain, TCPChain])
+        flows = self.run_observer()
+        self.observer_thread.join(3)
+
+        # capture files are not ticked, as the wall clock would corrupt the
+        # packet clock
+        self.create_observer("tcp_http.pcap", [BasicChain, TCPChain],
+                             idle_tick=0.001)
+        assert_equal(self.observer._idle_tick, None)
+        assert_equal(self.run_observer(), flows)
+
+    def test_observer_flush_quiet(self):
+        # a partial batch is passed on once it has waited for the flush
+        # interval, although no more packets are received
+        flows = self.quiet_flows(1, test_trace="icmp_ttl.pcap", count=1000,
+                                 flush_interval=0.1, batch_size=100)
+        assert len(flows) > 0
+        assert len(flows) % 100 > 0
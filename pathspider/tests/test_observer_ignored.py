@@ -0,0 +1,58 @@
+from nose.tools import assert_equal
+
+from pathspider.chains.base import Chain
+from pathspider.observer import IgnoredFlows
+from pathspider.tests.chains import ChainTestCase
+
+class VetoChain(Chain):
+
+    def new_flow(self, rec, ip):
+        return False
+
+def test_ignored_flows_evict():
+    ignored = IgnoredFlows(size=2, timeout=30)
+    ignored.add(b"a", 1.0)
+    ignored.add(b"b", 2.0)
+    # seeing a flow keeps it in the table
+    assert ignored.seen(b"a", 3.0)
+    ignored.add(b"c", 4.0)
+    assert_equal(len(ignored), 2)
+    assert b"a" in ignored
+    assert b"b" not in ignored
+    assert not ignored.seen(b"b", 5.0)
+    assert_equal(ignored.evicted, 1)
+
+def test_ignored_flows_expire():
+    ignored = IgnoredFlows(size=10, timeout=30)
+    ignored.add(b"a", 1.0)
+    ignored.add(b"b", 2.0)
+    ignored.seen(b"a", 20.0)
+    ignored.expire(32.5)
+    assert_equal(len(ignored), 1)
+    assert b"a" in ignored
+    ignored.expire(50.0)
+    assert_equal(len(ignored), 0)
+    assert_equal(ignored.expired, 2)
+    assert_equal(ignored.evicted, 0)
+
+class TestObserverIgnored(ChainTestCase):
+
+    def test_observer_ignored_bounded(self):
+        self.create_observer("icmp_ttl.pcap", [VetoChain], ignored_size=2)
+        sizes = []
+        original_add = self.observer._ignored.add
+        def add(fid, pt):
+            original_add(fid, pt)
+            sizes.append(len(self.observer._ignored))
+        self.observer._ignored.add = add
+
+        flows = self.run_observer()
+        self.observer_thread.join(3)
+
+        ignored = self.observer._ignored
+        assert_equal(flows, [])
+        assert max(sizes) <= 2
+        assert_equal(self.observer._ct_ignored, 297)
+        assert ignored.evicted > 0
+        assert ignored.expired > 0
+        assert_equal(len(ignored), 0)
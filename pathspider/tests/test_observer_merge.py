@@ -0,0 +1,90 @@
+import pkg_resources
+from nose.tools import assert_equal
+
+from pathspider import traces
+from pathspider.base import Spider
+from pathspider.chains.basic import BasicChain
+from pathspider.tests.chains import ChainTestCase
+
+def _trace(name):
+    return pkg_resources.resource_filename("pathspider", "tests/data/" + name)
+
+def five_tuple(flow):
+    return (flow['sip'], flow['sp'], flow['dip'], flow['dp'], flow['proto'])
+
+def test_merged_trace_order():
+    names = ["tcp_http.pcap", "tcp_http.pcap", "icmp_ttl.pcap"]
+    trace = traces.MergedTrace(
+        [traces.trace("pcap:" + _trace(name)) for name in names],
+        ["first", "second", "ttl"])
+    trace.start()
+    packets = [(pkt.seconds, trace.name) for pkt in trace]
+    trace.close()
+
+    assert_equal(packets, sorted(packets))
+    seconds = {name: [pt for (pt, source) in packets if source == name]
+               for name in ("first", "second", "ttl")}
+    assert_equal(seconds["first"], seconds["second"])
+    assert len(seconds["ttl"]) > 0
+    # the packets of the two copies of the same trace are interleaved
+    assert_equal([name for (_, name) in packets[:2]], ["first", "second"])
+
+class TestObserverMerge(ChainTestCase):
+
+    def test_observer_merge(self):
+        names = ["tcp_http.pcap", "icmp_ttl.pcap"]
+        interfaces = {}
+        for name in names:
+            self.create_observer(name, [BasicChain])
+            for flow in self.run_observer():
+                interfaces[five_tuple(flow)] = _trace(name)
+            self.observer_thread.join(3)
+
+        self.create_observer(names, [BasicChain], merge=True)
+        flows = self.run_observer()
+        self.observer_thread.join(3)
+
+        # the flows of all of the sources are seen, tagged with their source
+        assert_equal(len(flows), len(interfaces))
+        for flow in flows:
+            assert_equal(flow['interface'], interfaces[five_tuple(flow)])
+
+    def test_observer_merge_disabled(self):
+        self.create_observer(["tcp_http.pcap", "icmp_ttl.pcap"], [BasicChain])
+        flows = self.run_observer()
+        self.observer_thread.join(3)
+
+        for flow in flows:
+            assert 'interface' not in flow
+
+class UplinkSpider(Spider):
+
+    def connect(self, job, config):
+        return {'source': self.source}
+
+def test_spider_uplinks():
+    spider = UplinkSpider(1, ["pcap:eth0.pcap", "pcap:eth1.pcap"], None,
+                          False)
+    spider.uplink_sources = [
+        (("192.0.2.1", "2001:db8::1"), ("192.0.2.1", "2001:db8::1"),
+         (None, None)),
+        (("198.51.100.1", "2001:db8::2"), ("203.0.113.1", "2001:db8::2"),
+         (64496, None)),
+    ]
+    spider.stopping = False
+    for dip in ("192.0.2.100", "2001:db8::100", "192.0.2.101"):
+        spider.add_job({'dip': dip})
+    jobs = [spider.jobqueue.get_nowait() for _ in range(3)]
+
+    # jobs are assigned to the uplinks in turn
+    assert_equal([job['interface'] for job in jobs],
+                 ["eth0.pcap", "eth1.pcap", "eth0.pcap"])
+    assert_equal([job['sip'] for job in jobs],
+                 ["192.0.2.1", "2001:db8::2", "192.0.2.1"])
+    assert_equal(jobs[1]['path'], ["2001:db8::2", "2001:db8::100"])
+
+    # connections are made from the uplink of the job
+    assert_equal(spider._connect_wrapper(jobs[1], 0)['source'],
+                 ("198.51.100.1", "2001:db8::2"))
+    assert_equal(spider._connect_wrapper(jobs[2], 0)['source'],
+                 ("192.0.2.1", "2001:db8::1"))
@@ -0,0 +1,110 @@
+import queue
+
+from nose.tools import assert_equal
+
+from pathspider.base import NO_FLOW
+from pathspider.base import Spider
+from pathspider.chains.basic import BasicChain
+from pathspider.chains.tcp import TCPChain
+from pathspider.observer import AddressFilter
+from pathspider.tests.chains import ChainTestCase
+
+def five_tuple(flow):
+    return (flow['sip'], flow['sp'], flow['dip'], flow['dp'], flow['proto'])
+
+class TestObserverOverload(ChainTestCase):
+
+    # packets in the test traces are years behind the wall clock, so an
+    # observer with a lag threshold is overloaded from the first tick of the
+    # packet clock
+
+    def test_observer_overload_shed(self):
+        self.create_observer("icmp_ttl.pcap", [BasicChain])
+        observed = {five_tuple(flow) for flow in self.run_observer()}
+        self.observer_thread.join(3)
+
+        self.create_observer("icmp_ttl.pcap", [BasicChain], overload_lag=60)
+        flows = self.run_observer()
+        self.observer_thread.join(3)
+
+        shed = [flow for flow in flows if flow.get('observer_shed')]
+        kept = [flow for flow in flows if not flow.get('observer_shed')]
+        assert_equal(len(shed), self.observer._ct_shed)
+        assert len(shed) > 0
+        assert_equal(self.observer._ct_overload, 1)
+        # only flows created before the observer was overloaded are kept
+        assert_equal(len(kept), 1)
+        assert kept[0]['observer_overload']
+        # shed flow records identify the flow as BasicChain would
+        for flow in shed:
+            assert five_tuple(flow) in observed
+        assert_equal(len(observed), len(flows))
+
+    def test_observer_overload_sample(self):
+        self.create_observer("icmp_ttl.pcap", [BasicChain], overload_lag=60,
+                             overload_sample=0.5)
+        flows = self.run_observer()
+        self.observer_thread.join(3)
+
+        shed = [flow for flow in flows if flow.get('observer_shed')]
+        assert 0.3 < len(shed) / len(flows) < 0.7
+        for flow in flows:
+            assert flow.get('observer_shed') or flow['observer_overload']
+
+    def test_observer_overload_filter(self):
+        overload_filter = AddressFilter()
+        overload_filter.add("216.239.59.99")
+        self.create_observer("tcp_http.pcap", [BasicChain, TCPChain],
+                             overload_lag=60, overload_filter=overload_filter)
+        flows = self.run_observer()
+        self.observer_thread.join(3)
+
+        # flows for the jobs are kept, others are shed without a record. the
+        # first flow was created before the observer was overloaded.
+        assert_equal(self.observer._ct_shed, 1)
+        assert_equal([flow['dip'] for flow in flows],
+                     ["65.208.228.223", "216.239.59.99"])
+        for flow in flows:
+            assert flow['observer_overload']
+
+    def test_observer_overload_disabled(self):
+        self.create_observer("tcp_http.pcap", [BasicChain])
+        flows = self.run_observer()
+        self.observer_thread.join(3)
+
+        assert_equal(self.observer._ct_shed, 0)
+        for flow in flows:
+            assert 'observer_overload' not in flow
+
+class OverloadSpider(Spider):
+
+    _config_count = 1
+
+    def combine_flows(self, flows):
+        if not flows[0]['observed']:
+            return ['pathspider.not_observed']
+        return ['dummy.observed']
+
+def merge_job(flow):
+    spider = OverloadSpider(0, "", None, False)
+    spider.outqueue = queue.Queue()
+    spider.jobtab[1] = {'dip': "192.0.2.1"}
+    spider.merge(flow, {'dip': "192.0.2.1", 'sp': 1024, 'jobId': 1,
+                        'config': 0, 'spdr_start': "", 'spdr_stop': ""})
+    return spider.outqueue.get_nowait()
+
+def test_merge_overload():
+    shed = {'dip': "192.0.2.1", 'sp': 1024, 'observer_shed': True}
+    job = merge_job(shed)
+    assert_equal(job['missed_flows'], 1)
+    assert_equal(job['conditions'], ["pathspider.observer_overload",
+                                     "pathspider.missed_flows:1"])
+
+    job = merge_job({'dip': "192.0.2.1", 'sp': 1024,
+                     'observer_overload': True})
+    assert_equal(job['conditions'], ["dummy.observed",
+                                     "pathspider.observer_overload"])
+
+    job = merge_job(NO_FLOW)
+    assert_equal(job['conditions'], ["pathspider.not_observed",
+                                     "pathspider.missed_flows:1"])
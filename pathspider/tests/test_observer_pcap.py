@@ -0,0 +1,135 @@
+import collections
+import os
+import shutil
+import tempfile
+
+from nose.tools import assert_equal
+from nose.tools import assert_raises
+
+from pathspider.chains.basic import BasicChain
+from pathspider.chains.tcp import TCPChain
+from pathspider.observer import AddressFilter
+from pathspider.observer import FlowMatch
+from pathspider.tests.chains import ChainTestCase
+from pathspider.traces.packet import LINKTYPE_RAW
+from pathspider.traces.pcap import PcapTrace
+from pathspider.traces.pcap import PcapWriter
+
+def read_pcap(path):
+    trace = PcapTrace(path)
+    packets = [(pkt.seconds, pkt.linktype, pkt.wire_len, bytes(pkt.ip.data))
+               for pkt in trace]
+    trace.close()
+    return packets
+
+def flow_packets(packets):
+    # the packets of each flow, by the addresses and ports of the flow
+    flows = collections.defaultdict(list)
+    for (_, _, _, data) in packets:
+        key = tuple(sorted((data[12:16] + data[20:22],
+                            data[16:20] + data[22:24])))
+        flows[key].append(data)
+    return flows
+
+def test_flow_match():
+    match = FlowMatch(['dp=443', 'tcp_connected=false', 'host=example.com'])
+    assert_equal(match.conditions, [('dp', 443), ('tcp_connected', False),
+                                    ('host', "example.com")])
+    assert match({'dp': 443})
+    assert match({'dp': 80, 'tcp_connected': False})
+    assert match({'host': "example.com"})
+    assert not match({'dp': 80, 'tcp_connected': True})
+    assert not match({})
+    with assert_raises(ValueError):
+        FlowMatch(['443'])
+
+class TestObserverPcap(ChainTestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "flows.pcap")
+
+    def tearDown(self):
+        super().tearDown()
+        shutil.rmtree(self.tmpdir)
+
+    def test_pcap_writer_rotation(self):
+        original = read_pcap(self._lturi("tcp_http.pcap")[5:])
+        writer = PcapWriter(self.path, snaplen=60, file_size=200,
+                            file_count=3)
+        for (seconds, _, _, data) in original[:10]:
+            writer.write(seconds, data)
+        writer.close()
+        assert_equal(writer.packets, 10)
+
+        # the oldest file was overwritten, the packets of the others remain
+        names = sorted(os.listdir(self.tmpdir))
+        assert_equal(names, ["flows.pcap", "flows.pcap.1", "flows.pcap.2"])
+        written = []
+        for name in ("flows.pcap.1", "flows.pcap.2", "flows.pcap"):
+            written.extend(read_pcap(os.path.join(self.tmpdir, name)))
+        assert_equal(len(written), 7)
+        for ((seconds, linktype, wirelen, data),
+             (orig_seconds, _, _, orig_data)) in zip(written, original[3:10]):
+            assert abs(seconds - orig_seconds) < 1e-6
+            assert_equal(linktype, LINKTYPE_RAW)
+            assert_equal(wirelen, len(orig_data))
+            assert_equal(data, orig_data[:60])
+
+    def test_observer_pcap(self):
+        self.create_observer("tcp_http.pcap", [BasicChain, TCPChain])
+        expected = self.run_observer()
+        self.observer_thread.join(3)
+
+        writer = PcapWriter(self.path)
+        self.create_observer("tcp_http.pcap", [BasicChain, TCPChain],
+                             pcap_writer=writer, pcap_packets=4)
+        flows = self.run_observer()
+        self.observer_thread.join(3)
+
+        # the flows passed on are not changed
+        assert_equal(flows, expected)
+
+        # the first packets of each flow are written
+        original = flow_packets(read_pcap(self._lturi("tcp_http.pcap")[5:]))
+        written = flow_packets(read_pcap(self.path))
+        assert_equal(set(written), set(original))
+        for (key, packets) in written.items():
+            assert_equal(packets, original[key][:4])
+
+    def test_observer_pcap_select(self):
+        target = "216.239.59.99"
+        writer = PcapWriter(self.path)
+        pcap_flows = AddressFilter()
+        pcap_flows.add(target)
+        self.create_observer("tcp_http.pcap", [BasicChain, TCPChain],
+                             pcap_writer=writer, pcap_flows=pcap_flows,
+                             pcap_match=FlowMatch(['dp=80']))
+        flows = self.run_observer()
+        self.observer_thread.join(3)
+
+        # only the packets of the matching flows for the job are written
+        matching = [flow for flow in flows
+                    if target in (flow['sip'], flow['dip']) and
+                    flow['dp'] == 80]
+        assert len(matching) > 0
+        written = read_pcap(self.path)
+        assert len(written) > 0
+        for (_, _, _, data) in written:
+            assert target in (".".join(str(b) for b in data[12:16]),
+                              ".".join(str(b) for b in data[16:20]))
+        assert_equal(len(flow_packets(written)), len(matching))
+
+    def test_observer_pcap_memory(self):
+        writer = PcapWriter(self.path)
+        self.create_observer("tcp_http.pcap", [BasicChain],
+                             pcap_writer=writer, pcap_memory=1000)
+        self.run_observer()
+        self.observer_thread.join(3)
+
+        # packets are not kept while the memory limit is reached
+        written = read_pcap(self.path)
+        assert len(written) > 0
+        assert sum(len(data) for (_, _, _, data) in written) < 1000 + 1500
+        assert self.observer._ct_pcap_skipped > 0
+        assert_equal(self.observer._pcap_bytes, 0)
@@ -0,0 +1,105 @@
+
+from nose.tools import assert_equal
+
+from pathspider.chains.base import Chain
+from pathspider.chains.base import RETIRE
+from pathspider.chains.basic import BasicChain
+from pathspider.chains.mss import MSSChain
+from pathspider.chains.tcp import TCPChain
+from pathspider.chains.tcpopt import TCPOptChain
+from pathspider.chains.tfo import TFOChain
+from pathspider.tests.chains import ChainTestCase
+
+class RetiringChain(Chain):
+
+    def new_flow(self, rec, ip):
+        rec['_ip4_calls'] = 0
+        rec['_tcp_calls'] = 0
+        return True
+
+    def ip4(self, rec, ip, rev):
+        rec['_ip4_calls'] += 1
+        return RETIRE if rec['_ip4_calls'] == 2 else True
+
+    def tcp(self, rec, tcp, rev):
+        rec['_tcp_calls'] += 1
+        return True
+
+class TrailingChain(Chain):
+
+    def new_flow(self, rec, ip):
+        rec['_trailing_calls'] = 0
+        return True
+
+    def tcp(self, rec, tcp, rev):
+        rec['_trailing_calls'] += 1
+        return True
+
+class TestObserverRetire(ChainTestCase):
+
+    def test_observer_retire_chain(self):
+        self.create_observer("tcp_http.pcap",
+                             [BasicChain, RetiringChain, TrailingChain])
+        flows = self.run_observer()
+        assert len(flows) > 0
+
+        for flow in flows:
+            packets = flow['pkt_fwd'] + flow['pkt_rev']
+            # the chain is called for no further hooks once it has retired,
+            # while the other chains see every packet of the flow
+            assert_equal(flow['_ip4_calls'], min(packets, 2))
+            assert_equal(flow['_tcp_calls'],
+                         min(packets, 1) if flow['proto'] == 6 else 0)
+            assert_equal(flow['_trailing_calls'],
+                         packets if flow['proto'] == 6 else 0)
+            assert '_plan' not in flow
+
+    def test_observer_retire_plans(self):
+        self.create_observer("tcp_http.pcap",
+                             [BasicChain, RetiringChain, TrailingChain])
+        self.run_observer()
+        observer = self.observer
+
+        # a plan is created once for each set of retired chains
+        assert_equal(sorted(observer._plans), [0, 2])
+        plan = observer._plans[2]
+        assert_equal(len(plan.ip4), 1)
+        assert_equal(plan.tcp, (observer._chains[2].tcp, ))
+        assert_equal(plan.udp, ())
+
+    def test_observer_retire_handshake_chains(self):
+        chains = [BasicChain, TCPChain, MSSChain, TCPOptChain, TFOChain]
+        self.create_observer("tcp_http.pcap", chains)
+        flows = self.run_observer()
+
+        # the chains looking at the handshake retire from the first TCP flow
+        # once it is over, having recorded the options on its SYN and
+        # SYN/ACK, but not from the second, whose handshake was not captured
+        assert_equal(self.observer._ct_retired, 3)
+        flow = [flow for flow in flows if flow['sp'] == 3372][0]
+        assert_equal(flow['mss_value_fwd'], 1460)
+        assert_equal(flow['mss_value_rev'], 1380)
+        assert_equal(flow['tcpopt_sack'], True)
+
+    def test_observer_retire_handshake_chains_alone(self):
+        # without TCPChain, the chains cannot tell whether the handshake has
+        # been seen, and so never retire
+        chains = [BasicChain, MSSChain, TCPOptChain, TFOChain]
+        self.create_observer("tcp_http.pcap", chains)
+        self.run_observer()
+        assert_equal(self.observer._ct_retired, 0)
+
+class _Segment:
+
+    def __init__(self, syn_flag):
+        self.syn_flag = syn_flag
+
+def test_retire_late_syn_ack():
+    # a SYN/ACK arriving after another packet still has its options
+    # recorded, as the chains only retire once a SYN has been seen in both
+    # directions
+    for chain in (MSSChain(), TCPOptChain(), TFOChain()):
+        rec = {'tcp_synflags_fwd': 0x02, 'tcp_synflags_rev': None}
+        assert chain.tcp(rec, _Segment(False), False) is True
+        rec['tcp_synflags_rev'] = 0x12
+        assert chain.tcp(rec, _Segment(False), False) is RETIRE
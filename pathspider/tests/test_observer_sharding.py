@@ -0,0 +1,43 @@
+from pathspider.tests.chains import ChainTestCase
+
+from pathspider.chains.basic import BasicChain
+from pathspider.observer import flow_shard
+from pathspider.observer import _flow_key
+
+def test_flow_shard_symmetric():
+    a = b"\x0a\x00\x00\x01"
+    b = b"\x0a\x00\x00\x02"
+    (fkey, fdir) = _flow_key(a, b, b"\x06", b"\x9a\x4e\x00\x50")
+    (rkey, rdir) = _flow_key(b, a, b"\x06", b"\x00\x50\x9a\x4e")
+    assert fkey == rkey
+    assert fdir != rdir
+    for shard_count in range(1, 9):
+        assert 0 <= flow_shard(fkey, shard_count) < shard_count
+
+class TestObserverSharding(ChainTestCase):
+
+    def _flowkeys(self, flows):
+        return set((f['sip'], f['sp'], f['dip'], f['dp'], f['proto'])
+                   for f in flows)
+
+    def test_observer_shards_partition_flows(self):
+        test_trace = "icmp_ttl.pcap"
+        self.create_observer(test_trace, [BasicChain])
+        expected = self._flowkeys(self.run_observer())
+        self.tearDown()
+
+        shard_count = 3
+        seen = set()
+        total = 0
+        for shard in range(shard_count):
+            self.create_observer(test_trace, [BasicChain], shard=shard,
+                                 shard_count=shard_count)
+            flows = self.run_observer()
+            keys = self._flowkeys(flows)
+            assert seen.isdisjoint(keys)
+            seen |= keys
+            total += len(flows)
+            self.tearDown()
+
+        assert total == 297
+        assert seen == expected
@@ -0,0 +1,38 @@
+
+import logging
+
+from nose.tools import assert_equal
+
+from pathspider.chains.basic import BasicChain
+from pathspider.chains.tcp import TCPChain
+from pathspider.instrument import HookStats
+from pathspider.tests.chains import ChainTestCase
+
+def test_observer_stats_percentile():
+    stats = HookStats("Chain", "tcp")
+    for elapsed in [100] * 98 + [5000, 70000]:
+        stats.add(elapsed)
+    assert_equal(stats.calls, 100)
+    assert_equal(stats.total, 9800 + 75000)
+    assert_equal(stats.percentile(50), 128)
+    assert_equal(stats.percentile(99), 8192)
+    assert_equal(stats.percentile(100), 131072)
+
+class TestObserverStats(ChainTestCase):
+
+    def test_observer_stats(self):
+        self.create_observer("tcp_http.pcap", [BasicChain, TCPChain],
+                             stats_interval=3600)
+        with self.assertLogs("observer", logging.INFO) as logs:
+            flows = self.run_observer()
+        assert_equal(len(flows), 3)
+
+        hooks = {(stats.chain, stats.hook): stats.calls
+                 for stats in self.observer._instrumentation.hooks}
+        assert_equal(hooks, {("BasicChain", "new_flow"): 3,
+                             ("BasicChain", "ip4"): 43,
+                             ("BasicChain", "ip6"): 0,
+                             ("TCPChain", "tcp"): 41})
+        assert any("BasicChain.ip4: 43 calls" in line
+                   for line in logs.output)
+        assert any("2 active, 1 expiring" in line for line in logs.output)
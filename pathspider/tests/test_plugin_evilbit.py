@@ -122,3 +122,23 @@ def test_plugin_evilbit_combine():
             assert group[0] in conditions
 
             
+
+class TestPluginEvilBitCombineObserved(ChainTestCase):
+
+    def test_plugin_evilbit_combine_observed(self):
+        # the DNS server for the job is not on port 53, and the flows only
+        # hold the queries as no responses were captured
+        spider = EvilBit(0, "", TestArgs(connect="dnsudp"))
+        packets = [spider.forge(job, seq) for seq in range(spider.packets)]
+
+        with NamedTemporaryFile() as test_trace:
+            wrpcap(test_trace.name, [Ether()/packet for packet in packets])
+            self.create_observer(test_trace.name, EvilBit.chains)
+            flows = self.run_observer()
+
+        assert len(flows) == 2
+        for flow in flows:
+            assert flow['dp'] == 80
+            flow['observed'] = True
+        conditions = spider.combine_flows(flows)
+        assert "evilbit.connectivity.offline" in conditions
@@ -86,3 +86,23 @@ def test_plugin_udpzero_combine_not_observed():
         spider = UDPZero(0, "", None)
         conditions = spider.combine_flows(flows)
         assert "pathspider.not_observed" in conditions
+
+class TestPluginUDPZeroCombineObserved(ChainTestCase):
+
+    def test_plugin_udpzero_combine_observed(self):
+        # the DNS server for the job is not on port 53, and the flows only
+        # hold the queries as no responses were captured
+        spider = UDPZero(0, "", TestArgs(connect="dnsudp"))
+        packets = [spider.forge(job, seq) for seq in range(spider.packets)]
+
+        with NamedTemporaryFile() as test_trace:
+            wrpcap(test_trace.name, [Ether()/packet for packet in packets])
+            self.create_observer(test_trace.name, UDPZero.chains)
+            flows = self.run_observer()
+
+        assert len(flows) == 2
+        for flow in flows:
+            assert flow['dp'] == 80
+            flow['observed'] = True
+        conditions = spider.combine_flows(flows)
+        assert "udpzero.connectivity.offline" in conditions
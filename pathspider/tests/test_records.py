@@ -0,0 +1,41 @@
+
+from nose.tools import assert_equal
+from nose.tools import assert_raises
+
+from pathspider.chains.base import Field
+from pathspider.chains.basic import BasicChain
+from pathspider.records import record_class
+
+def test_records_declared_fields():
+    Record = record_class(BasicChain.fields)
+    rec = Record()
+    assert_equal(rec['sip'], None)
+    assert_equal(rec['pkt_fwd'], 0)
+    rec['pkt_fwd'] += 1
+    assert_equal(rec['pkt_fwd'], 1)
+    assert 'sip' in rec
+    assert not hasattr(rec, '__weakref__')
+    assert_equal(list(rec.to_dict().keys()),
+                 [field.name for field in BasicChain.fields])
+
+def test_records_undeclared_fields():
+    Record = record_class([Field("a", int, 0)])
+    rec = Record()
+    assert 'b' not in rec
+    assert_equal(rec.get('b', 5), 5)
+    rec['b'] = 2
+    assert 'b' in rec
+    assert_equal(rec.to_dict(), {'a': 0, 'b': 2})
+    del rec['a']
+    assert 'a' not in rec
+    assert_equal(rec.to_dict(), {'b': 2})
+
+def test_records_duplicate_fields():
+    Record = record_class([Field("a", int, 0), Field("a", int, 0)])
+    assert_equal(Record().to_dict(), {'a': 0})
+    assert_raises(ValueError, record_class,
+                  [Field("a", int, 0), Field("a", int, None)])
+
+def test_records_invalid_fields():
+    for name in ("to_dict", "get", "not valid", "class"):
+        assert_raises(ValueError, record_class, [Field(name, int, 0)])
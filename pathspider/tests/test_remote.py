@@ -0,0 +1,172 @@
+import argparse
+import json
+import queue
+import socket
+import struct
+import threading
+import time
+
+from nose.tools import assert_equal
+from nose.tools import assert_raises
+
+from pathspider.base import SHUTDOWN_SENTINEL
+from pathspider.base import Spider
+from pathspider.chains.basic import BasicChain
+from pathspider.chains.tcp import TCPChain
+from pathspider.observer import flow_fields
+from pathspider.remote import FlowServer
+from pathspider.remote import RemoteObserver
+from pathspider.remote import parse_address
+from pathspider.tests.chains import ChainTestCase
+
+def test_parse_address():
+    assert_equal(parse_address("192.0.2.1:7000"), ("192.0.2.1", 7000))
+    assert_equal(parse_address("[2001:db8::1]:7000"), ("2001:db8::1", 7000))
+    assert_equal(parse_address("capture.example.com:7000"),
+                 ("capture.example.com", 7000))
+    # a port on its own is on the loopback address
+    assert_equal(parse_address("7000"), ("127.0.0.1", 7000))
+    with assert_raises(ValueError):
+        parse_address("192.0.2.1")
+
+def wait_for_clients(server, count):
+    deadline = time.time() + 5
+    while server.client_count < count:
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+def start_remote(address, addresses=None, token=None):
+    remote = RemoteObserver(address, addresses, token=token)
+    flowqueue = queue.Queue()
+    irqueue = queue.Queue()
+    thread = threading.Thread(target=remote.run_flow_enqueuer,
+                              args=(flowqueue, irqueue), daemon=True)
+    thread.start()
+    return (flowqueue, irqueue, thread)
+
+def received(flowqueue):
+    return [flow for batch in iter(flowqueue.get, SHUTDOWN_SENTINEL)
+            for flow in batch]
+
+class TestRemote(ChainTestCase):
+
+    def test_remote_observer(self):
+        chains = [BasicChain, TCPChain]
+        self.create_observer("tcp_http.pcap", chains)
+        flows = self.run_observer()
+        self.observer_thread.join(3)
+
+        server = FlowServer(("127.0.0.1", 0), flow_fields(chains),
+                            allow_all=True)
+        (everything, _, first) = start_remote(server.address)
+        (filtered, _, second) = start_remote(server.address,
+                                             ["216.239.59.99", None])
+        wait_for_clients(server, 2)
+        server.send(flows[:2])
+        server.send(flows[2:])
+        server.close()
+        first.join(3)
+        second.join(3)
+        assert not first.is_alive()
+        assert not second.is_alive()
+
+        # the flows are received as they were sent
+        assert_equal(received(everything), flows)
+        # flows to or from other addresses are not sent
+        assert_equal(received(filtered),
+                     [flow for flow in flows
+                      if "216.239.59.99" in (flow['sip'], flow['dip'])])
+
+def test_remote_observer_interrupt():
+    # nothing is listening, so the remote observer keeps trying to connect
+    server = FlowServer(("127.0.0.1", 0), flow_fields([BasicChain]))
+    address = server.address
+    server.close()
+    (flowqueue, irqueue, thread) = start_remote(address)
+    irqueue.put(True)
+    thread.join(3)
+    assert not thread.is_alive()
+    assert_equal(flowqueue.get_nowait(), SHUTDOWN_SENTINEL)
+
+def test_remote_observer_refused():
+    server = FlowServer(("127.0.0.1", 0), flow_fields([BasicChain]),
+                        token="secret")
+    # a spider is refused for the wrong token, or for giving no addresses
+    # unless the server sends all of the flows, and does not try again
+    for (addresses, token) in ((["192.0.2.1"], None),
+                               (["192.0.2.1"], "guess"),
+                               ([], "secret")):
+        (flowqueue, _, thread) = start_remote(server.address, addresses,
+                                              token)
+        thread.join(3)
+        assert not thread.is_alive()
+        assert_equal(flowqueue.get_nowait(), SHUTDOWN_SENTINEL)
+    assert_equal(server.client_count, 0)
+
+    (flowqueue, _, thread) = start_remote(server.address, ["192.0.2.1"],
+                                          "secret")
+    wait_for_clients(server, 1)
+    server.close()
+    thread.join(3)
+    assert_equal(flowqueue.get_nowait(), SHUTDOWN_SENTINEL)
+
+def test_remote_server_token():
+    # a token is required unless listening on a loopback address
+    with assert_raises(ValueError):
+        FlowServer(("0.0.0.0", 0), flow_fields([BasicChain]))
+    server = FlowServer(("0.0.0.0", 0), flow_fields([BasicChain]),
+                        token="secret")
+    server.close()
+
+def test_remote_observer_quiet():
+    server = FlowServer(("127.0.0.1", 0), flow_fields([BasicChain]))
+    (flowqueue, irqueue, thread) = start_remote(server.address,
+                                                ["192.0.2.1"])
+    wait_for_clients(server, 1)
+    # an interrupt is noticed while no flows are being received
+    irqueue.put(True)
+    thread.join(3)
+    assert not thread.is_alive()
+    assert_equal(flowqueue.get_nowait(), SHUTDOWN_SENTINEL)
+    server.close()
+
+def test_remote_server_slow_spider():
+    server = FlowServer(("127.0.0.1", 0), flow_fields([BasicChain]),
+                        allow_all=True)
+    # a spider that connects for all of the flows and never reads them
+    stalled = socket.create_connection(server.address)
+    hello = json.dumps({"addresses": [], "token": None}).encode("utf-8")
+    stalled.sendall(struct.pack("!IB", len(hello), 2) + hello)
+    (flowqueue, _, thread) = start_remote(server.address, ["192.0.2.2"])
+    wait_for_clients(server, 2)
+
+    # the stalled spider is disconnected once its queue is full, without
+    # holding up the flows sent to the other spider
+    large = {'sip': "192.0.2.1", 'dip': "198.51.100.7", 'pad': "x" * 20000}
+    small = {'sip': "192.0.2.2", 'dip': "198.51.100.7"}
+    sent = 0
+    deadline = time.time() + 10
+    while server.client_count > 1:
+        assert time.time() < deadline
+        server.send([large, small])
+        sent += 1
+        # give the other spider time to keep up
+        time.sleep(0.001)
+    server.close()
+    thread.join(3)
+    assert not thread.is_alive()
+    assert_equal(received(flowqueue), [small] * sent)
+    stalled.close()
+
+class RemoteSpider(Spider):
+
+    chains = [BasicChain]
+
+def test_spider_remote_observer():
+    args = argparse.Namespace(observer_remote="192.0.2.10:7000")
+    spider = RemoteSpider(1, "pcap:capture.pcap", args, False)
+    observer = spider.create_observer()
+    assert isinstance(observer, RemoteObserver)
+    assert_equal(observer.address, ("192.0.2.10", 7000))
+    assert_equal(observer.addresses, ["127.0.0.1", "::1"])
+    assert_equal(observer.token, None)
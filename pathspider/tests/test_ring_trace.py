@@ -0,0 +1,138 @@
+import queue
+import socket
+import threading
+import time
+
+import nose
+from nose.tools import assert_equal
+
+from pathspider.chains.basic import BasicChain
+from pathspider.observer import Observer
+from pathspider.traces.merge import MergedTrace
+from pathspider.traces.packet import LINKTYPE_ETHERNET
+from pathspider.traces.ring import RingTrace
+
+# the tests capture on the loopback interface, which needs CAP_NET_RAW
+
+def start_ring(**kwargs):
+    if not hasattr(socket, "AF_PACKET"):
+        raise nose.SkipTest
+    trace = RingTrace("lo", promisc=False, **kwargs)
+    try:
+        trace.start()
+    except PermissionError:
+        raise nose.SkipTest
+    return trace
+
+def send_udp(ports):
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        for port in ports:
+            sock.sendto(b"pathspider", ("127.0.0.1", port))
+            # give the reader a chance to keep up with the small rings
+            time.sleep(0.001)
+
+def read_udp(trace, ports, seen):
+    for pkt in trace:
+        if pkt.udp is not None and pkt.udp.dst_port in ports:
+            seen.append((pkt.udp.dst_port, pkt.seconds, pkt.linktype,
+                         str(pkt.ip.dst_prefix)))
+
+def test_ring_trace_loopback():
+    # small blocks, so that the reader moves through the ring
+    trace = start_ring(block_size=4096, block_count=4)
+    ports = range(45000, 45100)
+    seen = []
+    reader = threading.Thread(target=read_udp, args=(trace, ports, seen),
+                              daemon=True)
+    reader.start()
+    start = time.time()
+    send_udp(ports)
+    deadline = time.time() + 5
+    while len({port for (port, _, _, _) in seen}) < len(ports):
+        assert time.time() < deadline
+        time.sleep(0.05)
+
+    # packets appear in order, once leaving and once arriving on lo
+    assert_equal(sorted(set(port for (port, _, _, _) in seen)), list(ports))
+    assert_equal([port for (port, _, _, _) in seen][:2], [45000, 45000])
+    for (_, seconds, linktype, dst) in seen:
+        assert start - 1 < seconds < time.time() + 1
+        assert_equal(linktype, LINKTYPE_ETHERNET)
+        assert_equal(dst, "127.0.0.1")
+    assert_equal(trace.pkt_drops(), 0)
+
+def test_ring_trace_fanout():
+    traces = [start_ring(fanout=0x5053, block_size=4096, block_count=4)
+              for _ in range(2)]
+    ports = range(46000, 46200)
+    seen = [[], []]
+    for (trace, trace_seen) in zip(traces, seen):
+        threading.Thread(target=read_udp, args=(trace, ports, trace_seen),
+                         daemon=True).start()
+    send_udp(ports)
+    deadline = time.time() + 5
+    while len({pkt[0] for pkts in seen for pkt in pkts}) < len(ports):
+        assert time.time() < deadline
+        time.sleep(0.05)
+
+    # each flow is delivered to one ring only
+    (first, second) = ({pkt[0] for pkt in pkts} for pkts in seen)
+    assert first and second
+    assert_equal(first & second, set())
+
+def test_ring_trace_merge():
+    trace = MergedTrace([start_ring(), start_ring()], ["lo0", "lo1"])
+    ports = range(48000, 48020)
+    seen = []
+    reader = threading.Thread(target=read_udp, args=(trace, ports, seen),
+                              daemon=True)
+    reader.start()
+    send_udp(ports)
+    send_udp([48020])
+    deadline = time.time() + 5
+    while len(seen) < 4 * len(ports):
+        assert time.time() < deadline
+        time.sleep(0.05)
+
+    # both rings see every packet, merged in timestamp order
+    seconds = [pt for (_, pt, _, _) in seen]
+    assert_equal(seconds, sorted(seconds))
+    assert_equal(sorted(set(port for (port, _, _, _) in seen)), list(ports))
+
+def test_observer_ring():
+    start_ring().close()
+    observers = [Observer("ring:lo", [BasicChain], shard=shard,
+                          shard_count=2) for shard in range(2)]
+    for observer in observers:
+        assert isinstance(observer._trace, RingTrace)
+        assert not observer._shard_check
+        observer._trace.close()
+    # the shards share a fanout group
+    assert observers[0]._fanout is not None
+    assert_equal(observers[0]._fanout, observers[1]._fanout)
+
+def test_observer_ring_flows():
+    start_ring().close()
+    observer = Observer("ring:lo", [BasicChain], idle_timeout=0,
+                        expiry_timeout=0, flush_interval=0, idle_tick=0.05)
+    flowqueue = queue.Queue()
+    irqueue = queue.Queue()
+    thread = threading.Thread(target=observer.run_flow_enqueuer,
+                              args=(flowqueue, irqueue), daemon=True)
+    thread.start()
+    send_udp([47000])
+
+    flows = []
+    deadline = time.time() + 5
+    while not any(flow['dp'] == 47000 for flow in flows):
+        flows.extend(flowqueue.get(timeout=deadline - time.time()))
+
+    # the observer stops at the next packet after being interrupted
+    irqueue.put(True)
+    send_udp([47001])
+    thread.join(3)
+    assert not thread.is_alive()
+
+    flow = [flow for flow in flows if flow['dp'] == 47000][0]
+    assert_equal(flow['sip'], "127.0.0.1")
+    assert_equal(flow['proto'], 17)
@@ -0,0 +1,64 @@
+from unittest import mock
+
+from nose.tools import assert_equal
+from nose.tools import assert_raises
+
+from pathspider.chains.tcp import parse_tcp_options
+from pathspider.chains.tcp import tcp_options
+from pathspider.chains.tcp import TO_MSS
+from pathspider.chains.tcp import TO_SACKOK
+from pathspider.chains.tcp import TO_TS
+from pathspider.chains.tcp import TO_WS
+
+# MSS 1460, SACK permitted, timestamps, NOP, window scale 7 (Linux SYN)
+LINUX_SYN = bytes([2, 4, 5, 180, 4, 2, 8, 10, 0, 0, 0, 1, 0, 0, 0, 0, 1, 3,
+                   3, 7])
+
+def test_tcp_options_parse():
+    opts = parse_tcp_options(LINUX_SYN)
+    assert_equal(sorted(opts), [TO_MSS, TO_WS, TO_SACKOK, TO_TS])
+    assert_equal(opts[TO_MSS], bytes([5, 180]))
+    assert_equal(opts[TO_WS], bytes([7]))
+    assert_equal(opts[TO_SACKOK], b"")
+    assert not opts.malformed
+
+def test_tcp_options_multiple():
+    opts = parse_tcp_options(bytes([2, 4, 5, 180, 1, 1, 2, 4, 2, 24]))
+    assert_equal(len(opts), 1)
+    # the last instance wins, all are kept in order
+    assert_equal(opts[TO_MSS], bytes([2, 24]))
+    assert_equal(opts.get_all(TO_MSS), (bytes([5, 180]), bytes([2, 24])))
+    assert_equal(opts.get_all(TO_WS), ())
+
+def test_tcp_options_eol():
+    opts = parse_tcp_options(bytes([3, 3, 7, 0, 2, 4, 5, 180]))
+    assert_equal(list(opts), [TO_WS])
+    assert not opts.malformed
+
+def test_tcp_options_malformed():
+    for optbytes in (bytes([2]),              # no length
+                     bytes([2, 0, 5, 180]),   # length too short
+                     bytes([2, 1, 5, 180]),   # length too short
+                     bytes([2, 6, 5, 180])):  # length past the end
+        opts = parse_tcp_options(optbytes)
+        assert opts.malformed
+        assert_equal(len(opts), 0)
+
+    # options before the malformed option are kept
+    opts = parse_tcp_options(bytes([3, 3, 7, 2, 9, 5]))
+    assert opts.malformed
+    assert_equal(opts[TO_WS], bytes([7]))
+
+def test_tcp_options_immutable():
+    opts = parse_tcp_options(LINUX_SYN)
+    with assert_raises(TypeError):
+        opts[TO_MSS] = bytes([2, 24]) # pylint: disable=unsupported-assignment-operation
+
+def test_tcp_options_cached():
+    tcp = mock.Mock(data=bytes(20) + LINUX_SYN, doff=10)
+    parse_tcp_options.cache_clear()
+    first = tcp_options(tcp)
+    tcp.data = bytearray(tcp.data)
+    second = tcp_options(tcp)
+    assert first is second
+    assert_equal(parse_tcp_options.cache_info().hits, 1)
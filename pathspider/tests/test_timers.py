@@ -0,0 +1,46 @@
+
+from nose.tools import assert_equal
+
+from pathspider.timers import TimingWheel
+
+def test_timers_deadline_order():
+    wheel = TimingWheel(slots=8, time=10)
+    wheel.schedule(14, "c")
+    wheel.schedule(12, "a")
+    wheel.schedule(13, "b")
+    wheel.schedule(30, "d")
+    assert_equal(len(wheel), 4)
+    assert_equal(list(wheel.expire(13)), ["a", "b"])
+    assert_equal(list(wheel.expire(20)), ["c"])
+    assert_equal(len(wheel), 1)
+    assert_equal(list(wheel.expire(30)), ["d"])
+    assert_equal(wheel.time, 30)
+
+def test_timers_jump():
+    wheel = TimingWheel(slots=8, time=0)
+    for deadline in (3, 20, 11, 1000, 5000):
+        wheel.schedule(deadline, deadline)
+    assert_equal(list(wheel.expire(1500)), [3, 11, 20, 1000])
+    assert_equal(wheel.time, 1500)
+    assert_equal(list(wheel.expire(6000)), [5000])
+    assert_equal(len(wheel), 0)
+
+def test_timers_schedule_while_expiring():
+    wheel = TimingWheel(slots=8, time=0)
+    wheel.schedule(2, "first")
+    fired = []
+    for item in wheel.expire(10):
+        fired.append((item, wheel.time))
+        if item == "first":
+            wheel.schedule(wheel.time + 3, "second")
+            wheel.schedule(wheel.time + 20, "later")
+            wheel.schedule(wheel.time - 1, "late")
+    assert_equal(fired, [("first", 2), ("late", 2), ("second", 5)])
+    assert_equal(list(wheel.expire(22)), ["later"])
+
+def test_timers_clear():
+    wheel = TimingWheel(slots=8, time=0)
+    wheel.schedule(2, "a")
+    wheel.clear()
+    assert_equal(len(wheel), 0)
+    assert_equal(list(wheel.expire(10)), [])
@@ -0,0 +1,107 @@
+
+import os
+import struct
+import tempfile
+
+import pkg_resources
+from nose.tools import assert_equal
+from nose.tools import assert_raises
+
+from pathspider import traces
+from pathspider.observer import _packet_source
+
+def _trace(name):
+    return pkg_resources.resource_filename("pathspider", "tests/data/" + name)
+
+def _packets(path):
+    trace = traces.trace("pcapfile:" + path)
+    trace.start()
+    packets = []
+    pkt = traces.packet()
+    while trace.read_packet(pkt):
+        ip = pkt.ip or pkt.ip6
+        packets.append((pkt.seconds, str(ip.src_prefix), str(ip.dst_prefix),
+                        ip.proto, bytes(ip.data)))
+    trace.close()
+    return packets
+
+def _pcapng(source, path):
+    """
+    Convert a little-endian, microsecond resolution pcap file to pcapng.
+    """
+
+    def block(btype, body):
+        body += b"\x00" * (-len(body) % 4)
+        return struct.pack("<II", btype, len(body) + 12) + body + \
+               struct.pack("<I", len(body) + 12)
+
+    with open(source, 'rb') as pcapfile:
+        data = pcapfile.read()
+    (linktype, ) = struct.unpack_from("<I", data, 20)
+    blocks = [block(0x0a0d0d0a, struct.pack("<IHHq", 0x1a2b3c4d, 1, 0, -1)),
+              block(1, struct.pack("<HHI", linktype, 0, 65535))]
+    offset = 24
+    while offset < len(data):
+        (sec, usec, caplen, wirelen) = struct.unpack_from("<IIII", data,
+                                                          offset)
+        timestamp = sec * 1000000 + usec
+        blocks.append(block(6, struct.pack(
+            "<IIIII", 0, timestamp >> 32, timestamp & 0xffffffff, caplen,
+            wirelen) + data[offset + 16:offset + 16 + caplen]))
+        offset += 16 + caplen
+    with open(path, 'wb') as pcapngfile:
+        pcapngfile.write(b"".join(blocks))
+
+def test_traces_pcap():
+    trace = traces.trace("pcap:" + _trace("tcp_http.pcap"))
+    trace.start()
+    pkt = traces.packet()
+    assert trace.read_packet(pkt)
+    assert_equal(pkt.seconds, 1084443427.311224)
+    assert_equal(str(pkt.ip.src_prefix), "145.254.160.237")
+    assert_equal(str(pkt.ip.dst_prefix), "65.208.228.223")
+    assert_equal((pkt.tcp.src_port, pkt.tcp.dst_port), (3372, 80))
+    assert_equal((pkt.tcp.flags, pkt.tcp.doff), (2, 7))
+    assert pkt.udp is None and pkt.ip6 is None
+    count = 1
+    while trace.read_packet(pkt):
+        count += 1
+    assert_equal(count, 43)
+
+def test_traces_ip6_udp():
+    packets = _packets(_trace("basic_ipv6_udp.pcap"))
+    assert_equal(len(packets), 2)
+    assert_equal(packets[0][1:4], ("2001:470:1d58:1337:4100:e1a1:8dcf:488",
+                                   "2001:4860:4860::8888", 17))
+
+def test_traces_pcapng():
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "tcp_http.pcapng")
+        _pcapng(_trace("tcp_http.pcap"), path)
+        assert_equal(_packets(path), _packets(_trace("tcp_http.pcap")))
+
+def test_traces_packet_source():
+    lturis = ["pcap:" + _trace("tcp_http.pcap")]
+    assert _packet_source(lturis, "python") is traces
+    assert_raises(ValueError, _packet_source, lturis, "dpdk")
+    assert_raises(ValueError, _packet_source, ["int:eth0"], "python")
+    assert not traces.supports("pcapfile:" + _trace("missing.pcap"))
+
+def test_traces_split_capture():
+    with tempfile.TemporaryDirectory() as directory:
+        pcapng = os.path.join(directory, "tcp_ecn.pcapng")
+        _pcapng(_trace("tcp_ecn.pcap"), pcapng)
+        for (source, extension) in ((_trace("tcp_ecn.pcap"), ".pcap"),
+                                    (pcapng, ".pcapng")):
+            packets = _packets(source)
+            paths = [os.path.join(directory, "split_{}{}".format(
+                index, extension)) for index in range(3)]
+            # TCP packets by port parity, and the rest left out
+            def choose(pkt):
+                return pkt.tcp.src_port % 2 if pkt.tcp else None
+            assert_equal(traces.split_capture(source, paths, choose),
+                         len(packets))
+            assert_equal(sorted(_packets(paths[0]) + _packets(paths[1])),
+                         sorted(packet for packet in packets
+                                if packet[3] == 6))
+            assert_equal(_packets(paths[2]), [])
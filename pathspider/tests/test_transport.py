@@ -0,0 +1,38 @@
+
+import json
+
+from nose.tools import assert_equal
+from nose.tools import assert_raises
+
+from pathspider.chains.basic import BasicChain
+from pathspider.chains.tcp import TCPChain
+from pathspider.observer import flow_fields
+from pathspider.transport import FlowCodec
+
+CHAINS = [BasicChain, TCPChain]
+
+def _flow(sp):
+    flow = {field.name: field.default for field in flow_fields(CHAINS)}
+    flow.update(pkt_first=1.5, sip="192.0.2.1", dip="198.51.100.7", proto=6,
+                sp=sp, dp=80, pkt_last=2.5)
+    return flow
+
+def test_transport_codec():
+    codec = FlowCodec(flow_fields(CHAINS))
+    undeclared = _flow(2)
+    undeclared['tcp_opts'] = [2, 4]
+    missing = _flow(3)
+    del missing['sp']
+    flows = [_flow(1), undeclared, missing]
+    packed = codec.pack(flows)
+    assert_equal(type(packed[0]), tuple)
+    assert_equal(packed[1:], [undeclared, missing])
+    for unpacked in (codec.unpack(packed),
+                     codec.unpack(json.loads(json.dumps(packed)))):
+        assert_equal(unpacked, flows)
+        for (flow, expected) in zip(unpacked, flows):
+            assert_equal(list(flow), list(expected))
+
+def test_transport_codec_invalid():
+    codec = FlowCodec(flow_fields(CHAINS))
+    assert_raises(ValueError, codec.unpack, [42])
@@ -0,0 +1,151 @@
+"""
+.. module:: pathspider.timers
+   :synopsis: A hashed timing wheel for packet clock timers
+
+This module contains the timing wheel used by PATHspider's Observer to track
+the idle and expiry deadlines of flows. Time is measured in integer ticks of
+the packet clock. Scheduling a timer is O(1) and advancing the clock costs
+one slot visit per tick. When the clock jumps further than one rotation (for
+example across a long silence in a capture file), the wheel skips directly to
+the next deadline instead of visiting every tick in between.
+
+.. codeauthor:: Iain R. Learmonth <irl@fsfe.org>
+
+"""
+
+import collections
+
+
+class TimingWheel:
+    """
+    A hashed timing wheel.
+
+    Timers are kept in the slot for their deadline modulo the size of the
+    wheel, so timers further away than one rotation share slots with nearer
+    ones and are skipped until their deadline is reached. Timers cannot be
+    cancelled; the owner is expected to check whether a timer is still
+    relevant when it fires.
+
+    .. code-block:: python
+
+     wheel = TimingWheel(time=10)
+     wheel.schedule(12, "a")
+     wheel.schedule(11, "b")
+     list(wheel.expire(15))  # ["b", "a"]
+
+    :param slots: The number of slots in the wheel, rounded up to a power of
+                  two
+    :type slots: int
+    :param time: The initial time of the wheel
+    :type time: int
+    """
+
+    def __init__(self, slots=256, time=0):
+        size = 1
+        while size < slots:
+            size <<= 1
+        self._mask = size - 1
+        # deadlines and items are kept in parallel lists for each slot to
+        # avoid allocating a pair for every timer
+        self._deadlines = [[] for _ in range(size)]
+        self._items = [[] for _ in range(size)]
+        self._due = collections.deque()
+        self._count = 0
+        self.time = time
+
+    def __len__(self):
+        return self._count
+
+    def schedule(self, deadline, item):
+        """
+        Schedule a timer. Timers with a deadline that has already passed will
+        fire the next time the wheel is expired.
+
+        :param deadline: The tick at which the timer fires
+        :type deadline: int
+        :param item: The value to return when the timer fires
+        """
+
+        if deadline <= self.time:
+            self._due.append(item)
+        else:
+            index = deadline & self._mask
+            self._deadlines[index].append(deadline)
+            self._items[index].append(item)
+        self._count += 1
+
+    def advance(self, time):
+        """
+        Move the clock forward without firing any timers. This must only be
+        used when no timers are scheduled before ``time``.
+
+        :param time: The new time
+        :type time: int
+        """
+
+        if time > self.time:
+            self.time = time
+
+    def expire(self, time):
+        """
+        Advance the clock, yielding the items of timers as they fire in
+        deadline order. Timers scheduled while iterating are fired if their
+        deadline is not after ``time``.
+
+        :param time: The new time
+        :type time: int
+        """
+
+        due = self._due
+        while due:
+            self._count -= 1
+            yield due.popleft()
+
+        # number of ticks since a timer last fired, starting as if a full
+        # rotation has passed so that a long jump skips ahead at once
+        quiet = self._mask + 1
+        while self.time < time:
+            if self._count == 0:
+                # nothing can fire, skip ahead
+                self.time = time
+                break
+            if quiet > self._mask and time - self.time > self._mask:
+                # a full rotation without any timers firing, skip ahead to
+                # the next deadline rather than visiting every slot
+                self.time = min(self._next_deadline(), time) - 1
+                quiet = 0
+            self.time += 1
+            index = self.time & self._mask
+            deadlines = self._deadlines[index]
+            if deadlines and min(deadlines) <= self.time:
+                quiet = 0
+                items = self._items[index]
+                keep_deadlines = self._deadlines[index] = []
+                keep_items = self._items[index] = []
+                for (deadline, item) in zip(deadlines, items):
+                    if deadline <= self.time:
+                        self._count -= 1
+                        yield item
+                    else:
+                        keep_deadlines.append(deadline)
+                        keep_items.append(item)
+            else:
+                quiet += 1
+            while due:
+                self._count -= 1
+                yield due.popleft()
+
+    def _next_deadline(self):
+        return min(min(deadlines) for deadlines in self._deadlines
+                   if deadlines)
+
+    def clear(self):
+        """
+        Remove all timers from the wheel.
+        """
+
+        for index in range(len(self._deadlines)):
+            self._deadlines[index] = []
+            self._items[index] = []
+        self._due.clear()
+        self._count = 0
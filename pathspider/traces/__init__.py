@@ -0,0 +1,111 @@
+"""
+.. module:: pathspider.traces
+   :synopsis: Pure Python packet sources for the Observer
+
+This package contains packet sources that can be used by the Observer in
+place of `python-libtrace
+<https://www.cs.auckland.ac.nz/~nevil/python-libtrace/>`_. The :func:`trace`
+and :func:`packet` functions mirror those of the ``plt`` module, so the
+package can be used wherever the Observer would use libtrace.
+
+Capture files given by ``pcap:`` and ``pcapfile:`` URIs are read with
+:class:`pathspider.traces.pcap.PcapTrace`. On Linux, ``ring:`` URIs (e.g.
+``ring:eth0``) capture live from the named interface with
+:class:`pathspider.traces.ring.RingTrace`. Several packet sources can be
+read at once with :class:`pathspider.traces.merge.MergedTrace`.
+
+.. codeauthor:: Iain R. Learmonth <irl@fsfe.org>
+
+"""
+
+from pathspider.traces.merge import MergedTrace
+from pathspider.traces.packet import Packet
+from pathspider.traces.pcap import PcapTrace
+from pathspider.traces.pcap import PcapWriter
+from pathspider.traces.pcap import is_capture_file
+from pathspider.traces.pcap import split_capture
+from pathspider.traces.ring import RingTrace
+
+#: libtrace URI formats for capture files that can be read by PcapTrace
+CAPTURE_FILE_FORMATS = ("pcap", "pcapfile")
+
+#: URI format for live capture with RingTrace
+RING_FORMAT = "ring"
+
+#: libtrace URI formats for live capture, whose packets are timestamped with
+#: the wall clock
+LIVE_FORMATS = (RING_FORMAT, "int", "pcapint", "bpf", "dag", "dpdk", "xdp")
+
+
+def supports(uri):
+    """
+    Check whether a libtrace URI can be read by the packet sources in this
+    package.
+
+    :param uri: the libtrace URI
+    :type uri: str
+    :rtype: bool
+    """
+
+    (fmt, _, path) = uri.partition(":")
+    if fmt == RING_FORMAT:
+        return bool(path)
+    return fmt in CAPTURE_FILE_FORMATS and is_capture_file(path)
+
+
+def is_ring(uri):
+    """
+    Check whether a URI is for live capture with
+    :class:`pathspider.traces.ring.RingTrace`.
+
+    :param uri: the URI
+    :type uri: str
+    :rtype: bool
+    """
+
+    return uri.partition(":")[0] == RING_FORMAT
+
+
+def is_live(uri):
+    """
+    Check whether a libtrace URI is for live capture from an interface,
+    rather than for reading a capture file.
+
+    :param uri: the libtrace URI
+    :type uri: str
+    :rtype: bool
+    """
+
+    return uri.partition(":")[0] in LIVE_FORMATS
+
+
+def trace(uri, fanout=None):
+    """
+    Create a packet source for a libtrace URI.
+
+    :param uri: the libtrace URI
+    :type uri: str
+    :param fanout: The PACKET_FANOUT group to join for ``ring:`` URIs
+    :type fanout: int
+    :rtype: pathspider.traces.pcap.PcapTrace or
+            pathspider.traces.ring.RingTrace
+    :raises ValueError: if the URI is not supported
+    """
+
+    (fmt, _, path) = uri.partition(":")
+    if fmt == RING_FORMAT:
+        return RingTrace(path, fanout=fanout)
+    if fmt not in CAPTURE_FILE_FORMATS:
+        raise ValueError("Unsupported packet source " + repr(uri) +
+                         ", python-libtrace is required")
+    return PcapTrace(path)
+
+
+def packet():
+    """
+    Create a packet to be filled by a packet source.
+
+    :rtype: pathspider.traces.packet.Packet
+    """
+
+    return Packet()
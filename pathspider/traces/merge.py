@@ -0,0 +1,161 @@
+"""
+.. module:: pathspider.traces.merge
+   :synopsis: Merging several packet sources in timestamp order
+
+This module contains a packet source that reads from several other packet
+sources at once and passes on their packets in timestamp order, so that a
+single Observer can track the flows seen on several interfaces of a
+multi-homed host in one flow table.
+
+.. codeauthor:: Iain R. Learmonth <irl@fsfe.org>
+
+"""
+
+import select
+import time
+
+from pathspider.traces.packet import Packet
+
+
+class MergedTrace:
+    """
+    A packet source merging the packets of several packet sources in
+    timestamp order.
+
+    Capture files are merged exactly. Live sources, which provide
+    ``poll_packet()`` and ``fileno()`` like
+    :class:`pathspider.traces.ring.RingTrace`, may not have handed over a
+    packet yet when another source has one. A packet is then held back
+    until it is ``lag`` seconds old, by the wall clock, in case a quiet
+    source hands over an earlier packet in the meantime.
+
+    :param traces: the packet sources to merge
+    :type traces: list
+    :param names: the names of the packet sources (e.g. the names of the
+                  interfaces captured on)
+    :type names: list(str)
+    :param lag: The time in seconds that a live source may take to hand
+                over a packet after it was captured, which must be longer
+                than the block timeout of a
+                :class:`~pathspider.traces.ring.RingTrace`
+    :type lag: float
+    """
+
+    def __init__(self, traces, names, lag=0.25):
+        if len(traces) != len(names):
+            raise ValueError("Each packet source to be merged needs a name")
+        self.traces = traces
+        self.names = names
+        #: The name of the packet source of the last packet read
+        self.name = None
+        self._lag = lag
+
+        # the next packet of each source, and the sources that have not yet
+        # been exhausted
+        self._pkts = [Packet() for _ in traces]
+        self._heads = [None] * len(traces)
+        self._open = list(range(len(traces)))
+        self._live = [hasattr(trace, "poll_packet") for trace in traces]
+
+    def start(self):
+        """
+        Start all of the packet sources.
+        """
+
+        for trace in self.traces:
+            trace.start()
+
+    def pkt_drops(self):
+        """
+        Get the number of packets dropped by all of the packet sources.
+
+        :rtype: int
+        """
+
+        return sum(trace.pkt_drops() for trace in self.traces)
+
+    def read_packet(self, pkt):
+        """
+        Read the earliest packet of any of the packet sources into a
+        :class:`pathspider.traces.packet.Packet`, waiting for the live
+        sources if necessary.
+
+        :param pkt: the packet to fill
+        :type pkt: pathspider.traces.packet.Packet
+        :returns: ``False`` when all of the sources are exhausted
+        :rtype: bool
+        """
+
+        heads = self._heads
+        while True:
+            quiet = [index for index in list(self._open)
+                     if heads[index] is None and not self._fill(index)]
+            ready = [index for index in self._open if heads[index] is not None]
+            if not ready:
+                if not quiet:
+                    return False
+                self._wait(quiet, None)
+                continue
+
+            first = min(ready, key=lambda index: heads[index].seconds)
+            head = heads[first]
+            if quiet:
+                # a quiet live source may still hand over an earlier packet
+                wait = head.seconds + self._lag - time.time()
+                if wait > 0:
+                    self._wait(quiet, wait)
+                    continue
+
+            # the source is read again when the next packet is read, so the
+            # packet remains valid until then
+            # pylint: disable=protected-access
+            heads[first] = None
+            self.name = self.names[first]
+            pkt.set(head._buf, head._start, head._end, head.seconds,
+                    head.linktype, head.wire_len)
+            return True
+
+    def __iter__(self):
+        pkt = Packet()
+        while self.read_packet(pkt):
+            yield pkt
+
+    def close(self):
+        """
+        Close all of the packet sources.
+        """
+
+        for trace in self.traces:
+            trace.close()
+        self._heads = [None] * len(self.traces)
+        self._open = []
+
+    def _fill(self, index):
+        """
+        Read the next packet of a source, if it has one ready.
+
+        :returns: None if the source is a live source without a packet
+                  ready, otherwise True (the source either has a packet or
+                  is exhausted)
+        """
+
+        trace = self.traces[index]
+        pkt = self._pkts[index]
+        if self._live[index]:
+            read = trace.poll_packet(pkt)
+        else:
+            read = trace.read_packet(pkt)
+        if read:
+            self._heads[index] = pkt
+            return True
+        if read is False:
+            self._open.remove(index)
+            return True
+        return None
+
+    def _wait(self, quiet, timeout):
+        poll = select.poll()
+        for index in quiet:
+            poll.register(self.traces[index].fileno(),
+                          select.POLLIN | select.POLLERR)
+        poll.poll(None if timeout is None else timeout * 1000)
@@ -0,0 +1,602 @@
+"""
+.. module:: pathspider.traces.packet
+   :synopsis: Lightweight header views over captured packet buffers
+
+This module contains zero-copy views over packets held in a buffer (typically
+a memory-mapped capture file or a capture ring). The views expose the subset
+of the `python-libtrace <https://www.cs.auckland.ac.nz/~nevil/python-libtrace/>`_
+packet API that is used by PATHspider's Observer and flow analysis chains, so
+that chains can be run against packets from sources other than libtrace.
+
+Header fields are decoded on access with :func:`struct.unpack_from` directly
+from the underlying buffer. Byte string attributes such as ``data`` and
+``payload`` are returned as :class:`memoryview` slices of the buffer and are
+only valid until the next packet is read into the same :class:`Packet`.
+
+.. codeauthor:: Iain R. Learmonth <irl@fsfe.org>
+
+"""
+
+import socket
+import struct
+
+#: Link type - BSD loopback encapsulation (host byte order)
+LINKTYPE_NULL = 0
+#: Link type - Ethernet
+LINKTYPE_ETHERNET = 1
+#: Link type - Raw IP (BSD value)
+LINKTYPE_RAW_BSD = 12
+#: Link type - Raw IP (OpenBSD value)
+LINKTYPE_RAW_OBSD = 14
+#: Link type - Raw IP
+LINKTYPE_RAW = 101
+#: Link type - OpenBSD loopback encapsulation (network byte order)
+LINKTYPE_LOOP = 108
+#: Link type - Linux "cooked" capture
+LINKTYPE_LINUX_SLL = 113
+#: Link type - Raw IPv4
+LINKTYPE_IPV4 = 228
+#: Link type - Raw IPv6
+LINKTYPE_IPV6 = 229
+#: Link type - Linux "cooked" capture, version 2
+LINKTYPE_LINUX_SLL2 = 276
+
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_IPV6 = 0x86DD
+ETHERTYPE_VLAN = (0x8100, 0x88A8, 0x9100)
+
+_U16 = struct.Struct("!H")
+_U32 = struct.Struct("!I")
+
+_IP6_EXTENSION_HEADERS = {0, 43, 60, 51}
+_IP6_FRAGMENT = 44
+
+_ICMP4_QUOTATION_TYPES = {3, 4, 5, 11, 12}
+_ICMP6_QUOTATION_TYPES = {1, 2, 3, 4}
+
+
+class IPPrefix:
+    """
+    An IPv4 or IPv6 host address, compatible with the parts of
+    ``plt.IPprefix`` used by the Observer.
+    """
+
+    __slots__ = ("version", "addr")
+
+    def __init__(self, version, addr):
+        self.version = version
+        self.addr = addr
+
+    def __str__(self):
+        return socket.inet_ntop(
+            socket.AF_INET if self.version == 4 else socket.AF_INET6,
+            self.addr)
+
+    def __repr__(self):
+        return "IPPrefix({!r})".format(str(self))
+
+    def __eq__(self, other):
+        return (isinstance(other, IPPrefix) and
+                self.version == other.version and self.addr == other.addr)
+
+    def __hash__(self):
+        return hash(self.addr)
+
+
+class _Header:
+    __slots__ = ("_buf", "_off", "_end")
+
+    def __init__(self, buf, off, end):
+        self._buf = buf
+        self._off = off
+        self._end = end
+
+    @property
+    def data(self):
+        """The captured bytes of this header and everything following it."""
+        return self._buf[self._off:self._end]
+
+
+class TCP(_Header):
+    """A TCP header view."""
+
+    __slots__ = ()
+
+    @property
+    def src_port(self):
+        return _U16.unpack_from(self._buf, self._off)[0]
+
+    @property
+    def dst_port(self):
+        return _U16.unpack_from(self._buf, self._off + 2)[0]
+
+    @property
+    def seq_nbr(self):
+        return _U32.unpack_from(self._buf, self._off + 4)[0]
+
+    @property
+    def ack_nbr(self):
+        return _U32.unpack_from(self._buf, self._off + 8)[0]
+
+    @property
+    def doff(self):
+        return self._buf[self._off + 12] >> 4
+
+    @property
+    def flags(self):
+        return self._buf[self._off + 13]
+
+    @property
+    def urg_flag(self):
+        return bool(self._buf[self._off + 13] & 0x20)
+
+    @property
+    def ack_flag(self):
+        return bool(self._buf[self._off + 13] & 0x10)
+
+    @property
+    def psh_flag(self):
+        return bool(self._buf[self._off + 13] & 0x08)
+
+    @property
+    def rst_flag(self):
+        return bool(self._buf[self._off + 13] & 0x04)
+
+    @property
+    def syn_flag(self):
+        return bool(self._buf[self._off + 13] & 0x02)
+
+    @property
+    def fin_flag(self):
+        return bool(self._buf[self._off + 13] & 0x01)
+
+    @property
+    def window(self):
+        return _U16.unpack_from(self._buf, self._off + 14)[0]
+
+    @property
+    def checksum(self):
+        return _U16.unpack_from(self._buf, self._off + 16)[0]
+
+    @property
+    def payload(self):
+        start = self._off + (self._buf[self._off + 12] >> 4) * 4
+        if start > self._end:
+            return None
+        return self._buf[start:self._end]
+
+
+class UDP(_Header):
+    """A UDP header view."""
+
+    __slots__ = ()
+
+    @property
+    def src_port(self):
+        return _U16.unpack_from(self._buf, self._off)[0]
+
+    @property
+    def dst_port(self):
+        return _U16.unpack_from(self._buf, self._off + 2)[0]
+
+    @property
+    def len(self):
+        return _U16.unpack_from(self._buf, self._off + 4)[0]
+
+    @property
+    def checksum(self):
+        return _U16.unpack_from(self._buf, self._off + 6)[0]
+
+    @property
+    def payload(self):
+        return self._buf[self._off + 8:self._end]
+
+
+class ICMP(_Header):
+    """An ICMPv4 header view."""
+
+    __slots__ = ()
+
+    _quotation_types = _ICMP4_QUOTATION_TYPES
+
+    @property
+    def type(self):
+        return self._buf[self._off]
+
+    @property
+    def code(self):
+        return self._buf[self._off + 1]
+
+    @property
+    def checksum(self):
+        return _U16.unpack_from(self._buf, self._off + 2)[0]
+
+    @property
+    def payload(self):
+        """
+        The quoted packet for message types that carry a quotation, or
+        ``None``.
+        """
+        start = self._off + 8
+        if (self._buf[self._off] not in self._quotation_types or
+                start >= self._end):
+            return None
+        return _ip_view(self._buf, start, self._end, quotation=True)
+
+
+class ICMP6(ICMP):
+    """An ICMPv6 header view."""
+
+    __slots__ = ()
+
+    _quotation_types = _ICMP6_QUOTATION_TYPES
+
+
+class IP(_Header):
+    """An IPv4 header view."""
+
+    __slots__ = ("seconds", "_capend")
+
+    version = 4
+
+    def __init__(self, buf, off, end, seconds=None, quotation=False):
+        self._capend = end
+        if not quotation and end - off >= 4:
+            # Trim link layer padding beyond the IP total length
+            end = min(end, off + _U16.unpack_from(buf, off + 2)[0])
+        super().__init__(buf, off, end)
+        self.seconds = seconds
+
+    @property
+    def hdr_len(self):
+        return self._buf[self._off] & 0x0f
+
+    @property
+    def traffic_class(self):
+        return self._buf[self._off + 1]
+
+    @property
+    def pkt_len(self):
+        return _U16.unpack_from(self._buf, self._off + 2)[0]
+
+    @property
+    def size(self):
+        """The number of captured bytes from the start of this header."""
+        return self._capend - self._off
+
+    @property
+    def ident(self):
+        return _U16.unpack_from(self._buf, self._off + 4)[0]
+
+    @property
+    def has_rf(self):
+        return bool(self._buf[self._off + 6] & 0x80)
+
+    @property
+    def has_df(self):
+        return bool(self._buf[self._off + 6] & 0x40)
+
+    @property
+    def has_mf(self):
+        return bool(self._buf[self._off + 6] & 0x20)
+
+    @property
+    def frag_offset(self):
+        return _U16.unpack_from(self._buf, self._off + 6)[0] & 0x1fff
+
+    @property
+    def ttl(self):
+        return self._buf[self._off + 8]
+
+    @property
+    def proto(self):
+        return self._buf[self._off + 9]
+
+    @property
+    def src_prefix(self):
+        off = self._off + 12
+        return IPPrefix(4, bytes(self._buf[off:off + 4]))
+
+    @property
+    def dst_prefix(self):
+        off = self._off + 16
+        return IPPrefix(4, bytes(self._buf[off:off + 4]))
+
+    def _transport_offset(self):
+        if _U16.unpack_from(self._buf, self._off + 6)[0] & 0x1fff:
+            # Not the first fragment, no transport header
+            return None
+        return self._off + (self._buf[self._off] & 0x0f) * 4
+
+    @property
+    def payload(self):
+        return self._buf[self._off + (self._buf[self._off] & 0x0f) * 4:self._end]
+
+    def _transport(self, proto, cls, minlen):
+        if self._buf[self._off + 9] != proto:
+            return None
+        off = self._transport_offset()
+        if off is None or self._end - off < minlen:
+            return None
+        return cls(self._buf, off, self._end)
+
+    @property
+    def tcp(self):
+        return self._transport(6, TCP, 20)
+
+    @property
+    def udp(self):
+        return self._transport(17, UDP, 8)
+
+    @property
+    def icmp(self):
+        return self._transport(1, ICMP, 8)
+
+    @property
+    def icmp6(self):
+        return None
+
+
+class IP6(_Header):
+    """An IPv6 header view."""
+
+    __slots__ = ("seconds", "_capend", "_nh", "_poff")
+
+    version = 6
+
+    def __init__(self, buf, off, end, seconds=None, quotation=False):
+        self._capend = end
+        if not quotation and end - off >= 6:
+            # Trim link layer padding beyond the IPv6 payload length
+            end = min(end, off + 40 + _U16.unpack_from(buf, off + 4)[0])
+        super().__init__(buf, off, end)
+        self.seconds = seconds
+        self._nh = None
+        self._poff = None
+
+    def _walk(self):
+        buf = self._buf
+        nh = buf[self._off + 6]
+        off = self._off + 40
+        while nh in _IP6_EXTENSION_HEADERS or nh == _IP6_FRAGMENT:
+            if off + 8 > self._end:
+                break
+            if nh == _IP6_FRAGMENT:
+                if _U16.unpack_from(buf, off + 2)[0] & 0xfff8:
+                    # Not the first fragment, no transport header
+                    self._nh = buf[off]
+                    self._poff = None
+                    return
+                hlen = 8
+            elif nh == 51:
+                hlen = (buf[off + 1] + 2) * 4
+            else:
+                hlen = (buf[off + 1] + 1) * 8
+            nh = buf[off]
+            off += hlen
+        self._nh = nh
+        self._poff = off
+
+    @property
+    def traffic_class(self):
+        return (((self._buf[self._off] & 0x0f) << 4) |
+                (self._buf[self._off + 1] >> 4))
+
+    @property
+    def flow_label(self):
+        return _U32.unpack_from(self._buf, self._off)[0] & 0xfffff
+
+    @property
+    def payload_len(self):
+        return _U16.unpack_from(self._buf, self._off + 4)[0]
+
+    @property
+    def size(self):
+        """The number of captured bytes from the start of this header."""
+        return self._capend - self._off
+
+    @property
+    def next_hdr(self):
+        return self._buf[self._off + 6]
+
+    @property
+    def hop_limit(self):
+        return self._buf[self._off + 7]
+
+    @property
+    def proto(self):
+        if self._nh is None:
+            self._walk()
+        return self._nh
+
+    @property
+    def src_prefix(self):
+        off = self._off + 8
+        return IPPrefix(6, bytes(self._buf[off:off + 16]))
+
+    @property
+    def dst_prefix(self):
+        off = self._off + 24
+        return IPPrefix(6, bytes(self._buf[off:off + 16]))
+
+    @property
+    def payload(self):
+        if self._nh is None:
+            self._walk()
+        if self._poff is None:
+            return self._buf[self._off + 40:self._end]
+        return self._buf[self._poff:self._end]
+
+    def _transport(self, proto, cls, minlen):
+        if self._nh is None:
+            self._walk()
+        if self._nh != proto or self._poff is None:
+            return None
+        if self._end - self._poff < minlen:
+            return None
+        return cls(self._buf, self._poff, self._end)
+
+    @property
+    def tcp(self):
+        return self._transport(6, TCP, 20)
+
+    @property
+    def udp(self):
+        return self._transport(17, UDP, 8)
+
+    @property
+    def icmp(self):
+        return None
+
+    @property
+    def icmp6(self):
+        return self._transport(58, ICMP6, 8)
+
+
+def _ip_view(buf, off, end, seconds=None, quotation=False):
+    if off >= end:
+        return None
+    version = buf[off] >> 4
+    if version == 4 and end - off >= 20:
+        return IP(buf, off, end, seconds, quotation)
+    if version == 6 and end - off >= 40:
+        return IP6(buf, off, end, seconds, quotation)
+    return None
+
+
+def network_offset(buf, start, end, linktype):
+    """
+    Find the offset of the network layer header in a captured frame.
+
+    :param buf: the buffer containing the frame
+    :param start: offset of the start of the frame in the buffer
+    :param end: offset of the end of the captured frame in the buffer
+    :param linktype: the pcap link type of the frame
+    :returns: the offset of the IP or IPv6 header, or ``None`` if the frame
+              does not carry IP
+    :rtype: int
+    """
+
+    if linktype == LINKTYPE_ETHERNET:
+        off = start + 12
+        if off + 2 > end:
+            return None
+        ethertype = _U16.unpack_from(buf, off)[0]
+        while ethertype in ETHERTYPE_VLAN and off + 6 <= end:
+            off += 4
+            ethertype = _U16.unpack_from(buf, off)[0]
+        if ethertype in (ETHERTYPE_IPV4, ETHERTYPE_IPV6):
+            return off + 2
+        return None
+    if linktype in (LINKTYPE_RAW, LINKTYPE_RAW_BSD, LINKTYPE_RAW_OBSD,
+                    LINKTYPE_IPV4, LINKTYPE_IPV6):
+        return start
+    if linktype == LINKTYPE_LINUX_SLL:
+        if start + 16 > end:
+            return None
+        if _U16.unpack_from(buf, start + 14)[0] in (ETHERTYPE_IPV4,
+                                                    ETHERTYPE_IPV6):
+            return start + 16
+        return None
+    if linktype == LINKTYPE_LINUX_SLL2:
+        if start + 20 > end:
+            return None
+        if _U16.unpack_from(buf, start)[0] in (ETHERTYPE_IPV4,
+                                               ETHERTYPE_IPV6):
+            return start + 20
+        return None
+    if linktype in (LINKTYPE_NULL, LINKTYPE_LOOP):
+        # The address family is in host byte order for NULL, so only the
+        # IP version nibble is trusted here
+        if start + 4 >= end:
+            return None
+        return start + 4
+    return None
+
+
+class Packet:
+    """
+    A reusable packet object, filled in by a packet source for each packet
+    read. This is compatible with the parts of ``plt.packet`` used by the
+    Observer: ``seconds``, ``ip``, ``ip6``, ``tcp``, ``udp``, ``icmp`` and
+    ``icmp6``.
+    """
+
+    __slots__ = ("seconds", "linktype", "wire_len", "_buf", "_start", "_end",
+                 "_l3", "_view")
+
+    def __init__(self):
+        self.seconds = 0.0
+        self.linktype = LINKTYPE_RAW
+        self.wire_len = 0
+        self._buf = b""
+        self._start = 0
+        self._end = 0
+        self._l3 = None
+        self._view = None
+
+    def set(self, buf, start, end, seconds, linktype, wire_len=None):
+        """
+        Point this packet at a new captured frame. This is called by packet
+        sources and discards any views decoded for the previous frame.
+        """
+
+        self._buf = buf
+        self._start = start
+        self._end = end
+        self.seconds = seconds
+        self.linktype = linktype
+        self.wire_len = end - start if wire_len is None else wire_len
+        self._l3 = network_offset(buf, start, end, linktype)
+        self._view = False
+
+    def _network(self):
+        if self._view is False:
+            self._view = None
+            if self._l3 is not None:
+                self._view = _ip_view(self._buf, self._l3, self._end,
+                                      self.seconds)
+        return self._view
+
+    @property
+    def data(self):
+        """The captured bytes of the frame, including the link layer."""
+        return self._buf[self._start:self._end]
+
+    @property
+    def capture_len(self):
+        return self._end - self._start
+
+    @property
+    def ip(self):
+        view = self._network()
+        if view is not None and view.version == 4:
+            return view
+        return None
+
+    @property
+    def ip6(self):
+        view = self._network()
+        if view is not None and view.version == 6:
+            return view
+        return None
+
+    @property
+    def tcp(self):
+        view = self._network()
+        return view.tcp if view is not None else None
+
+    @property
+    def udp(self):
+        view = self._network()
+        return view.udp if view is not None else None
+
+    @property
+    def icmp(self):
+        view = self._network()
+        return view.icmp if view is not None else None
+
+    @property
+    def icmp6(self):
+        view = self._network()
+        return view.icmp6 if view is not None else None
@@ -0,0 +1,383 @@
+"""
+.. module:: pathspider.traces.pcap
+   :synopsis: A memory-mapped pcap and pcapng packet source
+
+This module contains a pure Python packet source for classic pcap and pcapng
+capture files. The capture file is memory-mapped and records are walked in
+place, with each packet exposed through the zero-copy header views in
+:mod:`pathspider.traces.packet`. This avoids the per-packet object
+construction cost of libtrace for offline analysis and allows the Observer to
+be used where python-libtrace is not installed.
+
+It also contains :class:`PcapWriter`, used by the Observer to write the
+packets of selected flows to a set of rotating capture files, and
+:func:`split_capture`, used to split a capture file by flow for offline
+analysis in parallel.
+
+.. codeauthor:: Iain R. Learmonth <irl@fsfe.org>
+
+"""
+
+import mmap
+import struct
+
+from pathspider.traces.packet import LINKTYPE_RAW
+from pathspider.traces.packet import Packet
+
+PCAP_MAGIC_USEC = 0xa1b2c3d4
+PCAP_MAGIC_NSEC = 0xa1b23c4d
+PCAPNG_SHB = 0x0a0d0d0a
+PCAPNG_BYTE_ORDER_MAGIC = 0x1a2b3c4d
+
+_PCAPNG_IDB = 0x00000001
+_PCAPNG_OPB = 0x00000002
+_PCAPNG_SPB = 0x00000003
+_PCAPNG_EPB = 0x00000006
+
+_IF_TSRESOL = 9
+_IF_TSOFFSET = 14
+
+_PCAP_HEADER = struct.Struct("<IHHiIII")
+_PCAP_RECORD = struct.Struct("<IIII")
+_U16 = struct.Struct("!H")
+
+_MAGICS = {
+    b"\xd4\xc3\xb2\xa1": ("<", 1e-6),
+    b"\xa1\xb2\xc3\xd4": (">", 1e-6),
+    b"\x4d\x3c\xb2\xa1": ("<", 1e-9),
+    b"\xa1\xb2\x3c\x4d": (">", 1e-9),
+}
+
+
+def is_capture_file(path):
+    """
+    Check whether a file is an uncompressed pcap or pcapng capture file that
+    can be read by :class:`PcapTrace`.
+
+    :param path: the path to the file
+    :type path: str
+    :rtype: bool
+    """
+
+    try:
+        with open(path, "rb") as fh:
+            magic = fh.read(4)
+    except OSError:
+        return False
+    return magic in _MAGICS or magic == b"\x0a\x0d\x0d\x0a"
+
+
+class PcapTrace:
+    """
+    A packet source reading a pcap or pcapng file through a memory map.
+
+    The interface mirrors the parts of ``plt.trace`` used by the Observer, so
+    the trace can be used wherever a libtrace trace is expected:
+
+    .. code-block:: python
+
+     trace = PcapTrace("capture.pcap")
+     trace.start()
+     pkt = Packet()
+     while trace.read_packet(pkt):
+         print(pkt.seconds, pkt.ip)
+
+    :param path: the path to the capture file
+    :type path: str
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "rb")
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files cannot be mapped
+            self._map = None
+        self._buf = memoryview(self._map) if self._map is not None else b""
+        self._size = len(self._buf)
+        self._pos = 0
+        # start and end of the record for the last packet read
+        self._span = (0, 0)
+
+        magic = bytes(self._buf[0:4])
+        if magic in _MAGICS:
+            self._read = self._read_pcap
+            (self._endian, self._tsres) = _MAGICS[magic]
+            self._rec = struct.Struct(self._endian + "IIII")
+            self._linktype = struct.unpack_from(self._endian + "I",
+                                                self._buf, 20)[0] & 0x0fffffff
+            self._pos = 24
+        elif magic == b"\x0a\x0d\x0d\x0a":
+            self._read = self._read_pcapng
+            self._endian = "<"
+            self._interfaces = []
+        else:
+            self.close()
+            raise ValueError("{} is not a pcap or pcapng file".format(path))
+
+    def start(self):
+        """
+        Start the trace. This is a no-op, present for compatibility with
+        libtrace traces.
+        """
+
+    def pkt_drops(self): # pylint: disable=no-self-use
+        """
+        Capture files do not record drops, so this always returns 0.
+        """
+        return 0
+
+    def read_packet(self, pkt):
+        """
+        Read the next packet from the capture into a :class:`Packet`.
+
+        :param pkt: the packet to fill
+        :type pkt: pathspider.traces.packet.Packet
+        :returns: ``False`` when there are no more packets to read
+        :rtype: bool
+        """
+        return self._read(pkt)
+
+    def __iter__(self):
+        pkt = Packet()
+        while self._read(pkt):
+            yield pkt
+
+    def close(self):
+        """
+        Release the memory map and close the capture file.
+        """
+
+        self._buf = b""
+        if self._map is not None:
+            try:
+                self._map.close()
+            except BufferError:
+                # Views handed out for the last packet are still referenced
+                pass
+            self._map = None
+        self._file.close()
+
+    def _read_pcap(self, pkt):
+        pos = self._pos
+        if pos + 16 > self._size:
+            return False
+        (sec, frac, caplen, wirelen) = self._rec.unpack_from(self._buf, pos)
+        start = pos + 16
+        end = start + caplen
+        if end > self._size:
+            # Truncated final record
+            return False
+        self._pos = end
+        self._span = (pos, end)
+        pkt.set(self._buf, start, end, sec + frac * self._tsres,
+                self._linktype, wirelen)
+        return True
+
+    def _read_pcapng(self, pkt):
+        buf = self._buf
+        while self._pos + 12 <= self._size:
+            pos = self._pos
+            (btype, blen) = struct.unpack_from(self._endian + "II", buf, pos)
+            if btype == PCAPNG_SHB:
+                bom = struct.unpack_from("<I", buf, pos + 8)[0]
+                self._endian = "<" if bom == PCAPNG_BYTE_ORDER_MAGIC else ">"
+                blen = struct.unpack_from(self._endian + "I", buf, pos + 4)[0]
+                self._interfaces = []
+            if blen < 12 or pos + blen > self._size:
+                # Corrupt or truncated block
+                return False
+            self._pos = pos + blen
+            body = pos + 8
+
+            if btype == _PCAPNG_EPB:
+                (ifid, tshi, tslo, caplen, wirelen) = struct.unpack_from(
+                    self._endian + "IIIII", buf, body)
+                start = body + 20
+            elif btype == _PCAPNG_OPB:
+                (ifid, _, tshi, tslo, caplen, wirelen) = struct.unpack_from(
+                    self._endian + "HHIIII", buf, body)
+                start = body + 20
+            elif btype == _PCAPNG_SPB:
+                wirelen = struct.unpack_from(self._endian + "I", buf, body)[0]
+                (ifid, tshi, tslo) = (0, 0, 0)
+                start = body + 4
+                caplen = min(wirelen, blen - 16)
+            else:
+                if btype == _PCAPNG_IDB:
+                    self._interfaces.append(self._parse_idb(body, pos + blen - 4))
+                continue
+
+            if ifid >= len(self._interfaces):
+                continue
+            (linktype, units, tsres, tsoff) = self._interfaces[ifid]
+            # whole seconds and fractions are combined as for pcap files, so
+            # that timestamps are the same whichever format was used
+            timestamp = (tshi << 32) | tslo
+            seconds = (timestamp // units + (timestamp % units) * tsres +
+                       tsoff)
+            self._span = (pos, pos + blen)
+            pkt.set(buf, start, start + caplen, seconds, linktype, wirelen)
+            return True
+        return False
+
+    def _parse_idb(self, body, end):
+        buf = self._buf
+        linktype = struct.unpack_from(self._endian + "H", buf, body)[0]
+        units = 1000000
+        tsoff = 0
+        opt = body + 8
+        while opt + 4 <= end:
+            (code, olen) = struct.unpack_from(self._endian + "HH", buf, opt)
+            if code == 0:
+                break
+            if code == _IF_TSRESOL and olen >= 1:
+                res = buf[opt + 4]
+                units = 2 ** (res & 0x7f) if res & 0x80 else 10 ** res
+            elif code == _IF_TSOFFSET and olen >= 8:
+                tsoff = struct.unpack_from(self._endian + "q", buf, opt + 4)[0]
+            opt += 4 + ((olen + 3) & ~3)
+        return (linktype, units, 1 / units, tsoff)
+
+
+def split_capture(path, paths, choose):
+    """
+    Split a capture file into several capture files in the same format.
+
+    Each packet is copied to the file chosen for it, with its record or block
+    unchanged, so timestamps and link types are kept exactly. The file header
+    (and, for pcapng files, the section header and interface description
+    blocks) is copied to every file, so each file can be read on its own.
+
+    :param path: the path to the capture file to split
+    :type path: str
+    :param paths: the paths of the files to write
+    :type paths: list(str)
+    :param choose: a function given each packet that returns the index in
+                   ``paths`` of the file it is copied to, or None to leave
+                   the packet out
+    :type choose: function
+    :returns: the number of packets read
+    :rtype: int
+    """
+
+    trace = PcapTrace(path)
+    outputs = [open(output, "wb") for output in paths]
+    try:
+        buf = trace._buf # pylint: disable=protected-access
+        count = 0
+        mark = 0
+        pkt = Packet()
+        while trace.read_packet(pkt):
+            (start, end) = trace._span # pylint: disable=protected-access
+            if start > mark:
+                for output in outputs:
+                    output.write(buf[mark:start])
+            index = choose(pkt)
+            if index is not None:
+                outputs[index].write(buf[start:end])
+            mark = end
+            count += 1
+        # headers of a file without packets, and any trailing blocks
+        pos = trace._pos # pylint: disable=protected-access
+        if pos > mark:
+            for output in outputs:
+                output.write(buf[mark:pos])
+        return count
+    finally:
+        for output in outputs:
+            output.close()
+        trace.close()
+
+
+class PcapWriter:
+    """
+    Writes IP packets to a set of rotating pcap files.
+
+    Packets are written without a link layer header (``LINKTYPE_RAW``). Once
+    the current file has grown to ``file_size`` bytes, the next file is
+    started, and after ``file_count`` files the first file is overwritten, so
+    that at most ``file_count * file_size`` bytes are kept on disk. The files
+    are named ``path``, ``path.1``, ``path.2`` and so on.
+
+    No file is created until the first packet is written, so a writer can be
+    created before the process that uses it is started.
+
+    :param path: the path to the first capture file
+    :type path: str
+    :param snaplen: the maximum number of bytes written for each packet
+    :type snaplen: int
+    :param file_size: the size in bytes at which a new file is started, or
+                      None to write all packets to one file
+    :type file_size: int
+    :param file_count: the number of files to rotate through
+    :type file_count: int
+    """
+
+    def __init__(self, path, snaplen=65535, file_size=None, file_count=1):
+        if file_count < 1:
+            raise ValueError("A pcap writer needs at least one file")
+        self.path = path
+        self.snaplen = snaplen
+        self._file_size = file_size
+        self._file_count = file_count
+        self._file = None
+        self._index = 0
+        self._size = 0
+        #: The number of packets written
+        self.packets = 0
+
+    def _path(self, index):
+        return self.path if index == 0 else "{}.{}".format(self.path, index)
+
+    def _open(self):
+        self._file = open(self._path(self._index), "wb")
+        self._file.write(_PCAP_HEADER.pack(PCAP_MAGIC_USEC, 2, 4, 0, 0,
+                                           self.snaplen, LINKTYPE_RAW))
+        self._size = _PCAP_HEADER.size
+
+    def write(self, seconds, data):
+        """
+        Write a packet, truncated to ``snaplen`` bytes.
+
+        :param seconds: the time the packet was captured
+        :type seconds: float
+        :param data: the packet, starting with its IP header
+        :type data: bytes
+        """
+
+        if self._file is None:
+            self._open()
+        elif self._file_size is not None and self._size >= self._file_size:
+            self._file.close()
+            self._index = (self._index + 1) % self._file_count
+            self._open()
+
+        data = data[:self.snaplen]
+        # the original length is taken from the IP header, as the packet may
+        # already have been truncated
+        if len(data) >= 6 and data[0] >> 4 == 6:
+            wirelen = _U16.unpack_from(data, 4)[0] + 40
+        elif len(data) >= 4 and data[0] >> 4 == 4:
+            wirelen = _U16.unpack_from(data, 2)[0]
+        else:
+            wirelen = len(data)
+        wirelen = max(wirelen, len(data))
+
+        sec = int(seconds)
+        usec = min(int(round((seconds - sec) * 1e6)), 999999)
+        self._file.write(_PCAP_RECORD.pack(sec, usec, len(data), wirelen))
+        self._file.write(data)
+        self._size += _PCAP_RECORD.size + len(data)
+        self.packets += 1
+
+    def close(self):
+        """
+        Close the current capture file.
+        """
+
+        if self._file is not None:
+            self._file.close()
+            self._file = None
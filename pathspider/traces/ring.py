@@ -0,0 +1,283 @@
+"""
+.. module:: pathspider.traces.ring
+   :synopsis: A Linux AF_PACKET capture ring packet source
+
+This module contains a pure Python live packet source for Linux. Packets are
+captured from a network interface through an AF_PACKET socket with a
+TPACKET_V3 memory-mapped receive ring. The kernel fills blocks of packets in
+the ring and hands over whole blocks at a time, which are walked in place
+with the zero-copy header views in :mod:`pathspider.traces.packet`, so there
+is no system call per packet.
+
+Several rings on the same interface can join a PACKET_FANOUT group, in which
+case the kernel delivers all packets of a flow to the same ring using a
+symmetric flow hash. This allows the packets seen on an interface to be
+spread over several Observer processes, without each process receiving and
+discarding a copy of every packet.
+
+Capturing requires the ``CAP_NET_RAW`` capability.
+
+.. codeauthor:: Iain R. Learmonth <irl@fsfe.org>
+
+"""
+
+import mmap
+import select
+import socket
+import struct
+
+from pathspider.traces.packet import LINKTYPE_ETHERNET
+from pathspider.traces.packet import LINKTYPE_RAW
+from pathspider.traces.packet import Packet
+
+ETH_P_ALL = 0x0003
+
+SOL_PACKET = 263
+PACKET_ADD_MEMBERSHIP = 1
+PACKET_RX_RING = 5
+PACKET_STATISTICS = 6
+PACKET_VERSION = 10
+PACKET_FANOUT = 18
+
+PACKET_MR_PROMISC = 1
+TPACKET_V3 = 2
+PACKET_FANOUT_HASH = 0
+PACKET_FANOUT_FLAG_DEFRAG = 0x8000
+
+TP_STATUS_KERNEL = 0
+TP_STATUS_USER = 1
+
+# struct tpacket_req3
+_REQ = struct.Struct("=IIIIIII")
+# struct packet_mreq
+_MREQ = struct.Struct("=iHH8s")
+# struct tpacket_stats_v3
+_STATS = struct.Struct("=III")
+# block_status, num_pkts and offset_to_first_pkt of struct tpacket_block_desc
+_BLOCK = struct.Struct("=III")
+_U32 = struct.Struct("=I")
+_BLOCK_HEADER = 8
+# struct tpacket3_hdr up to tp_net
+_PACKET = struct.Struct("=IIIIIIHH")
+
+_FRAME_SIZE = 2048
+
+
+class RingTrace:
+    """
+    A packet source capturing from a network interface through a TPACKET_V3
+    memory-mapped receive ring.
+
+    The interface mirrors the parts of ``plt.trace`` used by the Observer, so
+    the trace can be used wherever a libtrace trace is expected:
+
+    .. code-block:: python
+
+     trace = RingTrace("eth0")
+     trace.start()
+     pkt = Packet()
+     while trace.read_packet(pkt):
+         print(pkt.seconds, pkt.ip)
+
+    Packets are only valid until the next packet is read, as the block
+    holding them is then returned to the kernel.
+
+    :param interface: the name of the network interface
+    :type interface: str
+    :param fanout: When given, the ring joins the PACKET_FANOUT group with
+                   this ID (0-65535), sharing the packets seen on the
+                   interface with the other rings in the group by flow
+    :type fanout: int
+    :param block_size: The size of each block of the ring in bytes. This
+                       must be a multiple of the page size, and limits the
+                       size of a captured packet.
+    :type block_size: int
+    :param block_count: The number of blocks in the ring
+    :type block_count: int
+    :param block_timeout: The time in milliseconds after which a partly
+                          filled block is handed over
+    :type block_timeout: int
+    :param promisc: Whether to put the interface in promiscuous mode while
+                    capturing
+    :type promisc: bool
+    """
+
+    def __init__(self, interface, fanout=None, block_size=1 << 20,
+                 block_count=64, block_timeout=100, promisc=True):
+        if fanout is not None and not 0 <= fanout <= 0xffff:
+            raise ValueError("PACKET_FANOUT group ID must be in the range "
+                             "0 <= fanout <= 65535")
+        self.interface = interface
+        self._fanout = fanout
+        self._block_size = block_size
+        self._block_count = block_count
+        self._block_timeout = block_timeout
+        self._promisc = promisc
+
+        self._sock = None
+        self._map = None
+        self._buf = b""
+        self._poll = None
+        self._drops = 0
+
+        # the block being read, the packets left in it, and the offset of
+        # the next packet
+        self._block = 0
+        self._held = False
+        self._left = 0
+        self._pos = 0
+
+    def start(self):
+        """
+        Set up the capture ring and start capturing.
+
+        :raises OSError: if the ring cannot be set up, e.g. because the
+                         interface does not exist or the process does not
+                         have the ``CAP_NET_RAW`` capability
+        """
+
+        sock = self._sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW,
+                                          socket.htons(ETH_P_ALL))
+        try:
+            sock.setsockopt(SOL_PACKET, PACKET_VERSION, TPACKET_V3)
+            sock.setsockopt(SOL_PACKET, PACKET_RX_RING, _REQ.pack(
+                self._block_size, self._block_count, _FRAME_SIZE,
+                self._block_size * self._block_count // _FRAME_SIZE,
+                self._block_timeout, 0, 0))
+            self._map = mmap.mmap(sock.fileno(),
+                                  self._block_size * self._block_count,
+                                  mmap.MAP_SHARED,
+                                  mmap.PROT_READ | mmap.PROT_WRITE)
+            self._buf = memoryview(self._map)
+            sock.bind((self.interface, ETH_P_ALL))
+            if self._promisc:
+                sock.setsockopt(SOL_PACKET, PACKET_ADD_MEMBERSHIP, _MREQ.pack(
+                    socket.if_nametoindex(self.interface), PACKET_MR_PROMISC,
+                    0, b""))
+            if self._fanout is not None:
+                sock.setsockopt(SOL_PACKET, PACKET_FANOUT, _U32.pack(
+                    self._fanout | (PACKET_FANOUT_HASH |
+                                    PACKET_FANOUT_FLAG_DEFRAG) << 16))
+        except OSError:
+            self.close()
+            raise
+
+        self._poll = select.poll()
+        self._poll.register(sock, select.POLLIN | select.POLLERR)
+
+    def pkt_drops(self):
+        """
+        Get the number of packets dropped by the kernel because the ring was
+        full since the capture was started.
+
+        :rtype: int
+        """
+
+        if self._sock is not None:
+            # the kernel resets its counters when they are read
+            self._drops += _STATS.unpack(self._sock.getsockopt(
+                SOL_PACKET, PACKET_STATISTICS, _STATS.size))[1]
+        return self._drops
+
+    def read_packet(self, pkt):
+        """
+        Read the next packet from the ring into a :class:`Packet`, waiting
+        for the kernel to hand over a block if necessary.
+
+        :param pkt: the packet to fill
+        :type pkt: pathspider.traces.packet.Packet
+        :returns: ``False`` if the capture has been closed
+        :rtype: bool
+        """
+
+        return self._read(pkt, True)
+
+    def poll_packet(self, pkt):
+        """
+        Read the next packet from the ring into a :class:`Packet` if one has
+        been handed over by the kernel, without waiting.
+
+        :param pkt: the packet to fill
+        :type pkt: pathspider.traces.packet.Packet
+        :returns: ``None`` if no packet is ready, or ``False`` if the capture
+                  has been closed
+        :rtype: bool
+        """
+
+        return self._read(pkt, False)
+
+    def fileno(self):
+        """
+        Get the file descriptor of the capture socket, which can be polled
+        for packets being ready.
+
+        :rtype: int
+        """
+
+        return self._sock.fileno()
+
+    def _read(self, pkt, wait):
+        while self._left == 0:
+            if self._held:
+                self._release_block()
+            ready = self._next_block(wait)
+            if not ready:
+                return ready
+
+        pos = self._pos
+        (next_offset, sec, nsec, snaplen, wirelen, _, mac,
+         net) = _PACKET.unpack_from(self._buf, pos)
+        self._left -= 1
+        self._pos = pos + next_offset
+        start = pos + mac
+        # devices without a link layer header (e.g. tunnels) capture IP
+        pkt.set(self._buf, start, start + snaplen, sec + nsec * 1e-9,
+                LINKTYPE_RAW if mac == net else LINKTYPE_ETHERNET, wirelen)
+        return True
+
+    def __iter__(self):
+        pkt = Packet()
+        while self.read_packet(pkt):
+            yield pkt
+
+    def close(self):
+        """
+        Release the ring and close the capture socket.
+        """
+
+        self._buf = b""
+        self._left = 0
+        self._held = False
+        if self._map is not None:
+            try:
+                self._map.close()
+            except BufferError:
+                # Views handed out for the last packet are still referenced
+                pass
+            self._map = None
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def _next_block(self, wait):
+        while self._sock is not None:
+            base = self._block * self._block_size
+            (status, count, first) = _BLOCK.unpack_from(
+                self._buf, base + _BLOCK_HEADER)
+            if status & TP_STATUS_USER:
+                self._held = True
+                self._left = count
+                self._pos = base + first
+                return True
+            if not wait:
+                return None
+            self._poll.poll()
+        return False
+
+    def _release_block(self):
+        # the block is handed back to the kernel once all of its packets
+        # have been read, and the last packet read is no longer needed
+        _U32.pack_into(self._buf, self._block * self._block_size +
+                                _BLOCK_HEADER, TP_STATUS_KERNEL)
+        self._held = False
+        self._block = (self._block + 1) % self._block_count
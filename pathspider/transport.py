@@ -0,0 +1,102 @@
+"""
+.. module:: pathspider.transport
+   :synopsis: Compact encoding of flows passed between hosts
+
+This module contains :class:`FlowCodec`, which packs flow records using the
+fields declared by the chains in use, so that the field names are not sent
+for every record. It is used to stream flows from a remote Observer (see
+:mod:`pathspider.remote`).
+
+.. codeauthor:: Iain R. Learmonth <irl@fsfe.org>
+
+"""
+
+import operator
+
+
+class FlowCodec:
+    """
+    Packs batches of flow records using the fields declared by the chains in
+    use.
+
+    Each flow record with exactly the declared fields is packed as a tuple of
+    its values in the order the fields were declared, so that the field names
+    are not repeated for every record. Any other flow record (e.g. one with
+    fields that were not declared) is packed as it is. The packed records
+    can then be serialised, for example as JSON.
+    """
+
+    def __init__(self, fields):
+        """
+        Create a codec for flow records with the given fields.
+
+        :param fields: the fields of the flow records, as returned by
+                       :func:`pathspider.observer.flow_fields`
+        :type fields: list(pathspider.chains.base.Field)
+        """
+
+        names = []
+        for field in fields:
+            if field.name not in names:
+                names.append(field.name)
+        self._names = tuple(names)
+        # itemgetter only returns a tuple for more than one field
+        self._getter = (operator.itemgetter(*names) if len(names) > 1
+                        else None)
+
+    @property
+    def names(self):
+        """
+        The names of the declared fields, in the order they are encoded.
+
+        :rtype: tuple(str)
+        """
+
+        return self._names
+
+    def pack(self, flows):
+        """
+        Convert a list of flow records to the tuples (or, for records
+        without exactly the declared fields, the dicts) they are encoded as.
+
+        :param flows: the flow records
+        :type flows: list(dict)
+        :rtype: list
+        """
+
+        getter = self._getter
+        count = len(self._names)
+        records = []
+        for flow in flows:
+            if getter is not None and len(flow) == count:
+                try:
+                    records.append(getter(flow))
+                    continue
+                except KeyError:
+                    pass
+            records.append(flow)
+        return records
+
+    def unpack(self, records):
+        """
+        Convert records produced by :meth:`pack` back to flow records. The
+        values of the declared fields may be given as a list rather than a
+        tuple, as they are when the records were serialised as JSON.
+
+        :param records: the packed records
+        :type records: list
+        :rtype: list(dict)
+        :raises ValueError: if a record is neither a dict nor a sequence of
+                            values
+        """
+
+        names = self._names
+        flows = []
+        for record in records:
+            if type(record) in (tuple, list):
+                flows.append(dict(zip(names, record)))
+            elif type(record) is dict:
+                flows.append(record)
+            else:
+                raise ValueError("Invalid packed flow record")
+        return flows
@@ -51,6 +51,10 @@ setup(
     packages=find_packages(exclude=['contrib', 'doc', 'examples']),
     include_package_data=True,
     install_requires=install_requires,
+    extras_require={
+        # vectorized offline observation with pspdr observe --columnar
+        'columnar': ['numpy'],
+    },
     entry_points={
         'console_scripts': [
             'pspdr=pathspider.cmd.base:handle_args_wrapper',